@@ -0,0 +1,199 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Boot timeline. How long after boot the first valid time was set, which is
+# when /run/sdwdate/first_success is created and the Whonix firewall leaves
+# timesync-fail-closed mode.
+#
+# Events, seconds since boot (CLOCK_BOOTTIME, includes suspend, not
+# affected by setting the clock):
+# process_start       sdwdate process started (/proc/self/stat). Time
+#                     before it is spent by the boot and by sdwdate-pre.
+# ready               READY=1 sent to systemd.
+# tor_ready           onion-time-pre-script succeeded.
+# first_fetch_sent    first requests to time sources started.
+# first_valid_result  first time source returned a valid time.
+# first_time_set      first time set, first_success created.
+#
+# Written to /run/sdwdate/boot_timeline (JSON) after each event, until
+# first_time_set. If sdwdate is restarted before that, the events of the
+# earlier processes of this boot are kept, every event is recorded once
+# per boot. Exported as metrics sdwdate_boot_timeline_seconds{event=...}
+# and sdwdate_time_to_first_sync_seconds.
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import time
+import threading
+
+
+EVENTS = (
+    "process_start",
+    "ready",
+    "tor_ready",
+    "first_fetch_sent",
+    "first_valid_result",
+    "first_time_set",
+)
+
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+
+def boottime_seconds():
+    return time.clock_gettime(time.CLOCK_BOOTTIME)
+
+
+def process_start_boottime_seconds():
+    """
+    Start of this process, seconds since boot, or None if unknown.
+    """
+    try:
+        with open("/proc/self/stat") as file_object:
+            stat = file_object.read()
+        # The process name (field 2) may contain spaces and parentheses.
+        # Field 22 is starttime, clock ticks since boot.
+        fields = stat[stat.rindex(")") + 2:].split()
+        return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_boot_id():
+    """
+    Returns None if unavailable, for example with systemd ProcSubset=pid.
+    /run is emptied at boot anyway.
+    """
+    try:
+        with open(BOOT_ID_PATH) as file_object:
+            return file_object.read().strip()
+    except OSError:
+        return None
+
+
+class BootTimeline(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.marks = {}
+        self.path = None
+        self.boot_id = read_boot_id()
+        self.process_starts = 1
+        self.recording = True
+
+    def mark(self, event, seconds=None):
+        """
+        Record event now (or at seconds since boot) unless already recorded
+        this boot. Returns True if recorded.
+        """
+        with self.lock:
+            if not self.recording or event in self.marks:
+                return False
+            if seconds is None:
+                seconds = boottime_seconds()
+            self.marks[event] = round(seconds, 3)
+            if event == "first_time_set":
+                self.recording = False
+        self.write()
+        return True
+
+    def load(self, path, first_success):
+        """
+        Called once path is known. Merges the timeline of earlier sdwdate
+        processes of this boot. first_success: whether
+        /run/sdwdate/first_success exists.
+        """
+        import json
+        process_start = process_start_boottime_seconds()
+        if process_start is not None:
+            self.mark("process_start", process_start)
+        previous = None
+        try:
+            with open(path) as file_object:
+                previous = json.load(file_object)
+        except (OSError, ValueError):
+            pass
+        if previous is not None and not self.same_boot(previous):
+            previous = None
+
+        with self.lock:
+            self.path = path
+            if previous is not None:
+                marks = dict(previous.get("events", {}))
+                for event, seconds in self.marks.items():
+                    marks.setdefault(event, seconds)
+                self.marks = marks
+                self.process_starts = previous.get("process_starts", 1) + 1
+            # The first sync of this boot happened before this process and
+            # its timeline is gone (folder not in /run) or was never written.
+            if "first_time_set" in self.marks or \
+                    (previous is None and first_success):
+                self.recording = False
+                self.marks = dict(previous.get("events", {})) \
+                    if previous is not None else {}
+                return
+        self.write()
+
+    def same_boot(self, previous):
+        if previous.get("boot_id") is not None and self.boot_id is not None:
+            return previous["boot_id"] == self.boot_id
+        # Seconds since boot only grow within a boot.
+        seconds = [
+            value for value in previous.get("events", {}).values()
+            if value is not None
+        ]
+        return not seconds or max(seconds) <= boottime_seconds()
+
+    def record(self):
+        with self.lock:
+            return {
+                "boot_id": self.boot_id,
+                "process_starts": self.process_starts,
+                "events": {
+                    event: self.marks[event]
+                    for event in EVENTS if event in self.marks
+                },
+            }
+
+    def write(self):
+        import json
+        with self.lock:
+            path = self.path
+        if path is None:
+            return
+        temp_path = path + ".tmp." + str(os.getpid())
+        try:
+            with open(temp_path, "w") as file_object:
+                json.dump(self.record(), file_object, sort_keys=True)
+            os.replace(temp_path, path)
+        except OSError:
+            error_message = str(sys.exc_info()[0]) + " " + \
+                str(sys.exc_info()[1])
+            print("boot_timeline.py: could not write " + path + " " +
+                  error_message)
+
+    def gauges(self):
+        """
+        For MetricsRegistry.set_gauge.
+        """
+        events = self.record()["events"]
+        return {
+            (("event", event),): seconds
+            for event, seconds in events.items() if seconds is not None
+        }
+
+    def time_to_first_sync(self):
+        with self.lock:
+            return self.marks.get("first_time_set")
+
+    def summary(self):
+        events = self.record()["events"]
+        return " ".join(
+            event + ": " + str(events.get(event))
+            for event in EVENTS
+        )
+
+
+BOOT_TIMELINE = BootTimeline()
@@ -31,6 +31,8 @@ def time_human_readable(unixtime):
 
 def time_replay_protection_file_read():
     import subprocess
+    from sdwdate.spans import count_child_process
+    count_child_process()
     process = subprocess.Popen(
         "/usr/bin/minimum-unixtime-show",
         stdout=subprocess.PIPE,
@@ -44,6 +46,150 @@ def time_replay_protection_file_read():
     return unixtime, time_human_readable
 
 
+def read_config_option(option, default):
+    """ Value of the last line starting with 'option=' of all files in
+        /etc/sdwdate.d/*.conf in lexical order, otherwise default.
+    """
+    value = default
+    if not os.path.exists("/etc/sdwdate.d/"):
+        return value
+    files = sorted(glob.glob("/etc/sdwdate.d/*.conf"))
+    for file_item in files:
+        with open(file_item) as conf:
+            lines = conf.readlines()
+        for line in lines:
+            if line.startswith(option + "="):
+                value = line.split("=", 1)[1].strip()
+    return value
+
+
+def control_socket_config():
+    return read_config_option("CONTROL_SOCKET", "false") == "true"
+
+
+def ntp_shm_config():
+    """ Returns the NTP SHM unit number or None if disabled.
+    """
+    if read_config_option("NTP_SHM", "false") != "true":
+        return None
+    return int(read_config_option("NTP_SHM_UNIT", "2"))
+
+
+def time_distribution_server_config():
+    """ Returns the listen address (ip:port) or None if disabled.
+    """
+    if read_config_option("TIME_DISTRIBUTION_SERVER", "false") != "true":
+        return None
+    return read_config_option(
+        "TIME_DISTRIBUTION_SERVER_LISTEN", "10.152.152.10:9199")
+
+
+def time_distribution_client_config():
+    """ Returns the server address (ip:port) or None if disabled.
+    """
+    if read_config_option("TIME_DISTRIBUTION_CLIENT", "false") != "true":
+        return None
+    return read_config_option(
+        "TIME_DISTRIBUTION_SERVER_ADDRESS", "10.152.152.10:9199")
+
+
+def time_distribution_key_file_config():
+    return read_config_option(
+        "TIME_DISTRIBUTION_KEY_FILE", "/etc/sdwdate.d/time-distribution.key")
+
+
+def time_distribution_max_age_config():
+    return int(read_config_option("TIME_DISTRIBUTION_MAX_AGE", "14400"))
+
+
+def metrics_textfile_config():
+    """ Returns the path of the metrics text file or None if disabled.
+        Environment variable SDWDATE_METRICS_TEXTFILE takes precedence over
+        the config files. MEASURE_ONLY: None if it is the file of the config
+        files, which belongs to the instance setting the time.
+    """
+    configured_metrics_textfile = read_config_option("METRICS_TEXTFILE", "")
+    metrics_textfile = os.environ.get(
+        "SDWDATE_METRICS_TEXTFILE", configured_metrics_textfile)
+    if metrics_textfile == "":
+        return None
+    if measure_only_config() and \
+            metrics_textfile == configured_metrics_textfile:
+        return None
+    return metrics_textfile
+
+
+def span_timing_config():
+    return read_config_option("SPAN_TIMING", "false") == "true"
+
+
+def journal_structured_config():
+    return read_config_option("JOURNAL_STRUCTURED", "false") == "true"
+
+
+def log_compact_config():
+    return read_config_option("LOG_COMPACT", "false") == "true"
+
+
+def transcript_record_config():
+    return read_config_option("TRANSCRIPT_RECORD", "false") == "true"
+
+
+def transcript_keep_config():
+    return int(read_config_option("TRANSCRIPT_KEEP", "100"))
+
+
+def memory_release_config():
+    return read_config_option("MEMORY_RELEASE", "true") == "true"
+
+
+def probe_config():
+    """ Returns None if background probing is disabled, otherwise
+        (probes per hour, concurrency, bytes per hour, max age seconds).
+    """
+    if read_config_option("PROBE", "false") != "true":
+        return None
+    return (
+        float(read_config_option("PROBE_PER_HOUR", "4")),
+        int(read_config_option("PROBE_CONCURRENCY", "2")),
+        int(read_config_option("PROBE_BYTES_PER_HOUR", "32768")),
+        int(read_config_option("PROBE_MAX_AGE", "3600")),
+    )
+
+
+def warm_restart_max_age_config():
+    """ Returns seconds, 0 if warm restart is disabled.
+    """
+    return int(read_config_option("WARM_RESTART_MAX_AGE", "900"))
+
+
+def measure_only_config():
+    """ Returns True if sdwdate runs rounds without setting the time.
+        Environment variable SDWDATE_MEASURE_ONLY takes precedence over the
+        config files.
+    """
+    measure_only = os.environ.get(
+        "SDWDATE_MEASURE_ONLY", read_config_option("MEASURE_ONLY", "false"))
+    return measure_only == "true"
+
+
+def profile_config():
+    """ Returns (number of rounds to profile, tuple of profile modes).
+        Environment variables SDWDATE_PROFILE_ROUNDS and SDWDATE_PROFILE_MODE
+        take precedence over the config files.
+    """
+    rounds = os.environ.get(
+        "SDWDATE_PROFILE_ROUNDS", read_config_option("PROFILE_ROUNDS", "0"))
+    modes = os.environ.get(
+        "SDWDATE_PROFILE_MODE", read_config_option("PROFILE_MODE", "cprofile"))
+    try:
+        rounds = int(rounds)
+    except ValueError:
+        rounds = 0
+    modes = tuple(mode.strip() for mode in modes.split(",") if mode.strip())
+    return rounds, modes
+
+
 def randomize_time_config():
     status = False
     if not os.path.exists("/etc/sdwdate.d/"):
@@ -171,18 +317,17 @@ def sort_pool(pool, mode):
     return(pool_single_url, pool_single_comment)
 
 
-def read_pools(pool, mode):
-    SDWDATE_POOL_ZERO = False
-    SDWDATE_POOL_ONE = False
-    SDWDATE_POOL_TWO = False
+POOL_PREFIX = "SDWDATE_POOL_"
 
-    pool_one = []
-    pool_two = []
-    pool_three = []
 
-    pool_one_url = []
-    pool_two_url = []
-    pool_three_url = []
+def read_pool_definitions():
+    """ Returns a list of (pool name, config lines) in the order the pools
+        are first declared. Any SDWDATE_POOL_<NAME>=( declares a pool.
+        Declaring the same name again in a later file adds to that pool.
+    """
+    pool_names = []
+    pool_lines = {}
+    current_pool = None
 
     if os.path.exists('/etc/sdwdate.d/'):
         files = sorted(glob.glob('/etc/sdwdate.d/*.conf'))
@@ -194,26 +339,16 @@ def read_pools(pool, mode):
                 with open(conf) as c:
                     for line in c:
                         line = line.strip()
-                        if line.startswith('SDWDATE_POOL_ZERO'):
-                            SDWDATE_POOL_ZERO = True
-
-                        elif line.startswith('SDWDATE_POOL_ONE'):
-                            SDWDATE_POOL_ZERO = False
-                            SDWDATE_POOL_ONE = True
-
-                        elif line.startswith('SDWDATE_POOL_TWO'):
-                            SDWDATE_POOL_ZERO = False
-                            SDWDATE_POOL_ONE = False
-                            SDWDATE_POOL_TWO = True
+                        if line.startswith(POOL_PREFIX) and '=' in line:
+                            current_pool = line[len(POOL_PREFIX):].split(
+                                '=', 1)[0].strip()
+                            if current_pool not in pool_lines:
+                                pool_names.append(current_pool)
+                                pool_lines[current_pool] = []
 
-                        elif SDWDATE_POOL_ZERO and not line.startswith('##'):
-                            pool_one.append(line)
-
-                        elif SDWDATE_POOL_ONE and not line.startswith('##'):
-                            pool_two.append(line)
-
-                        elif SDWDATE_POOL_TWO and not line.startswith('##'):
-                            pool_three.append(line)
+                        elif current_pool is not None and \
+                                not line.startswith('##'):
+                            pool_lines[current_pool].append(line)
 
             if not conf_found:
                 print(
@@ -225,21 +360,44 @@ def read_pools(pool, mode):
     else:
         print('User configuration folder "/etc/sdwdate.d" does not exist.')
 
-    pool_one_url, pool_one_comment = sort_pool(pool_one, mode)
-    pool_two_url, pool_two_comment = sort_pool(pool_two, mode)
-    pool_three_url, pool_three_comment = sort_pool(pool_three, mode)
+    return [(name, pool_lines[name]) for name in pool_names]
+
+
+def number_of_pools_config():
+    return len(read_pool_definitions())
 
-    pool_url = [pool_one_url, pool_two_url, pool_three_url]
-    pool_comment = [pool_one_comment, pool_two_comment, pool_three_comment]
 
-    return(pool_url[pool],
-           pool_comment[pool])
+def clamp_pool_quorum(quorum, number_of_pools):
+    """ Limits quorum to a majority of the pools ... number_of_pools. """
+    return max(number_of_pools // 2 + 1, min(quorum, number_of_pools))
+
+
+def pool_quorum_config(number_of_pools):
+    """ Returns how many pools must return a valid time (k of N) before the
+        median is used. Defaults to all pools. Limited to a majority of the
+        pools ... N.
+    """
+    quorum = read_config_option("POOL_QUORUM", "")
+    try:
+        quorum = int(quorum)
+    except ValueError:
+        return number_of_pools
+    return clamp_pool_quorum(quorum, number_of_pools)
+
+
+def read_pools(pool, mode):
+    pool_definitions = read_pool_definitions()
+    pool_name, pool_lines = pool_definitions[pool]
+    pool_url, pool_comment = sort_pool(pool_lines, mode)
+
+    return(pool_url,
+           pool_comment)
 
 
 if __name__ == "__main__":
     pool = int(sys.argv[1])
     mode = sys.argv[2]
     pool_url, pool_comment = read_pools(pool, mode)
-    print("pool: " + str(pool))
+    print("pool: " + str(pool) + " (" + read_pool_definitions()[pool][0] + ")")
     print("pool_url: " + str(pool_url))
     print("pool_comment: " + str(pool_comment))
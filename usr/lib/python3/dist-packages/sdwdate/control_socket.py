@@ -0,0 +1,246 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Examples:
+# sudo -u sdwdate python3 /usr/lib/python3/dist-packages/sdwdate/control_socket.py status
+# sudo -u sdwdate python3 /usr/lib/python3/dist-packages/sdwdate/control_socket.py subscribe
+# sudo -u sdwdate python3 /usr/lib/python3/dist-packages/sdwdate/control_socket.py resync
+# sudo -u sdwdate python3 /usr/lib/python3/dist-packages/sdwdate/control_socket.py clock-jump
+
+# Protocol:
+# The client sends one command terminated by a new line.
+# The server replies with one JSON object per line.
+#
+# status     : current snapshot, then the connection is closed.
+# subscribe  : current snapshot, then a new snapshot whenever it changed.
+# resync     : same as signal SIGUSR1. Only allowed for root and sdwdate.
+# clock-jump : same as signal SIGUSR2. Only allowed for root and sdwdate.
+#
+# The socket is mode 0660, only accessible by user sdwdate, group sdwdate
+# and root. At most CONNECTIONS_MAX connections, each served by a thread,
+# of which at most SUBSCRIBERS_MAX subscribe. Further connections are
+# closed straight away, further subscribers get an error. Clients which do
+# not send their command, or subscribers which do not read, within
+# CONNECTION_TIMEOUT_SECONDS are disconnected.
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import json
+import time
+import signal
+import select
+import socket
+import struct
+import threading
+import socketserver
+from pathlib import Path
+
+
+CONTROL_SOCKET_DEFAULT_PATH = "/run/sdwdate/sdwdate.sock"
+
+COMMAND_MAX_LENGTH = 64
+
+CONNECTIONS_MAX = 16
+SUBSCRIBERS_MAX = 4
+
+# Seconds. Socket timeout for reading the command and for every write.
+CONNECTION_TIMEOUT_SECONDS = 10
+
+# Seconds. Subscribers check for shutdown this often.
+SUBSCRIBE_WAIT_SECONDS = 60
+
+
+class StatusSnapshot(object):
+    """
+    Thread safe holder of the state served by the control socket.
+    Every update produces a new version. Readers always get a serialized
+    copy of one version, never a partially updated one.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.data = {
+            "phase": "starting",
+            "icon": "",
+            "message": "",
+            "round": 0,
+            "fetch_iteration": 0,
+            "sources": [],
+            "median_offset": None,
+            "error_bound": None,
+            "new_diff": None,
+            "next_wake_unixtime": None,
+            "updated_unixtime": None,
+        }
+
+    def update(self, **kwargs):
+        with self.condition:
+            self.data.update(kwargs)
+            self.data["updated_unixtime"] = round(time.time(), 3)
+            self.version += 1
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            return self.version, json.dumps(self.data)
+
+    def wait_for_change(self, version, timeout):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.version != version, timeout)
+            return self.version, json.dumps(self.data)
+
+
+def peer_is_privileged(connection):
+    creds = connection.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    pid, uid, gid = struct.unpack("3i", creds)
+    return uid == 0 or uid == os.getuid()
+
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    # Set as socket timeout by StreamRequestHandler.setup.
+    timeout = CONNECTION_TIMEOUT_SECONDS
+
+    def handle(self):
+        try:
+            self.handle_command()
+        except OSError:
+            # Timeout or client disconnected.
+            return
+
+    def handle_command(self):
+        command = self.rfile.readline(COMMAND_MAX_LENGTH)
+        command = command.decode("utf-8", errors="replace").strip()
+        snapshot = self.server.snapshot
+
+        if command == "status":
+            version, data = snapshot.get()
+            self.send_line(data)
+        elif command == "subscribe":
+            if not self.server.subscribers.acquire(blocking=False):
+                self.send_line(json.dumps({"error": "too many subscribers"}))
+                return
+            try:
+                self.subscribe(snapshot)
+            finally:
+                self.server.subscribers.release()
+        elif command in ("resync", "clock-jump"):
+            if not peer_is_privileged(self.request):
+                self.send_line(json.dumps({"error": "permission denied"}))
+                return
+            if command == "resync":
+                sig = signal.SIGUSR1
+            else:
+                sig = signal.SIGUSR2
+            # Handled by the signal handler in the main thread of sdwdate.
+            os.kill(os.getpid(), sig)
+            self.send_line(json.dumps({"result": "ok"}))
+        else:
+            self.send_line(json.dumps({"error": "unknown command"}))
+
+    def subscribe(self, snapshot):
+        version, data = snapshot.get()
+        while True:
+            try:
+                self.send_line(data)
+            except OSError:
+                # Subscriber disconnected.
+                return
+            # Only changed snapshots are sent.
+            new_version = version
+            while new_version == version:
+                if self.server.shutting_down or self.peer_closed():
+                    return
+                new_version, data = snapshot.wait_for_change(
+                    version, SUBSCRIBE_WAIT_SECONDS)
+            version = new_version
+
+    def peer_closed(self):
+        """
+        Subscribers do not send anything after the command. Readable means
+        end of file (or unexpected data), the subscriber is gone.
+        """
+        readable, writable, exceptional = select.select(
+            [self.request], [], [], 0)
+        return bool(readable)
+
+    def send_line(self, data):
+        self.wfile.write(data.encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, snapshot):
+        self.snapshot = snapshot
+        self.shutting_down = False
+        self.connections_lock = threading.Lock()
+        self.connections = 0
+        self.subscribers = threading.BoundedSemaphore(SUBSCRIBERS_MAX)
+        socketserver.UnixStreamServer.__init__(
+            self, socket_path, ControlRequestHandler)
+
+    def verify_request(self, request, client_address):
+        """
+        Refused connections are closed without starting a thread.
+        """
+        with self.connections_lock:
+            if self.connections >= CONNECTIONS_MAX:
+                return False
+            self.connections += 1
+            return True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            with self.connections_lock:
+                self.connections -= 1
+
+
+def start_control_socket(socket_path, snapshot):
+    # Stale socket of a previous run.
+    Path(socket_path).unlink(missing_ok=True)
+    server = ControlServer(socket_path, snapshot)
+    # User sdwdate, group sdwdate (readers such as sdwdate-gui) and root.
+    # Commands changing state are restricted by peer_is_privileged.
+    os.chmod(socket_path, 0o660)
+    thread = threading.Thread(
+        target=server.serve_forever, name="control_socket", daemon=True)
+    thread.start()
+    return server
+
+
+def stop_control_socket(server, socket_path):
+    server.shutting_down = True
+    try:
+        # Stops serve_forever, waits at most its poll interval.
+        server.shutdown()
+        server.server_close()
+    except BaseException:
+        pass
+    Path(socket_path).unlink(missing_ok=True)
+
+
+def query(command, socket_path=CONTROL_SOCKET_DEFAULT_PATH):
+    """
+    Generator yielding the decoded JSON replies of sdwdate.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(command.encode("utf-8") + b"\n")
+        with client.makefile("rb") as reader:
+            for line in reader:
+                yield json.loads(line)
+
+
+if __name__ == "__main__":
+    for reply in query(sys.argv[1]):
+        print(json.dumps(reply, indent=2), flush=True)
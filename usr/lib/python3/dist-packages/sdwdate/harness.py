@@ -0,0 +1,403 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Hermetic stand-ins for benchmarking sdwdate without Tor.
+#
+# FakeTimeSource : local HTTP server replying with a (skewed) Date header
+#                  after a configurable latency. Can fail randomly.
+# Socks5Proxy    : local SOCKS5 proxy resolving fake onion host names
+#                  (socks5h, as used by url_to_unixtime) to FakeTimeSource
+#                  ports.
+#
+# url_to_unixtime is run unmodified against these. Tor specific sanity checks
+# (Tor consensus, minimum-unixtime-show) are replaced by stand-ins, see
+# install_sanity_check_stand_ins.
+#
+# Only http is supported. https onions would require a certificate trusted by
+# url_to_unixtime.
+#
+# Used by /usr/share/sdwdate/benchmark.
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import time
+import random
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from email.utils import formatdate
+
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+# Lower than the url_to_unixtime timeout (120 seconds) of run_command.
+MAXIMUM_LATENCY_SECONDS = 100
+
+SOCKS_VERSION = 5
+SOCKS_COMMAND_CONNECT = 1
+SOCKS_ADDRESS_TYPE_IPV4 = 1
+SOCKS_ADDRESS_TYPE_DOMAIN = 3
+SOCKS_REPLY_SUCCEEDED = 0
+SOCKS_REPLY_HOST_UNREACHABLE = 4
+SOCKS_REPLY_COMMAND_NOT_SUPPORTED = 7
+
+
+class SourceProfile(object):
+    """
+    Behavior of a fake time source.
+    latency: seconds. Median for lognormal, mean for uniform.
+    latency_jitter: seconds. Spread for uniform, sigma for lognormal.
+    skew: seconds added to the Date header.
+    failure_rate: 0 to 1. Failed requests are closed without reply.
+    timeout_rate: 0 to 1. Timed out requests are never replied to, like an
+    unreachable onion service.
+    body_size: bytes of the response body.
+    """
+    def __init__(self, latency=0.5, latency_jitter=0.2,
+                 distribution="lognormal", skew=0, failure_rate=0.0,
+                 timeout_rate=0.0, body_size=512):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError("unknown latency distribution: " + distribution)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.distribution = distribution
+        self.skew = skew
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.body_size = body_size
+
+    def sample_latency(self, random_object):
+        if self.distribution == "fixed":
+            latency = self.latency
+        elif self.distribution == "uniform":
+            latency = random_object.uniform(
+                self.latency - self.latency_jitter,
+                self.latency + self.latency_jitter)
+        else:
+            latency = random_object.lognormvariate(
+                0, self.latency_jitter) * self.latency
+        return min(max(latency, 0), MAXIMUM_LATENCY_SECONDS)
+
+    def sample_outcome(self, random_object):
+        """
+        Returns "ok", "failure" or "timeout".
+        """
+        value = random_object.random()
+        if value < self.timeout_rate:
+            return "timeout"
+        if value < self.timeout_rate + self.failure_rate:
+            return "failure"
+        return "ok"
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class FakeTimeSourceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        request = b""
+        while b"\r\n\r\n" not in request:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            request += data
+
+        with server.lock:
+            latency = server.profile.sample_latency(server.random_object)
+            outcome = server.profile.sample_outcome(server.random_object)
+            server.requests += 1
+            if outcome != "ok":
+                server.failures += 1
+
+        if outcome == "timeout":
+            # Until the client gives up.
+            while self.request.recv(4096):
+                pass
+            return
+
+        time.sleep(latency)
+        if outcome == "failure":
+            return
+
+        body = b"x" * server.profile.body_size
+        header = (
+            "HTTP/1.1 200 OK\r\n"
+            "Date: " + formatdate(
+                time.time() + server.profile.skew, usegmt=True) + "\r\n"
+            "Content-Type: text/plain\r\n"
+            "Content-Length: " + str(len(body)) + "\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        if request.startswith(b"HEAD "):
+            # Headers only, Content-Length as for GET.
+            body = b""
+        self.request.sendall(header.encode("ascii") + body)
+
+
+class FakeTimeSource(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host_name, profile, seed=None):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ("127.0.0.1", 0), FakeTimeSourceHandler)
+        self.host_name = host_name
+        self.profile = profile
+        self.random_object = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def url(self):
+        return "http://" + self.host_name
+
+    @property
+    def port_number(self):
+        return self.server_address[1]
+
+
+def receive_exactly(connection, length):
+    data = b""
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def relay(source, destination):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            destination.sendall(data)
+    except OSError:
+        pass
+    finally:
+        try:
+            destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class Socks5Handler(socketserver.BaseRequestHandler):
+    def reply(self, code):
+        self.request.sendall(
+            struct.pack("!BBBB4sH", SOCKS_VERSION, code, 0,
+                        SOCKS_ADDRESS_TYPE_IPV4, b"\x00" * 4, 0))
+
+    def handle(self):
+        connection = self.request
+        try:
+            version, number_of_methods = receive_exactly(connection, 2)
+            receive_exactly(connection, number_of_methods)
+            # No authentication.
+            connection.sendall(bytes((SOCKS_VERSION, 0)))
+
+            version, command, reserved, address_type = \
+                receive_exactly(connection, 4)
+            if address_type == SOCKS_ADDRESS_TYPE_DOMAIN:
+                length = receive_exactly(connection, 1)[0]
+                host_name = receive_exactly(connection, length).decode("ascii")
+            elif address_type == SOCKS_ADDRESS_TYPE_IPV4:
+                host_name = socket.inet_ntoa(receive_exactly(connection, 4))
+            else:
+                self.reply(SOCKS_REPLY_COMMAND_NOT_SUPPORTED)
+                return
+            receive_exactly(connection, 2)
+        except (OSError, ValueError):
+            return
+
+        if command != SOCKS_COMMAND_CONNECT:
+            self.reply(SOCKS_REPLY_COMMAND_NOT_SUPPORTED)
+            return
+
+        port_number = self.server.routes.get(host_name)
+        if port_number is None:
+            self.reply(SOCKS_REPLY_HOST_UNREACHABLE)
+            return
+
+        try:
+            upstream = socket.create_connection(("127.0.0.1", port_number))
+        except OSError:
+            self.reply(SOCKS_REPLY_HOST_UNREACHABLE)
+            return
+
+        with upstream:
+            self.reply(SOCKS_REPLY_SUCCEEDED)
+            thread = threading.Thread(
+                target=relay, args=(upstream, connection), daemon=True)
+            thread.start()
+            relay(connection, upstream)
+            thread.join()
+
+
+class Socks5Proxy(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ("127.0.0.1", 0), Socks5Handler)
+        # host name -> local port
+        self.routes = {}
+
+    @property
+    def port_number(self):
+        return self.server_address[1]
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def fake_onion_host_name(pool_number, index):
+    # 56 characters, like v3 onion addresses.
+    label = ("benchmarkpool" + str(pool_number) + "source" + str(index))
+    return label.ljust(56, "a")[:56] + ".onion"
+
+
+class FakeNetwork(object):
+    """
+    A SOCKS5 proxy and fake time sources grouped into pools.
+    profiles: list (pools) of lists (sources) of SourceProfile.
+    """
+    def __init__(self, profiles, seed=0):
+        self.proxy = start_server(Socks5Proxy())
+        self.pools = []
+        for pool_number, pool_profiles in enumerate(profiles):
+            sources = []
+            for index, profile in enumerate(pool_profiles):
+                source = start_server(FakeTimeSource(
+                    fake_onion_host_name(pool_number, index),
+                    profile,
+                    seed=seed * 1000003 + pool_number * 1009 + index
+                ))
+                self.proxy.routes[source.host_name] = source.port_number
+                sources.append(source)
+            self.pools.append(sources)
+
+    def pool_urls(self, pool_number):
+        return [source.url for source in self.pools[pool_number]]
+
+    def request_counts(self):
+        requests = 0
+        failures = 0
+        for sources in self.pools:
+            for source in sources:
+                requests += source.requests
+                failures += source.failures
+        return requests, failures
+
+    def shutdown(self):
+        self.proxy.shutdown()
+        self.proxy.server_close()
+        for sources in self.pools:
+            for source in sources:
+                source.shutdown()
+                source.server_close()
+
+
+class FakePool(object):
+    """
+    Stands in for TimeSourcePool where only url and comment are used.
+    """
+    def __init__(self, urls):
+        self.url = list(urls)
+        self.comment = ["benchmark"] * len(self.url)
+        self.url_random_pool = []
+        self.already_picked_index = []
+        self.done = False
+
+
+def time_replay_protection_file_read_stand_in():
+    # Same format as time_replay_protection_file_read. One day ago.
+    unixtime = int(time.time()) - 86400
+    return unixtime, time.strftime(
+        "%a %b %d %H:%M:%S UTC %Y", time.gmtime(unixtime))
+
+
+def static_time_sanity_check_stand_in(unixtime_to_validate):
+    return "sane", "none"
+
+
+def time_consensus_sanity_check_stand_in(unixtime):
+    # A consensus valid from one hour ago for three hours.
+    now = time.time()
+    valid_after = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - 3600))
+    valid_until = time.strftime(
+        "%Y-%m-%d %H:%M:%S", time.gmtime(now + 2 * 3600))
+    return "ok", "", valid_after, valid_until
+
+
+def install_sanity_check_stand_ins():
+    from sdwdate import remote_times
+    remote_times.time_replay_protection_file_read = \
+        time_replay_protection_file_read_stand_in
+    remote_times.static_time_sanity_check = static_time_sanity_check_stand_in
+    remote_times.time_consensus_sanity_check = \
+        time_consensus_sanity_check_stand_in
+
+
+def configure_sdwdate_module(status_folder, pool_urls, proxy_ip, proxy_port,
+                             pool_quorum=None):
+    """
+    Set the module globals of sdwdate.sdwdate which main() and global_files()
+    would otherwise set, so SdwdateClass methods can be called directly.
+    pool_urls: list (pools) of lists of urls.
+    pool_quorum: as POOL_QUORUM. None: all pools.
+    Returns the sdwdate.sdwdate module.
+    """
+    from sdwdate import sdwdate as sdwdate_module
+    from sdwdate.config import clamp_pool_quorum
+
+    os.makedirs(status_folder, exist_ok=True)
+
+    logger = logging.getLogger("sdwdate-harness")
+    logger.setLevel(logging.WARNING)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+
+    sdwdate_module.LOGGER = logger
+    sdwdate_module.translate_object = lambda message: message
+    sdwdate_module.proxy_ip = proxy_ip
+    sdwdate_module.proxy_port = proxy_port
+    sdwdate_module.proxy_scheduler = None
+    sdwdate_module.resync_requested = False
+    sdwdate_module.sleep_process = []
+    sdwdate_module.sclockadj_process = []
+    sdwdate_module.status_first_success_path = status_folder + "/first_success"
+    sdwdate_module.status_success_path = status_folder + "/success"
+    sdwdate_module.status_file_path = status_folder + "/status"
+    sdwdate_module.sleep_long_file_path = status_folder + "/sleep_long"
+    sdwdate_module.fail_file_path = status_folder + "/fail"
+    sdwdate_module.clock_jump_do_once_file = \
+        status_folder + "/clock_jump_do_once"
+    sdwdate_module.msg_path = status_folder + "/msg"
+    sdwdate_module.profile_folder_path = status_folder + "/profile"
+
+    def read_pools_stand_in(pool, mode):
+        return list(pool_urls[pool]), ["benchmark"] * len(pool_urls[pool])
+
+    def pool_quorum_stand_in(number_of_pools):
+        if pool_quorum is None:
+            return number_of_pools
+        return clamp_pool_quorum(pool_quorum, number_of_pools)
+
+    sdwdate_module.read_pools = read_pools_stand_in
+    sdwdate_module.number_of_pools_config = lambda: len(pool_urls)
+    sdwdate_module.pool_quorum_config = pool_quorum_stand_in
+    return sdwdate_module
@@ -0,0 +1,130 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# systemd watchdog heartbeat.
+#
+# The main loop enters a phase with a deadline (HEARTBEAT.enter) whenever it
+# makes progress. A thread sends WATCHDOG=1 every half WatchdogSec while the
+# current phase is within its deadline. Once a phase overruns, pings stop
+# and systemd restarts sdwdate after WatchdogSec. A hang is therefore
+# noticed after the deadline of the phase plus WatchdogSec, not after the
+# longest possible sleep.
+#
+# Without WATCHDOG_USEC (not started by systemd or no WatchdogSec) phases
+# are still tracked, but nothing is sent.
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import time
+import threading
+
+
+# Seconds. Deadlines of phases, from entering the phase.
+# One onion-time-pre-script run and the wait after it.
+PREPARATION_DEADLINE_SECONDS = 180
+# Margin added to the deadlines of fetching (url_to_unixtime timeout,
+# times the number of SOCKS endpoints tried) and sleeping (sleep time).
+FETCH_MARGIN_SECONDS = 120
+SLEEP_MARGIN_SECONDS = 120
+# Setting the time, writing files, transcripts, releasing memory.
+DEFAULT_DEADLINE_SECONDS = 120
+
+
+def watchdog_interval_seconds():
+    """
+    Half of WatchdogSec, or None if systemd does not expect pings from this
+    process.
+    """
+    watchdog_pid = os.environ.get("WATCHDOG_PID")
+    if watchdog_pid is not None and watchdog_pid != str(os.getpid()):
+        return None
+    try:
+        watchdog_usec = int(os.environ.get("WATCHDOG_USEC", ""))
+    except ValueError:
+        return None
+    if watchdog_usec <= 0:
+        return None
+    return watchdog_usec / 1000000 / 2
+
+
+class Heartbeat(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phase = "starting"
+        self.deadline_monotonic = None
+        self.overrun_reported = False
+        self.notify = None
+        self.log = None
+        self.interval_seconds = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, notify, log, interval_seconds=None):
+        """
+        notify: function sending a sd_notify message, for example
+        SDNOTIFY_OBJECT.notify. log: function logging an error message.
+        Returns False if the watchdog is not enabled.
+        """
+        if interval_seconds is None:
+            interval_seconds = watchdog_interval_seconds()
+        if interval_seconds is None:
+            return False
+        self.notify = notify
+        self.log = log
+        self.interval_seconds = interval_seconds
+        self.thread = threading.Thread(
+            target=self.run, name="sdwdate-heartbeat", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+
+    def enter(self, phase, deadline_seconds=DEFAULT_DEADLINE_SECONDS):
+        """
+        Progress. The phase must end, or enter be called again, within
+        deadline_seconds.
+        """
+        with self.lock:
+            self.phase = phase
+            self.deadline_monotonic = time.monotonic() + deadline_seconds
+            self.overrun_reported = False
+        self.ping()
+
+    def overrun_seconds(self):
+        """
+        Seconds the current phase is past its deadline, 0 if within.
+        """
+        with self.lock:
+            if self.deadline_monotonic is None:
+                return 0
+            return max(time.monotonic() - self.deadline_monotonic, 0)
+
+    def ping(self):
+        if self.notify is None:
+            return False
+        overrun = self.overrun_seconds()
+        if overrun > 0:
+            with self.lock:
+                report = not self.overrun_reported
+                self.overrun_reported = True
+                phase = self.phase
+            if report:
+                self.log(
+                    "Watchdog: phase '" + phase + "' overran its deadline by "
+                    + str(round(overrun)) + " seconds. Stopped sending "
+                    + "WATCHDOG=1, systemd will restart sdwdate.")
+            return False
+        self.notify("WATCHDOG=1")
+        return True
+
+    def run(self):
+        while not self.stop_event.wait(self.interval_seconds):
+            self.ping()
+
+
+HEARTBEAT = Heartbeat()
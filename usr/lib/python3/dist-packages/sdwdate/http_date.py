@@ -0,0 +1,168 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Strict parsers for the two time formats sdwdate reads, returning integer
+# unix time. Used instead of dateutil.parser.parse(...).strftime('%s'),
+# which guesses the format, depends on the TZ environment variable and is
+# slow to import.
+#
+# HTTP Date header, RFC 7231 section 7.1.1.1 IMF-fixdate only:
+# Sun, 06 Nov 1994 08:49:37 GMT
+# The obsolete RFC 850 and asctime formats are rejected.
+#
+# Tor consensus/valid-after and consensus/valid-until, always UTC:
+# 2021-01-26 05:00:00
+#
+# Anything else raises DateParseError, a ValueError.
+#
+# Benchmark and cross-check: /usr/share/sdwdate/http-date-benchmark
+
+import sys
+sys.dont_write_bytecode = True
+
+
+DAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+MONTH_NAMES = (
+    "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec",
+)
+
+MONTH_NUMBERS = {name: number + 1 for number, name in enumerate(MONTH_NAMES)}
+
+IMF_FIXDATE_LENGTH = len("Sun, 06 Nov 1994 08:49:37 GMT")
+
+CONSENSUS_TIME_LENGTH = len("2021-01-26 05:00:00")
+
+DIGITS = frozenset("0123456789")
+
+
+class DateParseError(ValueError):
+    pass
+
+
+def is_leap_year(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def days_in_month(year, month):
+    if month == 2:
+        return 29 if is_leap_year(year) else 28
+    if month in (4, 6, 9, 11):
+        return 30
+    return 31
+
+
+def days_from_civil(year, month, day):
+    """
+    Days since 1970-01-01 of a proleptic Gregorian date.
+    """
+    # Howard Hinnant, chrono-Compatible Low-Level Date Algorithms.
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (9 if month <= 2 else -3)) + 2) // 5 + \
+        day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - \
+        year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def number(value, start, end, name, minimum, maximum):
+    field = value[start:end]
+    if not DIGITS.issuperset(field):
+        raise DateParseError(
+            name + " not numeric: " + repr(field) + " in " + repr(value))
+    result = int(field)
+    if result < minimum or result > maximum:
+        raise DateParseError(
+            name + " out of range: " + field + " in " + repr(value))
+    return result
+
+
+def separator(value, position, expected):
+    if value[position] != expected:
+        raise DateParseError(
+            "expected " + repr(expected) + " at position " + str(position) +
+            " in " + repr(value))
+
+
+def to_unixtime(value, year, month, day, hour, minute, second):
+    if day > days_in_month(year, month):
+        raise DateParseError("day out of range: " + repr(value))
+    days = days_from_civil(year, month, day)
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+
+def check_length(value, length, description):
+    if not isinstance(value, str):
+        raise DateParseError(
+            description + " not a string: " + repr(value))
+    if len(value) != length:
+        raise DateParseError(
+            description + " length " + str(len(value)) + ", expected " +
+            str(length) + ": " + repr(value))
+
+
+def parse_imf_fixdate(value):
+    """
+    Returns the unix time of an IMF-fixdate string, for example
+    'Sun, 06 Nov 1994 08:49:37 GMT'. The day name must match the date.
+    Second 60 (leap second) is accepted as RFC 7231 allows.
+    """
+    check_length(value, IMF_FIXDATE_LENGTH, "IMF-fixdate")
+    #  0         1         2
+    #  01234567890123456789012345678
+    #  Sun, 06 Nov 1994 08:49:37 GMT
+    day_name = value[0:3]
+    if day_name not in DAY_NAMES:
+        raise DateParseError("invalid day name: " + repr(value))
+    separator(value, 3, ",")
+    separator(value, 4, " ")
+    day = number(value, 5, 7, "day", 1, 31)
+    separator(value, 7, " ")
+    month = MONTH_NUMBERS.get(value[8:11])
+    if month is None:
+        raise DateParseError("invalid month name: " + repr(value))
+    separator(value, 11, " ")
+    year = number(value, 12, 16, "year", 1970, 9999)
+    separator(value, 16, " ")
+    hour = number(value, 17, 19, "hour", 0, 23)
+    separator(value, 19, ":")
+    minute = number(value, 20, 22, "minute", 0, 59)
+    separator(value, 22, ":")
+    second = number(value, 23, 25, "second", 0, 60)
+    if value[25:] != " GMT":
+        raise DateParseError("time zone not ' GMT': " + repr(value))
+
+    unixtime = to_unixtime(value, year, month, day, hour, minute, second)
+    # 1970-01-01 was a Thursday.
+    if DAY_NAMES[(unixtime // 86400 + 3) % 7] != day_name:
+        raise DateParseError("day name does not match date: " + repr(value))
+    return unixtime
+
+
+def parse_consensus_time(value):
+    """
+    Returns the unix time of a Tor consensus time string, for example
+    '2021-01-26 05:00:00', which is UTC.
+    """
+    check_length(value, CONSENSUS_TIME_LENGTH, "consensus time")
+    #  0         1
+    #  0123456789012345678
+    #  2021-01-26 05:00:00
+    year = number(value, 0, 4, "year", 1970, 9999)
+    separator(value, 4, "-")
+    month = number(value, 5, 7, "month", 1, 12)
+    separator(value, 7, "-")
+    day = number(value, 8, 10, "day", 1, 31)
+    separator(value, 10, " ")
+    hour = number(value, 11, 13, "hour", 0, 23)
+    separator(value, 13, ":")
+    minute = number(value, 14, 16, "minute", 0, 59)
+    separator(value, 16, ":")
+    second = number(value, 17, 19, "second", 0, 60)
+    return to_unixtime(value, year, month, day, hour, minute, second)
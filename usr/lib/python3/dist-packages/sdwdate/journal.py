@@ -0,0 +1,136 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Structured logging to journald using its native protocol.
+# https://systemd.io/JOURNAL_NATIVE_PROTOCOL/
+#
+# Records:
+# SDWDATE_RECORD=source : one per time source result.
+# SDWDATE_RECORD=round  : one per round.
+#
+# Examples:
+# journalctl SDWDATE_RECORD=round -o verbose
+# journalctl SDWDATE_RECORD=source SDWDATE_STATUS=timeout
+# journalctl SDWDATE_RECORD=source SDWDATE_POOL=1 -o json
+
+import sys
+sys.dont_write_bytecode = True
+
+import socket
+import struct
+import logging
+import threading
+
+
+JOURNAL_SOCKET_PATH = "/run/systemd/journal/socket"
+
+SYSLOG_IDENTIFIER = "sdwdate"
+
+# syslog priorities.
+LOGGING_LEVEL_TO_PRIORITY = {
+    logging.CRITICAL: 2,
+    logging.ERROR: 3,
+    logging.WARNING: 4,
+    logging.INFO: 6,
+    logging.DEBUG: 7,
+}
+
+
+def encode_field(name, value):
+    name = name.encode("ascii")
+    value = str(value).encode("utf-8")
+    if b"\n" in value:
+        return name + b"\n" + struct.pack("<Q", len(value)) + value + b"\n"
+    return name + b"=" + value + b"\n"
+
+
+class JournalSender(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.socket = None
+        self.enabled = False
+        # Added to every entry. For example SDWDATE_ROUND.
+        self.context = {}
+
+    def set_context(self, **fields):
+        with self.lock:
+            self.context.update(fields)
+
+    def send(self, message, priority=6, **fields):
+        data = encode_field("MESSAGE", message)
+        data += encode_field("PRIORITY", priority)
+        data += encode_field("SYSLOG_IDENTIFIER", SYSLOG_IDENTIFIER)
+        with self.lock:
+            items = list(self.context.items()) + list(fields.items())
+            for name, value in items:
+                if value is None:
+                    continue
+                data += encode_field(name, value)
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.sendto(data, JOURNAL_SOCKET_PATH)
+
+
+JOURNAL = JournalSender()
+
+
+class JournalHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            priority = LOGGING_LEVEL_TO_PRIORITY.get(record.levelno, 6)
+            JOURNAL.send(
+                self.format(record),
+                priority,
+                CODE_FUNC=record.funcName,
+                CODE_LINE=record.lineno,
+            )
+        except BaseException:
+            self.handleError(record)
+
+
+def send_source_record(
+        pool, url, status, took_time, time_diff_raw, time_diff_lag_cleaned):
+    if not JOURNAL.enabled:
+        return
+    message = (
+        "source: pool " + str(pool) + " " + url + " status: " + str(status) +
+        " took_time: " + str(took_time) + " time_diff_raw: " +
+        str(time_diff_raw)
+    )
+    try:
+        JOURNAL.send(
+            message,
+            SDWDATE_RECORD="source",
+            SDWDATE_POOL=pool,
+            SDWDATE_URL=url,
+            SDWDATE_STATUS=status,
+            SDWDATE_TOOK_MS=int(round(float(took_time) * 1000)),
+            SDWDATE_OFFSET=time_diff_raw,
+            SDWDATE_OFFSET_LAG_CLEANED=time_diff_lag_cleaned,
+        )
+    except OSError:
+        pass
+
+
+def send_round_record(
+        status, fetch_iterations, median_offset, new_diff, error_bound):
+    if not JOURNAL.enabled:
+        return
+    message = (
+        "round: status: " + str(status) + " fetch_iterations: " +
+        str(fetch_iterations) + " median_offset: " + str(median_offset)
+    )
+    try:
+        JOURNAL.send(
+            message,
+            SDWDATE_RECORD="round",
+            SDWDATE_STATUS=status,
+            SDWDATE_FETCH_ITERATIONS=fetch_iterations,
+            SDWDATE_OFFSET=median_offset,
+            SDWDATE_NEW_DIFF=new_diff,
+            SDWDATE_ERROR_BOUND=error_bound,
+        )
+    except OSError:
+        pass
@@ -0,0 +1,371 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Reads the structured journal entries written by sdwdate when
+# JOURNAL_STRUCTURED=true (see journal.py).
+#
+# Filtering is done by journalctl using field matches, which are looked up in
+# the journal field index, instead of scanning the text of every line. Output
+# of journalctl is streamed and only the summaries are kept in memory.
+#
+# Views:
+# rounds   : one line per round (default)
+# sources  : one line per time source result
+# latency  : latency table per time source
+# streaks  : failure streaks per time source
+# timeline : offset timeline per round
+#
+# Examples:
+# sdwdate-log-query
+# sdwdate-log-query latency --since "-7 days"
+# sdwdate-log-query sources --status timeout --pool 1
+# sdwdate-log-query rounds --cursor-file ~/.cache/sdwdate-log-query.cursor
+# sdwdate-log-query sources --follow
+
+import sys
+sys.dont_write_bytecode = True
+
+import json
+import time
+import argparse
+import subprocess
+
+
+VIEWS = ("rounds", "sources", "latency", "streaks", "timeline")
+
+# Only entries written by the sdwdate service. Trusted field, cannot be set by
+# other processes.
+JOURNAL_UNIT_MATCH = "_SYSTEMD_UNIT=sdwdate.service"
+
+OK_STATUS = "ok"
+
+TIMELINE_BAR_WIDTH = 30
+
+
+def build_journalctl_command(view, args):
+    command = ["journalctl", "--output=json", "--no-pager", "--quiet"]
+    if args.boot == "":
+        command.append("--boot")
+    elif args.boot is not None:
+        command.append("--boot=" + args.boot)
+    if args.since:
+        command.append("--since=" + args.since)
+    if args.until:
+        command.append("--until=" + args.until)
+    if args.lines:
+        command.append("--lines=" + str(args.lines))
+    if args.cursor_file:
+        command.append("--cursor-file=" + args.cursor_file)
+    if args.follow:
+        command.append("--follow")
+
+    command.append(JOURNAL_UNIT_MATCH)
+    if view == "timeline":
+        command.append("SDWDATE_RECORD=round")
+    elif view == "rounds":
+        # Source records are needed to count sources per round. Pool, source
+        # and status filters are applied to those below.
+        command.append("SDWDATE_RECORD=round")
+        command.append("SDWDATE_RECORD=source")
+    else:
+        command.append("SDWDATE_RECORD=source")
+        if args.pool is not None:
+            command.append("SDWDATE_POOL=" + args.pool)
+        if args.source:
+            command.append("SDWDATE_URL=" + args.source)
+        if args.status:
+            command.append("SDWDATE_STATUS=" + args.status)
+    return command
+
+
+def field(entry, name, default=""):
+    value = entry.get(name, default)
+    # journalctl prints binary fields as a list of bytes and fields that
+    # appear more than once as a list of strings.
+    if isinstance(value, list):
+        if value and isinstance(value[0], int):
+            return bytes(value).decode("utf-8", "replace")
+        return value[-1] if value else default
+    if value is None:
+        return default
+    return value
+
+
+def float_field(entry, name):
+    try:
+        return float(field(entry, name))
+    except ValueError:
+        return None
+
+
+def time_string(entry):
+    try:
+        microseconds = int(field(entry, "__REALTIME_TIMESTAMP"))
+    except ValueError:
+        return "?"
+    return time.strftime(
+        "%Y-%m-%d %H:%M:%S", time.localtime(microseconds / 1000000))
+
+
+def round_key(entry):
+    # The round counter starts over if sdwdate is restarted.
+    return (
+        field(entry, "_BOOT_ID"),
+        field(entry, "_PID"),
+        field(entry, "SDWDATE_ROUND"),
+    )
+
+
+def source_matches(entry, args):
+    if args.pool is not None and field(entry, "SDWDATE_POOL") != args.pool:
+        return False
+    if args.source and field(entry, "SDWDATE_URL") != args.source:
+        return False
+    if args.status and field(entry, "SDWDATE_STATUS") != args.status:
+        return False
+    return True
+
+
+def read_entries(command):
+    """
+    Generator yielding decoded journal entries.
+    """
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        for line in process.stdout:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest rank.
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def format_ms(value):
+    if value is None:
+        return "-"
+    return str(int(value))
+
+
+class RoundsView(object):
+    def __init__(self, args):
+        self.args = args
+        self.sources = {}
+
+    def add(self, entry):
+        key = round_key(entry)
+        if field(entry, "SDWDATE_RECORD") == "source":
+            if not source_matches(entry, self.args):
+                return
+            counts = self.sources.setdefault(key, [0, 0])
+            counts[1] += 1
+            if field(entry, "SDWDATE_STATUS") == OK_STATUS:
+                counts[0] += 1
+            return
+        ok_count, total_count = self.sources.pop(key, [0, 0])
+        if self.args.pool is not None or self.args.source or self.args.status:
+            if total_count == 0:
+                return
+        print(
+            time_string(entry)
+            + " round: " + field(entry, "SDWDATE_ROUND")
+            + " status: " + field(entry, "SDWDATE_STATUS")
+            + " fetch_iterations: " + field(entry, "SDWDATE_FETCH_ITERATIONS")
+            + " sources_ok: " + str(ok_count) + "/" + str(total_count)
+            + " offset: " + field(entry, "SDWDATE_OFFSET")
+            + " error_bound: " + field(entry, "SDWDATE_ERROR_BOUND"),
+            flush=True
+        )
+
+    def finish(self):
+        pass
+
+
+class SourcesView(object):
+    def __init__(self, args):
+        self.args = args
+
+    def add(self, entry):
+        print(
+            time_string(entry)
+            + " round: " + field(entry, "SDWDATE_ROUND")
+            + " pool: " + field(entry, "SDWDATE_POOL")
+            + " status: " + field(entry, "SDWDATE_STATUS")
+            + " took_ms: " + field(entry, "SDWDATE_TOOK_MS")
+            + " offset: " + field(entry, "SDWDATE_OFFSET")
+            + " url: " + field(entry, "SDWDATE_URL"),
+            flush=True
+        )
+
+    def finish(self):
+        pass
+
+
+class LatencyView(object):
+    def __init__(self, args):
+        self.args = args
+        # url -> [pool, ok, failed, took_ms list of ok requests]
+        self.sources = {}
+
+    def add(self, entry):
+        url = field(entry, "SDWDATE_URL")
+        item = self.sources.setdefault(
+            url, [field(entry, "SDWDATE_POOL"), 0, 0, []])
+        if field(entry, "SDWDATE_STATUS") == OK_STATUS:
+            item[1] += 1
+            took_ms = float_field(entry, "SDWDATE_TOOK_MS")
+            if took_ms is not None:
+                item[3].append(took_ms)
+        else:
+            item[2] += 1
+
+    def finish(self):
+        rows = []
+        for url, (pool, ok_count, failed_count, took_ms) in self.sources.items():
+            took_ms.sort()
+            rows.append((
+                pool, url, ok_count, failed_count,
+                percentile(took_ms, 0.5),
+                percentile(took_ms, 0.95),
+                took_ms[-1] if took_ms else None,
+            ))
+        # Slowest first.
+        rows.sort(key=lambda row: (row[4] is None, -(row[4] or 0)))
+        print("%-4s %6s %6s %8s %8s %8s  %s" % (
+            "pool", "ok", "failed", "p50_ms", "p95_ms", "max_ms", "url"))
+        for pool, url, ok_count, failed_count, p50, p95, maximum in rows:
+            print("%-4s %6d %6d %8s %8s %8s  %s" % (
+                pool, ok_count, failed_count,
+                format_ms(p50), format_ms(p95), format_ms(maximum), url))
+
+
+class StreaksView(object):
+    def __init__(self, args):
+        self.args = args
+        # url -> [pool, current streak, longest streak, last failure time,
+        #         last status]
+        self.sources = {}
+
+    def add(self, entry):
+        url = field(entry, "SDWDATE_URL")
+        item = self.sources.setdefault(
+            url, [field(entry, "SDWDATE_POOL"), 0, 0, "-", ""])
+        status = field(entry, "SDWDATE_STATUS")
+        item[4] = status
+        if status == OK_STATUS:
+            item[1] = 0
+            return
+        item[1] += 1
+        item[2] = max(item[2], item[1])
+        item[3] = time_string(entry)
+
+    def finish(self):
+        rows = [
+            (pool, url, current, longest, last_failure, last_status)
+            for url, (pool, current, longest, last_failure, last_status)
+            in self.sources.items()
+            if longest > 0
+        ]
+        rows.sort(key=lambda row: (-row[2], -row[3]))
+        print("%-4s %7s %7s %-19s %-8s  %s" % (
+            "pool", "current", "longest", "last_failure", "last", "url"))
+        for pool, url, current, longest, last_failure, last_status in rows:
+            print("%-4s %7d %7d %-19s %-8s  %s" % (
+                pool, current, longest, last_failure, last_status, url))
+
+
+class TimelineView(object):
+    def __init__(self, args):
+        self.args = args
+
+    def add(self, entry):
+        offset = float_field(entry, "SDWDATE_OFFSET")
+        if offset is None:
+            offset = 0.0
+        # Logarithmic scale. Offsets range from below one second to days.
+        bar_length = 0
+        magnitude = abs(offset)
+        while magnitude >= 1 and bar_length < TIMELINE_BAR_WIDTH:
+            bar_length += 1
+            magnitude = magnitude / 2
+        bar_character = "+" if offset >= 0 else "-"
+        print(
+            "%s round: %-5s %-7s offset: %10s error_bound: %6s |%s" % (
+                time_string(entry),
+                field(entry, "SDWDATE_ROUND"),
+                field(entry, "SDWDATE_STATUS"),
+                field(entry, "SDWDATE_OFFSET"),
+                field(entry, "SDWDATE_ERROR_BOUND"),
+                bar_character * bar_length,
+            ),
+            flush=True
+        )
+
+    def finish(self):
+        pass
+
+
+VIEW_CLASSES = {
+    "rounds": RoundsView,
+    "sources": SourcesView,
+    "latency": LatencyView,
+    "streaks": StreaksView,
+    "timeline": TimelineView,
+}
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog="sdwdate-log-query",
+        description="Query structured sdwdate journal entries. "
+        "Requires JOURNAL_STRUCTURED=true in /etc/sdwdate.d/*.conf."
+    )
+    parser.add_argument("view", nargs="?", default="rounds", choices=VIEWS)
+    parser.add_argument("--pool", help="pool number, for example 0")
+    parser.add_argument("--source", help="time source url")
+    parser.add_argument(
+        "--status", help="ok, timeout, error or done (rejected)")
+    parser.add_argument("--since", help="see journalctl --since")
+    parser.add_argument("--until", help="see journalctl --until")
+    parser.add_argument(
+        "--boot", nargs="?", const="", default=None,
+        help="only this boot or the given boot, see journalctl --boot")
+    parser.add_argument(
+        "--lines", type=int, default=0,
+        help="only the most recent LINES matching journal entries")
+    parser.add_argument(
+        "--cursor-file",
+        help="continue after the cursor stored in this file and update it")
+    parser.add_argument(
+        "--follow", action="store_true", help="wait for new entries")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    view = VIEW_CLASSES[args.view](args)
+    command = build_journalctl_command(args.view, args)
+    try:
+        for entry in read_entries(command):
+            view.add(entry)
+    except KeyboardInterrupt:
+        pass
+    view.finish()
+
+
+if __name__ == "__main__":
+    main()
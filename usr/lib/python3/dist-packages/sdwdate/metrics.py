@@ -0,0 +1,189 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Metrics textfile exporter.
+# Text exposition format as read by the textfile collector of
+# prometheus-node-exporter. The file is replaced atomically so the collector
+# never reads a partially written file.
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import threading
+
+
+# Seconds. Requests time out after 120 seconds.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120)
+
+# check_remote status -> label value.
+# "done" means a time was fetched but rejected by a time sanity check.
+# "fallback": time distribution client, no valid time from the server,
+# falling back to fetching over Tor.
+STATUS_LABELS = {
+    "ok": "ok",
+    "timeout": "timeout",
+    "error": "error",
+    "done": "rejected",
+    "fallback": "fallback",
+}
+
+
+def escape_label_value(value):
+    value = str(value)
+    value = value.replace("\\", "\\\\")
+    value = value.replace("\n", "\\n")
+    value = value.replace('"', '\\"')
+    return value
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    items = [
+        name + '="' + escape_label_value(value) + '"'
+        for name, value in labels
+    ]
+    return "{" + ",".join(items) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels, lines):
+        for bound, bucket_count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            lines.append(
+                name + "_bucket" +
+                format_labels(labels + (("le", str(bound)),)) +
+                " " + str(bucket_count))
+        lines.append(
+            name + "_bucket" + format_labels(labels + (("le", "+Inf"),)) +
+            " " + str(self.count))
+        lines.append(
+            name + "_sum" + format_labels(labels) + " " +
+            format_value(round(self.sum, 3)))
+        lines.append(
+            name + "_count" + format_labels(labels) + " " + str(self.count))
+
+
+class MetricsRegistry(object):
+    """
+    Process wide. Counters and histograms accumulate over all rounds since
+    sdwdate was started.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # write is called by the main thread and by the thread waiting for
+        # sclockadj. Both use the same temporary file.
+        self.write_lock = threading.Lock()
+        self.pool_latency = {}
+        self.source_latency = {}
+        self.requests = {}
+        self.rounds = {}
+        self.fetch_iterations_total = 0
+        self.gauges = {}
+
+    def observe_request(self, pool, url, status, took_time):
+        status_label = STATUS_LABELS.get(status, status)
+        # Pool numbers and "time_distribution". Sorted when rendering.
+        pool = str(pool)
+        with self.lock:
+            key = (("pool", pool),)
+            self.pool_latency.setdefault(key, Histogram()).observe(took_time)
+            key = (("pool", pool), ("url", url))
+            self.source_latency.setdefault(key, Histogram()).observe(took_time)
+            key = (("pool", pool), ("status", status_label))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def observe_round(self, result, fetch_iterations):
+        with self.lock:
+            key = (("result", result),)
+            self.rounds[key] = self.rounds.get(key, 0) + 1
+            self.fetch_iterations_total += fetch_iterations
+            self.gauges["fetch_iterations_last_round"] = fetch_iterations
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            name = "sdwdate_pool_request_duration_seconds"
+            lines.append("# HELP " + name + " Duration of url_to_unixtime requests per pool.")
+            lines.append("# TYPE " + name + " histogram")
+            for labels, histogram in sorted(self.pool_latency.items()):
+                histogram.render(name, labels, lines)
+
+            name = "sdwdate_source_request_duration_seconds"
+            lines.append("# HELP " + name + " Duration of url_to_unixtime requests per time source.")
+            lines.append("# TYPE " + name + " histogram")
+            for labels, histogram in sorted(self.source_latency.items()):
+                histogram.render(name, labels, lines)
+
+            name = "sdwdate_requests_total"
+            lines.append("# HELP " + name + " Requests per pool and status (ok, timeout, error, rejected, fallback).")
+            lines.append("# TYPE " + name + " counter")
+            for labels, value in sorted(self.requests.items()):
+                lines.append(name + format_labels(labels) + " " + str(value))
+
+            name = "sdwdate_rounds_total"
+            lines.append("# HELP " + name + " Rounds per result (success, error).")
+            lines.append("# TYPE " + name + " counter")
+            for labels, value in sorted(self.rounds.items()):
+                lines.append(name + format_labels(labels) + " " + str(value))
+
+            name = "sdwdate_fetch_iterations_total"
+            lines.append("# HELP " + name + " Fetch loop iterations of all rounds.")
+            lines.append("# TYPE " + name + " counter")
+            lines.append(name + " " + str(self.fetch_iterations_total))
+
+            for gauge_name, value in sorted(self.gauges.items()):
+                name = "sdwdate_" + gauge_name
+                lines.append("# TYPE " + name + " gauge")
+                if isinstance(value, dict):
+                    for labels, item in sorted(value.items()):
+                        lines.append(
+                            name + format_labels(labels) + " " +
+                            format_value(item))
+                else:
+                    lines.append(name + " " + format_value(value))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        temp_path = path + ".tmp." + str(os.getpid())
+        with self.write_lock:
+            with open(temp_path, "w") as file_object:
+                file_object.write(self.render())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+
+
+if __name__ == "__main__":
+    registry = MetricsRegistry()
+    registry.observe_request(0, "http://example.onion", "ok", 3.2)
+    registry.observe_request(0, "http://example.onion", "timeout", 120.0)
+    registry.observe_request(
+        "time_distribution", "timedist://10.152.152.10:9199", "fallback", 0.1)
+    registry.observe_round("success", 2)
+    registry.set_gauge("median_offset_seconds", -1.0)
+    print(registry.render(), end="")
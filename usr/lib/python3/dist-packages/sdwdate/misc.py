@@ -14,3 +14,31 @@ def strip_html(message):
     tmp_message = re.sub("<br>", "\n", message)
     # Strip remaining HTML.
     return re.sub("<[^<]+?>", "", tmp_message)
+
+
+def median(values):
+    """
+    Middle value, for an even number of values the mean of the two middle
+    values. values must not be empty.
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def offsets_agree(offsets, error_bounds):
+    """
+    Whether all offsets lie within their error bounds of each other, meaning
+    the intervals offset +/- error_bound have a common point.
+    """
+    if not offsets:
+        return False
+    lowest_upper = min(
+        offset + error_bound
+        for offset, error_bound in zip(offsets, error_bounds))
+    highest_lower = max(
+        offset - error_bound
+        for offset, error_bound in zip(offsets, error_bounds))
+    return highest_lower <= lowest_upper
@@ -0,0 +1,237 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# NTP shared memory (SHM) reference clock output.
+# Same segment layout as ntpd's and chrony's refclock SHM driver.
+#
+# The segment is created by sdwdate, owned by user sdwdate, mode 0600, so no
+# other user can feed the NTP daemon a time. chronyd and ntpd attach to it
+# while still running as root, which is allowed regardless of the mode.
+# Therefore sdwdate must start first, see the systemd drop-in in
+# /etc/sdwdate.d/30_default.conf. If the NTP daemon created the segment
+# first, it is owned by root and shmget fails with errno 13 (EACCES). Then
+# remove the segment (ipcrm -M 0x4e545032 for unit 2), restart sdwdate,
+# then the NTP daemon.
+#
+# Example chrony configuration (unit 2):
+# refclock SHM 2:perm=0600 refid SDWD precision 1 poll 4 filter 1
+#
+# One measurement per round, but the NTP daemon polls every few seconds and
+# considers the source unreachable without new samples. ShmRefresher
+# therefore writes the sample of the last round again every
+# REFRESH_INTERVAL_SECONDS until the next round: receive time now,
+# reference time the time measured by the round plus the time elapsed since
+# (CLOCK_BOOTTIME). The reference time stays correct while the NTP daemon
+# corrects the clock. It drifts with the local oscillator, some 0.2 seconds
+# per hour at 50 ppm, well within the error bound of a round.
+#
+# Example:
+# sudo -u sdwdate python3 /usr/lib/python3/dist-packages/sdwdate/ntp_shm.py 2 1.5 1.2
+
+import sys
+sys.dont_write_bytecode = True
+
+import time
+import math
+import ctypes
+import threading
+
+from sdwdate.boot_timeline import boottime_seconds
+
+
+# "NTP0". Unit N uses key NTPD_BASE + N.
+NTPD_BASE = 0x4e545030
+
+IPC_CREAT = 0o1000
+
+# Never world writable, not even units 2 and above. See above.
+SHM_PERMISSIONS = 0o600
+
+EACCES = 13
+
+LEAP_NOWARNING = 0
+
+# Seconds. chrony 'poll 4'.
+REFRESH_INTERVAL_SECONDS = 16
+
+
+class ShmTime(ctypes.Structure):
+    _fields_ = [
+        ("mode", ctypes.c_int),
+        ("count", ctypes.c_int),
+        ("clockTimeStampSec", ctypes.c_long),
+        ("clockTimeStampUSec", ctypes.c_int),
+        ("receiveTimeStampSec", ctypes.c_long),
+        ("receiveTimeStampUSec", ctypes.c_int),
+        ("leap", ctypes.c_int),
+        ("precision", ctypes.c_int),
+        ("nsamples", ctypes.c_int),
+        ("valid", ctypes.c_int),
+        ("clockTimeStampNSec", ctypes.c_uint),
+        ("receiveTimeStampNSec", ctypes.c_uint),
+        ("dummy", ctypes.c_int * 8),
+    ]
+
+
+class NtpShmError(Exception):
+    pass
+
+
+class NtpShm(object):
+    def __init__(self, unit):
+        self.unit = int(unit)
+        self.segment = None
+        self.address = None
+        self.libc = None
+
+    def attach(self):
+        if self.segment is not None:
+            return
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.shmget.restype = ctypes.c_int
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.restype = ctypes.c_int
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+
+        shm_id = libc.shmget(
+            NTPD_BASE + self.unit,
+            ctypes.sizeof(ShmTime),
+            IPC_CREAT | SHM_PERMISSIONS
+        )
+        if shm_id == -1:
+            errno = ctypes.get_errno()
+            message = "shmget unit " + str(self.unit) + " failed. errno: " + \
+                str(errno)
+            if errno == EACCES:
+                message += " Segment created by another user, probably " + \
+                    "the NTP daemon. sdwdate must create it, start sdwdate " + \
+                    "before the NTP daemon."
+            raise NtpShmError(message)
+
+        address = libc.shmat(shm_id, None, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            raise NtpShmError(
+                "shmat unit " + str(self.unit) + " failed. errno: " +
+                str(ctypes.get_errno()))
+
+        self.libc = libc
+        self.address = address
+        self.segment = ShmTime.from_address(address)
+
+    def detach(self):
+        if self.segment is None:
+            return
+        self.segment = None
+        self.libc.shmdt(self.address)
+        self.address = None
+
+    def write_sample(self, offset_seconds, error_bound_seconds, nsamples):
+        """
+        Publish one measurement. The reference time is the local time of
+        the measurement plus the offset measured by sdwdate.
+        """
+        self.attach()
+
+        receive_ns = time.time_ns()
+        clock_ns = receive_ns + int(offset_seconds * 1000000000)
+
+        # Precision is log2 seconds. For example error bound 1.5 -> 1 (2s).
+        precision = math.ceil(math.log2(max(error_bound_seconds, 2 ** -20)))
+
+        shm = self.segment
+        # Mode 1: Readers only use the sample if count did not change while
+        # reading it.
+        shm.mode = 1
+        shm.valid = 0
+        shm.count += 1
+
+        shm.clockTimeStampSec = clock_ns // 1000000000
+        shm.clockTimeStampNSec = clock_ns % 1000000000
+        shm.clockTimeStampUSec = shm.clockTimeStampNSec // 1000
+        shm.receiveTimeStampSec = receive_ns // 1000000000
+        shm.receiveTimeStampNSec = receive_ns % 1000000000
+        shm.receiveTimeStampUSec = shm.receiveTimeStampNSec // 1000
+        shm.leap = LEAP_NOWARNING
+        shm.precision = precision
+        shm.nsamples = nsamples
+
+        shm.count += 1
+        shm.valid = 1
+
+        return precision
+
+
+class ShmRefresher(object):
+    """
+    Writes the measurement of one round to ntp_shm every
+    REFRESH_INTERVAL_SECONDS, until stopped.
+    offset_seconds: median offset of the round, measured just now.
+    on_disciplined: called once from the thread, as soon as the clock is
+    within error_bound_seconds of the measured time.
+    """
+    def __init__(self, ntp_shm, offset_seconds, error_bound_seconds,
+                 nsamples, on_disciplined=None):
+        self.ntp_shm = ntp_shm
+        self.reference_unixtime = time.time() + offset_seconds
+        self.reference_boottime = boottime_seconds()
+        self.error_bound_seconds = error_bound_seconds
+        self.nsamples = nsamples
+        self.on_disciplined = on_disciplined
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="sdwdate-ntp-shm", daemon=True)
+
+    def offset(self):
+        """
+        Seconds the clock is behind the time measured by the round, now.
+        """
+        elapsed = boottime_seconds() - self.reference_boottime
+        return self.reference_unixtime + elapsed - time.time()
+
+    def disciplined(self):
+        return abs(self.offset()) <= self.error_bound_seconds
+
+    def refresh(self):
+        """
+        Returns the precision written.
+        """
+        precision = self.ntp_shm.write_sample(
+            self.offset(), self.error_bound_seconds, self.nsamples)
+        if self.on_disciplined is not None and self.disciplined():
+            on_disciplined = self.on_disciplined
+            self.on_disciplined = None
+            on_disciplined()
+        return precision
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive() and \
+                self.thread is not threading.current_thread():
+            self.thread.join(5)
+
+    def run(self):
+        while not self.stop_event.wait(REFRESH_INTERVAL_SECONDS):
+            try:
+                self.refresh()
+            except BaseException:
+                error_message = str(sys.exc_info()[0]) + " " + \
+                    str(sys.exc_info()[1])
+                print("ntp_shm.py: refresh error: " + error_message)
+
+
+if __name__ == "__main__":
+    unit = int(sys.argv[1])
+    offset_seconds = float(sys.argv[2])
+    error_bound_seconds = float(sys.argv[3])
+    ntp_shm = NtpShm(unit)
+    precision = ntp_shm.write_sample(offset_seconds, error_bound_seconds, 1)
+    print("unit: " + str(unit) + " precision: " + str(precision))
+    ntp_shm.detach()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Opt-in profiling of sdwdate rounds using cProfile and/or tracemalloc.
+#
+# Enable using /etc/sdwdate.d/*.conf:
+# PROFILE_ROUNDS=1
+# PROFILE_MODE=cprofile,tracemalloc
+# or using environment variables SDWDATE_PROFILE_ROUNDS and SDWDATE_PROFILE_MODE.
+#
+# Output in /run/sdwdate/profile/:
+# round-<unixtime>-<round>.pstats     (cProfile)
+# round-<unixtime>-<round>.tracemalloc (tracemalloc snapshot)
+#
+# Analyze:
+# python3 -c 'import pstats; pstats.Stats("round-...pstats").sort_stats("cumulative").print_stats(30)'
+# python3 /usr/lib/python3/dist-packages/sdwdate/profiling.py round-...tracemalloc
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import time
+from pathlib import Path
+
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+TRACEMALLOC_FRAMES = 10
+
+
+class RoundProfiler(object):
+    def __init__(self):
+        self.rounds_remaining = 0
+        self.modes = ()
+        self.last_requested = None
+        self.profile = None
+        self.tracemalloc_started = False
+
+    def configure(self, rounds, modes):
+        """
+        Profile the next 'rounds' rounds. Called every round. Only a changed
+        setting arms the profiler again, otherwise a setting left in the
+        config file would profile every round.
+        """
+        requested = (rounds, modes)
+        if requested == self.last_requested:
+            return
+        self.last_requested = requested
+        self.rounds_remaining = rounds
+        self.modes = tuple(mode for mode in modes if mode in PROFILE_MODES)
+
+    def start(self):
+        if self.rounds_remaining <= 0 or not self.modes:
+            return False
+        if "tracemalloc" in self.modes:
+            import tracemalloc
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.tracemalloc_started = True
+        if "cprofile" in self.modes:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return True
+
+    def stop(self, profile_folder, round_number):
+        """
+        Returns the list of written files. The profilers are stopped even if
+        writing fails, so they do not stay active for the next rounds.
+        """
+        profile = self.profile
+        snapshot = None
+        try:
+            if profile is not None:
+                self.profile = None
+                profile.disable()
+            if self.tracemalloc_started:
+                import tracemalloc
+                self.tracemalloc_started = False
+                try:
+                    snapshot = tracemalloc.take_snapshot()
+                finally:
+                    tracemalloc.stop()
+        finally:
+            self.rounds_remaining -= 1
+
+        written_files = []
+        Path(profile_folder).mkdir(parents=True, exist_ok=True)
+        # systemd-tmpfiles 'Z /run/sdwdate/*' might have removed 'chmod +x'.
+        os.chmod(profile_folder, 0o755)
+        file_name_prefix = (
+            profile_folder + "/round-" + str(int(time.time())) + "-" +
+            str(round_number)
+        )
+
+        if profile is not None:
+            file_name = file_name_prefix + ".pstats"
+            profile.dump_stats(file_name)
+            written_files.append(file_name)
+
+        if snapshot is not None:
+            file_name = file_name_prefix + ".tracemalloc"
+            snapshot.dump(file_name)
+            written_files.append(file_name)
+
+        return written_files
+
+
+def tracemalloc_report(file_name, limit=25):
+    import tracemalloc
+    snapshot = tracemalloc.Snapshot.load(file_name)
+    lines = []
+    for statistic in snapshot.statistics("lineno")[:limit]:
+        lines.append(str(statistic))
+    return lines
+
+
+if __name__ == "__main__":
+    for line in tracemalloc_report(sys.argv[1]):
+        print(line)
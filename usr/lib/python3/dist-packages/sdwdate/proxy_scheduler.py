@@ -0,0 +1,162 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Spreads concurrent requests of get_time_from_servers across several SOCKS
+# endpoints (Tor instances or isolated SocksPorts). Tracks latency and
+# failures per endpoint and routes around dead endpoints.
+
+import sys
+sys.dont_write_bytecode = True
+
+import time
+import socket
+import threading
+
+
+# Local TCP connect to the SOCKS port. Tells apart a dead endpoint from a
+# slow onion.
+PROBE_TIMEOUT_SECONDS = 2
+
+# Dead endpoints are skipped for DEAD_BACKOFF_SECONDS * 2 ^ (failures - 1),
+# at most DEAD_BACKOFF_MAX_SECONDS.
+DEAD_BACKOFF_SECONDS = 30
+DEAD_BACKOFF_MAX_SECONDS = 600
+
+# Weight of the newest sample of the exponentially weighted moving average.
+LATENCY_EWMA_WEIGHT = 0.3
+
+
+class ProxyEndpoint(object):
+    def __init__(self, ip_address, port_number):
+        self.ip_address = ip_address
+        self.port_number = port_number
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.dead_until = 0
+
+    def __str__(self):
+        return self.ip_address + ":" + self.port_number
+
+    def is_dead(self):
+        return time.monotonic() < self.dead_until
+
+
+class ProxyScheduler(object):
+    def __init__(self, proxy_list):
+        self.lock = threading.Lock()
+        self.endpoints = [
+            ProxyEndpoint(ip_address, port_number)
+            for ip_address, port_number in proxy_list
+        ]
+
+    def pick(self, exclude=()):
+        """
+        Least busy, then fastest endpoint which is not known to be dead.
+        If all are dead, the least recently failed one. Returns None if all
+        endpoints are excluded.
+        """
+        with self.lock:
+            candidates = [
+                endpoint for endpoint in self.endpoints
+                if endpoint not in exclude
+            ]
+            if not candidates:
+                return None
+            alive = [
+                endpoint for endpoint in candidates
+                if not endpoint.is_dead()
+            ]
+            if alive:
+                endpoint = min(
+                    alive,
+                    key=lambda item: (
+                        item.in_flight,
+                        item.latency_ewma or 0
+                    )
+                )
+            else:
+                endpoint = min(candidates, key=lambda item: item.dead_until)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.in_flight -= 1
+
+    def mark_dead(self, endpoint):
+        with self.lock:
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            backoff = DEAD_BACKOFF_SECONDS * \
+                2 ** (endpoint.consecutive_failures - 1)
+            backoff = min(backoff, DEAD_BACKOFF_MAX_SECONDS)
+            endpoint.dead_until = time.monotonic() + backoff
+
+    def report(self, endpoint, took_time, success):
+        with self.lock:
+            endpoint.requests += 1
+            if not success:
+                endpoint.failures += 1
+                return
+            endpoint.consecutive_failures = 0
+            endpoint.dead_until = 0
+            if endpoint.latency_ewma is None:
+                endpoint.latency_ewma = took_time
+            else:
+                endpoint.latency_ewma = round(
+                    LATENCY_EWMA_WEIGHT * took_time
+                    + (1 - LATENCY_EWMA_WEIGHT) * endpoint.latency_ewma,
+                    2
+                )
+
+    @staticmethod
+    def probe(endpoint):
+        try:
+            with socket.create_connection(
+                    (endpoint.ip_address, int(endpoint.port_number)),
+                    PROBE_TIMEOUT_SECONDS):
+                return True
+        except OSError:
+            return False
+
+    def acquire(self, exclude=()):
+        """
+        Pick an endpoint that accepts connections. Dead endpoints found by
+        probing are marked dead and the next one is tried.
+        """
+        tried = list(exclude)
+        while True:
+            endpoint = self.pick(exclude=tried)
+            if endpoint is None:
+                return None
+            if self.probe(endpoint):
+                return endpoint
+            self.release(endpoint)
+            self.mark_dead(endpoint)
+            tried.append(endpoint)
+
+    def summary(self):
+        with self.lock:
+            items = []
+            for endpoint in self.endpoints:
+                items.append(
+                    str(endpoint)
+                    + " requests: " + str(endpoint.requests)
+                    + " failures: " + str(endpoint.failures)
+                    + " latency_ewma: " + str(endpoint.latency_ewma)
+                    + " dead: " + str(endpoint.is_dead())
+                )
+            return "; ".join(items)
+
+
+def is_proxy_error(stderr):
+    """
+    url_to_unixtime could not talk to the SOCKS endpoint at all, as opposed
+    to the SOCKS endpoint not reaching the onion.
+    """
+    return "Connection refused" in stderr or "[Errno 111]" in stderr
@@ -41,6 +41,33 @@ def proxy_settings():
     return ip_address, port_number
 
 
+def proxy_list_settings():
+    """ List of (ip_address, port_number) SOCKS endpoints.
+        PROXY_LIST from /etc/sdwdate.d/*.conf, otherwise the single endpoint
+        of proxy_settings().
+    """
+    proxy_list = []
+    if os.path.exists('/etc/sdwdate.d/'):
+        files = sorted(glob.glob('/etc/sdwdate.d/*.conf'))
+        for f in files:
+            with open(f) as conf:
+                lines = conf.readlines()
+            for line in lines:
+                if line.startswith('PROXY_LIST'):
+                    proxy_list = []
+                    items = re.search(r'=(.*)', line).group(1).split()
+                    for item in items:
+                        ip_address, port_number = item.rsplit(':', 1)
+                        proxy_list.append((ip_address, port_number))
+
+    if not proxy_list:
+        proxy_list.append(proxy_settings())
+
+    return proxy_list
+
+
 if __name__ == "__main__":
     ip_address, port_number = proxy_settings()
     print(ip_address + " " + port_number)
+    for ip_address, port_number in proxy_list_settings():
+        print("proxy_list: " + ip_address + " " + port_number)
@@ -15,25 +15,73 @@ import signal
 import shlex
 import time
 import subprocess
+import collections
 from subprocess import Popen, PIPE
 import concurrent.futures
 
 from .config import get_comment
 from .config import read_pools
+from .config import number_of_pools_config
 from .config import time_human_readable
 from .config import time_replay_protection_file_read
 from .timesanitycheck import time_consensus_sanity_check
 from .timesanitycheck import static_time_sanity_check
+from .proxy_scheduler import is_proxy_error
+from .spans import span
+from .spans import add_span
+from .spans import count_child_process
+from .transcript import TRANSCRIPT
 
 
-def run_command(i, url_to_unixtime_command, remote):
-    timeout_seconds = 120
+# Default of run_command.
+URL_TO_UNIXTIME_TIMEOUT_SECONDS = 120
 
+# Result of check_remote for one time source.
+# index: position in list_of_remote_servers of get_time_from_servers.
+# status: "ok", "error", "timeout" or "done" (valid answer, failed the
+# sanity checks). unixtime, time_diff_raw and time_diff_lag_cleaned are 0
+# unless status is "ok". pool and iteration are set by sdwdate_fetch_loop,
+# pool is None for the time distribution client.
+RemoteResult = collections.namedtuple("RemoteResult", (
+    "index", "url", "status", "unixtime", "took_time", "half_took_time",
+    "time_diff_raw", "time_diff_lag_cleaned", "pool", "iteration",
+), defaults=(None, 0))
+
+# See LOG_COMPACT. One line per remote instead of one line per detail.
+COMPACT_LOG = False
+
+
+def set_compact_log(compact_log):
+    global COMPACT_LOG
+    COMPACT_LOG = compact_log
+
+
+def print_detail(message):
+    if not COMPACT_LOG:
+        print(message)
+
+
+def print_compact(i, remote, status, took_time, remote_unixtime, time_diff_raw_int):
+    if not COMPACT_LOG:
+        return
+    print(
+        "remote " + str(i) + ": " + str(remote) +
+        " | status: " + str(status) +
+        " | took_time: " + str(took_time) +
+        " | remote_unixtime: " + str(remote_unixtime) +
+        " | time_diff_raw: " + str(time_diff_raw_int)
+    )
+
+
+def run_command(i, url_to_unixtime_command, remote,
+                timeout_seconds=URL_TO_UNIXTIME_TIMEOUT_SECONDS):
     # Avoid Popen shell=True.
     url_to_unixtime_command = shlex.split(url_to_unixtime_command)
 
     start_unixtime = time.time()
+    start_monotonic = time.monotonic()
 
+    count_child_process()
     process = subprocess.Popen(
         url_to_unixtime_command,
         stdout=PIPE,
@@ -43,7 +91,7 @@ def run_command(i, url_to_unixtime_command, remote):
     try:
         process.wait(timeout_seconds)
         # Process already terminated before timeout.
-        print("remote_times.py: i: " + str(i) + " | done")
+        print_detail("remote_times.py: i: " + str(i) + " | done")
         status = "done"
     except subprocess.TimeoutExpired:
         print("remote_times.py: i: " + str(i) + " | timeout_network")
@@ -67,6 +115,7 @@ def run_command(i, url_to_unixtime_command, remote):
 
     end_unixtime = time.time()
     took_time = end_unixtime - start_unixtime
+    add_span("url_to_unixtime", time.monotonic() - start_monotonic)
 
     # Round took_time to two digits for better readability.
     # No other reason for rounding.
@@ -120,14 +169,69 @@ def run_command(i, url_to_unixtime_command, remote):
     return process, status, end_unixtime, took_time, stdout, stderr
 
 
-def check_remote(i, pools, remote, process, status, end_unixtime, took_time, stdout, stderr):
+def build_url_to_unixtime_command(proxy_ip_address, proxy_port_number, remote):
+    remote_port = "80"
+    url_to_unixtime_debug = "true"
+    return "url_to_unixtime" + " " + proxy_ip_address + " " + \
+        proxy_port_number + " " + remote + " " + remote_port + " " + \
+        url_to_unixtime_debug
+
+
+def run_command_scheduled(i, proxy_scheduler, remote):
+    """
+    run_command through the SOCKS endpoint picked by proxy_scheduler.
+    If the endpoint turns out to be dead, retry through another one.
+    """
+    tried = []
+    result = None
+    while True:
+        endpoint = proxy_scheduler.acquire(exclude=tried)
+        if endpoint is None:
+            if result is not None:
+                return result
+            # No endpoint accepts connections. Try anyway for a proper
+            # error message.
+            endpoint = proxy_scheduler.pick()
+
+        url_to_unixtime_command = build_url_to_unixtime_command(
+            endpoint.ip_address, endpoint.port_number, remote)
+        print(
+            "remote_times.py: i: " + str(i) + " | proxy: " + str(endpoint) +
+            " | " + url_to_unixtime_command
+        )
+
+        result = run_command(i, url_to_unixtime_command, remote)
+        proxy_scheduler.release(endpoint)
+        process, status, end_unixtime, took_time, stdout, stderr = result
+
+        if status == "done" and process.returncode != 0 and \
+                is_proxy_error(stderr):
+            print(
+                "remote_times.py: i: " + str(i) + " | proxy " +
+                str(endpoint) + " dead, retrying using another proxy"
+            )
+            proxy_scheduler.mark_dead(endpoint)
+            tried.append(endpoint)
+            continue
+
+        success = status == "done" and process.returncode == 0
+        proxy_scheduler.report(endpoint, took_time, success)
+        return result
+
+
+def check_remote(i, pools, remote, process, status, end_unixtime, took_time, stdout, stderr,
+                 pool=None, iteration=0):
+    """
+    Validates the result of run_command. Returns a RemoteResult of pool
+    number pool in fetch loop iteration iteration.
+    """
     message = "remote " + str(i) + ": " + str(remote)
-    print(message)
+    print_detail(message)
 
     comment = get_comment(pools, remote)
 
     message = "* comment: " + comment
-    print(message)
+    print_detail(message)
 
     half_took_time_float = float(took_time) / 2
     # Round took_time to two digits for better readability.
@@ -135,9 +239,9 @@ def check_remote(i, pools, remote, process, status, end_unixtime, took_time, std
     half_took_time_float = round(half_took_time_float, 2)
 
     message = "* took_time     : " + str(took_time) + " second(s)"
-    print(message)
+    print_detail(message)
     message = "* half_took_time: " + str(half_took_time_float) + " second(s)"
-    print(message)
+    print_detail(message)
 
     unixtime_maybe = stdout
 
@@ -208,19 +312,23 @@ def check_remote(i, pools, remote, process, status, end_unixtime, took_time, std
 
     if not status == "done":
         message = "* exit_code: " + str(process.returncode)
-        print(message)
+        print_detail(message)
         if not stdout_string_length_is > unixtime_string_length_max:
             message = "* stdout: " + str(stdout)
-            print(message)
+            print_detail(message)
         if not stderr_length_is > stderr_string_length_max:
             message = "* stderr: " + stderr
-            print(message)
+            print_detail(message)
         message = "* remote_status: " + str(status)
-        print(message)
+        print_detail(message)
         remote_unixtime = 0
         time_diff_raw_int = 0
         time_diff_lag_cleaned_float = 0.0
-        return status, half_took_time_float, remote_unixtime, time_diff_raw_int, time_diff_lag_cleaned_float
+        print_compact(i, remote, status, took_time, remote_unixtime, time_diff_raw_int)
+        return RemoteResult(
+            i, remote, status, remote_unixtime, took_time,
+            half_took_time_float, time_diff_raw_int,
+            time_diff_lag_cleaned_float, pool, iteration)
 
     time_diff_raw_int = int(remote_unixtime) - int(end_unixtime)
     remote_time = time_human_readable(remote_unixtime)
@@ -234,10 +342,11 @@ def check_remote(i, pools, remote, process, status, end_unixtime, took_time, std
     time_diff_lag_cleaned_float = round(time_diff_lag_cleaned_float, 2)
 
 
-    time_replay_protection_minium_unixtime_int, \
-        time_replay_protection_minium_unixtime_human_readable = (
-            time_replay_protection_file_read()
-        )
+    with span("check_remote.time_replay_protection_file_read"):
+        time_replay_protection_minium_unixtime_int, \
+            time_replay_protection_minium_unixtime_human_readable = (
+                time_replay_protection_file_read()
+            )
 
     time_replay_protection_minium_unixtime_human_readable = \
         time_replay_protection_minium_unixtime_human_readable.strip()
@@ -247,185 +356,207 @@ def check_remote(i, pools, remote, process, status, end_unixtime, took_time, std
     )
 
 
-    timesanitycheck_status_static, \
-        timesanitycheck_error_static = \
-        static_time_sanity_check(remote_unixtime)
-
-    consensus_status, \
-        consensus_error, \
-        consensus_valid_after_str, \
-        consensus_valid_until_str = \
-        time_consensus_sanity_check(remote_unixtime)
+    with span("check_remote.static_time_sanity_check"):
+        timesanitycheck_status_static, \
+            timesanitycheck_error_static = \
+            static_time_sanity_check(remote_unixtime)
+
+    with span("check_remote.time_consensus_sanity_check"):
+        consensus_status, \
+            consensus_error, \
+            consensus_valid_after_str, \
+            consensus_valid_until_str = \
+            time_consensus_sanity_check(remote_unixtime)
+
+    TRANSCRIPT.record_sanity_inputs(
+        remote,
+        (time_replay_protection_minium_unixtime_int,
+         time_replay_protection_minium_unixtime_human_readable),
+        (timesanitycheck_status_static, timesanitycheck_error_static),
+        (consensus_status, consensus_error, consensus_valid_after_str,
+         consensus_valid_until_str)
+    )
 
     message = (
         "* replay_protection_unixtime: "
         + time_replay_protection_minium_unixtime_str
     )
-    print(message)
+    print_detail(message)
     message = "* remote_unixtime           : " + str(remote_unixtime)
-    print(message)
+    print_detail(message)
 
     message = "* consensus/valid-after           : " + \
         consensus_valid_after_str
-    print(message)
+    print_detail(message)
     message = (
         "* replay_protection_time          : "
         + time_replay_protection_minium_unixtime_human_readable
     )
-    print(message)
+    print_detail(message)
     message = "* remote_time                     : " + remote_time
-    print(message)
+    print_detail(message)
     message = "* consensus/valid-until           : " + \
         consensus_valid_until_str
-    print(message)
+    print_detail(message)
 
     message = "* time_diff_raw        : " + \
         str(time_diff_raw_int) + " second(s)"
-    print(message)
+    print_detail(message)
     message = (
         "* time_diff_lag_cleaned: "
         + str(time_diff_lag_cleaned_float)
         + " second(s)"
     )
-    print(message)
+    print_detail(message)
 
     # Fallback.
     remote_status = "fallback"
 
     if timesanitycheck_status_static == "sane":
         message = "* Time Replay Protection         : sane"
-        print(message)
+        print_detail(message)
     elif timesanitycheck_status_static == "slow":
         message = "* Time Replay Protection         : slow"
-        print(message)
+        print_detail(message)
         remote_status = "False"
     elif timesanitycheck_status_static == "fast":
         message = "* Time Replay Protection         : fast"
-        print(message)
+        print_detail(message)
         remote_status = "False"
     elif timesanitycheck_status_static == "error":
         message = (
             "* Static Time Sanity Check       : error:"
             + timesanitycheck_error_static
         )
-        print(message)
+        print_detail(message)
         remote_status = "False"
 
     if consensus_status == "ok":
         message = "* Tor Consensus Time Sanity Check: sane"
-        print(message)
+        print_detail(message)
         if not remote_status == "False":
             remote_status = "True"
     elif consensus_status == "slow":
         message = "* Tor Consensus Time Sanity Check: slow"
-        print(message)
+        print_detail(message)
         remote_status = "False"
     elif consensus_status == "fast":
         message = "* Tor Consensus Time Sanity Check: fast"
-        print(message)
+        print_detail(message)
         remote_status = "False"
     elif consensus_status == "error":
         message = "* Tor Consensus Time Sanity Check: error: " + \
             consensus_error
-        print(message)
+        print_detail(message)
         remote_status = "False"
 
     message = "* remote_status: " + remote_status
-    print(message)
+    print_detail(message)
 
     if remote_status == "True":
         status = "ok"
-        return status, half_took_time_float, remote_unixtime, time_diff_raw_int, time_diff_lag_cleaned_float
+        print_compact(i, remote, status, took_time, remote_unixtime, time_diff_raw_int)
+        return RemoteResult(
+            i, remote, status, remote_unixtime, took_time,
+            half_took_time_float, time_diff_raw_int,
+            time_diff_lag_cleaned_float, pool, iteration)
 
-    remote_unixtime = 0
-    time_diff_raw_int = 0
-    time_diff_lag_cleaned_float = 0.00
-    return status, half_took_time_float, remote_unixtime, time_diff_raw_int, time_diff_lag_cleaned_float
+    print_compact(i, remote, status, took_time, remote_unixtime, time_diff_raw_int)
+    return RemoteResult(
+        i, remote, status, 0, took_time, half_took_time_float, 0, 0.00,
+        pool, iteration)
 
 
-def get_time_from_servers(
+def iter_time_from_servers(
         pools,
         list_of_remote_servers,
         proxy_ip_address,
-        proxy_port_number):
-
-    remote_port = "80"
-
+        proxy_port_number,
+        proxy_scheduler=None,
+        url_pool_number=None,
+        iteration=0):
+    """
+    Fetches the time from all list_of_remote_servers concurrently. Yields a
+    RemoteResult as soon as each one is checked, in order of completion.
+    url_pool_number: optional dict url -> pool number, stored in each
+    RemoteResult together with iteration.
+    """
     number_of_remote_servers = len(list_of_remote_servers)
-    # Example number_of_remote_servers:
-    # 3
-    range_of_remote_servers = range(number_of_remote_servers)
-    # Example range_of_remote_servers:
-    # range(0, 3)
-
-    url_to_unixtime_debug = "true"
-
-    status = [None] * number_of_remote_servers
-    status_list = [None] * number_of_remote_servers
-    urls_list = [None] * number_of_remote_servers
-    took_time_list = [None] * number_of_remote_servers
-    half_took_time_list = [None] * number_of_remote_servers
-    remote_unixtime_list = [None] * number_of_remote_servers
-    handle_list = [None] * number_of_remote_servers
-    future_list = [None] * number_of_remote_servers
-
-    end_unixtime = [None] * number_of_remote_servers
-    took_time = [None] * number_of_remote_servers
-    stdout = [None] * number_of_remote_servers
-    stderr = [None] * number_of_remote_servers
-
-    time_diff_raw_int_list = [None] * number_of_remote_servers
-    time_diff_lag_cleaned_float_list = [None] * number_of_remote_servers
 
     url_to_unixtime_commands_list = [None] * number_of_remote_servers
+    if proxy_scheduler is None:
+        print_detail("remote_times.py: url_to_unixtime_command (s):")
+        for i, remote in enumerate(list_of_remote_servers):
+            url_to_unixtime_commands_list[i] = build_url_to_unixtime_command(
+                proxy_ip_address, proxy_port_number, remote)
+            print_detail(url_to_unixtime_commands_list[i])
+
+        print_detail("")
+
+    # Only kept for the transcript.
+    recording = TRANSCRIPT.enabled
+    if recording:
+        runs = [None] * number_of_remote_servers
+        results = [None] * number_of_remote_servers
+
+    # One worker per time source. The default (number of CPUs + 4) would
+    # queue requests when there are more pools than that.
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(number_of_remote_servers, 1)) as executor:
+        future_index = {}
+        for i, remote in enumerate(list_of_remote_servers):
+            if proxy_scheduler is None:
+                future = executor.submit(
+                    run_command, i, url_to_unixtime_commands_list[i], remote
+                )
+            else:
+                future = executor.submit(
+                    run_command_scheduled, i, proxy_scheduler, remote
+                )
+            future_index[future] = i
+
+        # check_remote of one source runs while the others are still
+        # being fetched.
+        for future in concurrent.futures.as_completed(future_index):
+            i = future_index[future]
+            remote = list_of_remote_servers[i]
+            run = future.result()
+            pool = None
+            if url_pool_number is not None:
+                pool = url_pool_number.get(remote)
+            with span("check_remote"):
+                result = check_remote(
+                    i, pools, remote, *run, pool=pool, iteration=iteration)
+            if recording:
+                runs[i] = run
+                results[i] = result
+
+            print_detail("")
+            yield result
+
+    if recording:
+        TRANSCRIPT.record_batch(pools, list_of_remote_servers, runs, results)
 
-    print("remote_times.py: url_to_unixtime_command (s):")
-    for i in range_of_remote_servers:
-        url_to_unixtime_commands_list[i] = "url_to_unixtime" + " " + proxy_ip_address + " " + \
-            proxy_port_number + " " + list_of_remote_servers[i] + " " + remote_port + " " + url_to_unixtime_debug
-        print(url_to_unixtime_commands_list[i])
-
-    print("")
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        for i in range_of_remote_servers:
-            future_list[i] = executor.submit(
-                run_command, i, url_to_unixtime_commands_list[i], list_of_remote_servers[i]
-            )
-
-    for i in range_of_remote_servers:
-        handle_list[i], status[i], end_unixtime[i], took_time[i], stdout[i], stderr[i] = future_list[i].result()
-
-    for i in range_of_remote_servers:
-        status_list[i], \
-        half_took_time_list[i], \
-        remote_unixtime_list[i], \
-        time_diff_raw_int_list[i], \
-        time_diff_lag_cleaned_float_list[i] \
-            = \
-            check_remote(i, pools, list_of_remote_servers[i], handle_list[i], status[i], end_unixtime[i], took_time[i], stdout[i], stderr[i])
-
-        print("")
-
-        urls_list[i] = list_of_remote_servers[i]
-        took_time_list[i] = took_time[i]
-
-    print("remote_times.py: urls_list:")
-    print(str(urls_list))
-    print("remote_times.py: status_list:")
-    print(str(status_list))
-    print("remote_times.py: took_time_list:")
-    print(str(took_time_list))
-    print("remote_times.py: half_took_time_list:")
-    print(str(half_took_time_list))
-    print("remote_times.py: remote_unixtime_list:")
-    print(str(remote_unixtime_list))
-    print("remote_times.py: time_diff_raw_int_list:")
-    print(str(time_diff_raw_int_list))
-    print("remote_times.py: time_diff_lag_cleaned_float_list:")
-    print(str(time_diff_lag_cleaned_float_list))
-
-    return urls_list, status_list, remote_unixtime_list, took_time_list, half_took_time_list, time_diff_raw_int_list, time_diff_lag_cleaned_float_list
+def get_time_from_servers(
+        pools,
+        list_of_remote_servers,
+        proxy_ip_address,
+        proxy_port_number,
+        proxy_scheduler=None):
+    """
+    As iter_time_from_servers. Returns the list of RemoteResult in the order
+    of list_of_remote_servers once all are done.
+    """
+    results = [None] * len(list_of_remote_servers)
+    for result in iter_time_from_servers(
+            pools,
+            list_of_remote_servers,
+            proxy_ip_address,
+            proxy_port_number,
+            proxy_scheduler):
+        results[result.index] = result
+    return results
 
 
 def remote_times_signal_handler(sig, frame):
@@ -450,7 +581,7 @@ def main():
     signal.signal(signal.SIGINT, remote_times_signal_handler)
 
     pools = []
-    number_of_pools = 3
+    number_of_pools = number_of_pools_config()
     pool_range = range(number_of_pools)
     for pool_i in pool_range:
         pools.append(TimeSourcePool(pool_i))
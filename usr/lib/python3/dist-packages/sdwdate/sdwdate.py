@@ -9,45 +9,180 @@ import sys
 sys.dont_write_bytecode = True
 
 from pathlib import Path
-import json
 import subprocess
 from subprocess import Popen
 # from random import randint
-import secrets
-from datetime import datetime
 import time
 import glob
 import os
 import signal
+import threading
 import logging
 import shlex
 import sdnotify
-from guimessages.translations import _translations
 from sdwdate.proxy_settings import proxy_settings
+from sdwdate.proxy_settings import proxy_list_settings
+from sdwdate.proxy_scheduler import ProxyScheduler
 from sdwdate.config import read_pools
+from sdwdate.config import number_of_pools_config
+from sdwdate.config import pool_quorum_config
 from sdwdate.config import allowed_failures_config
 from sdwdate.config import allowed_failures_calculate
 from sdwdate.config import time_human_readable
 from sdwdate.config import time_replay_protection_file_read
 from sdwdate.config import randomize_time_config
-from sdwdate.remote_times import get_time_from_servers
+from sdwdate.config import control_socket_config
+from sdwdate.config import ntp_shm_config
+from sdwdate.config import metrics_textfile_config
+from sdwdate.config import span_timing_config
+from sdwdate.config import profile_config
+from sdwdate.config import journal_structured_config
+from sdwdate.config import log_compact_config
+from sdwdate.config import transcript_record_config
+from sdwdate.config import transcript_keep_config
+from sdwdate.config import memory_release_config
+from sdwdate.config import probe_config
+from sdwdate.config import warm_restart_max_age_config
+from sdwdate.config import measure_only_config
+from sdwdate.config import time_distribution_server_config
+from sdwdate.config import time_distribution_client_config
+from sdwdate.config import time_distribution_key_file_config
+from sdwdate.config import time_distribution_max_age_config
+from sdwdate.control_socket import StatusSnapshot
+from sdwdate.control_socket import start_control_socket
+from sdwdate.control_socket import stop_control_socket
+from sdwdate.metrics import MetricsRegistry
+from sdwdate.spans import ROUND_SPANS
+from sdwdate.spans import span
+from sdwdate.spans import count_child_process
+from sdwdate.profiling import RoundProfiler
+from sdwdate.journal import JOURNAL
+from sdwdate.journal import JournalHandler
+from sdwdate.journal import send_source_record
+from sdwdate.journal import send_round_record
+from sdwdate.transcript import TRANSCRIPT
+from sdwdate.memory import release_memory
+from sdwdate.source_health import SOURCE_HEALTH
+from sdwdate.source_health import BackgroundProber
+from sdwdate.heartbeat import HEARTBEAT
+from sdwdate.boot_timeline import BOOT_TIMELINE
+from sdwdate.boot_timeline import boottime_seconds
+from sdwdate.warm_restart import write_last_round
+from sdwdate.warm_restart import read_last_round
+from sdwdate.heartbeat import PREPARATION_DEADLINE_SECONDS
+from sdwdate.heartbeat import FETCH_MARGIN_SECONDS
+from sdwdate.heartbeat import SLEEP_MARGIN_SECONDS
+from sdwdate.timesanitycheck import static_time_sanity_check
+from sdwdate.timesanitycheck import time_consensus_sanity_check
+from sdwdate.remote_times import iter_time_from_servers
+from sdwdate.remote_times import RemoteResult
+from sdwdate.remote_times import URL_TO_UNIXTIME_TIMEOUT_SECONDS
+from sdwdate.remote_times import set_compact_log
 from sdwdate.misc import strip_html
+from sdwdate.misc import median
+from sdwdate.misc import offsets_agree
 
 
 os.environ["LC_TIME"] = "C"
 os.environ["TZ"] = "UTC"
 time.tzset()
 
+
+def attach_ntp_shm():
+    """
+    NTP_SHM. Creates the segment before READY=1, so an NTP daemon ordered
+    After=sdwdate.service finds it, owned by sdwdate. See ntp_shm.py.
+    Returns None if NTP_SHM is disabled.
+    """
+    ntp_shm_unit = ntp_shm_config()
+    if ntp_shm_unit is None or measure_only_config():
+        return None
+    from sdwdate.ntp_shm import NtpShm
+    ntp_shm = NtpShm(ntp_shm_unit)
+    try:
+        ntp_shm.attach()
+    except BaseException:
+        # LOGGER is not set up yet. Retried by write_ntp_shm.
+        error_message = str(sys.exc_info()[0]) + " " + str(sys.exc_info()[1])
+        print("NTP SHM: ERROR: " + error_message)
+    return ntp_shm
+
+
+ntp_shm_object = attach_ntp_shm()
+# ShmRefresher of the last round.
+ntp_shm_refresher = None
+
+resync_requested = False
+# SIGUSR2 received before global_files() set clock_jump_do_once_file.
+clock_jump_pending = False
+
+
+def early_resync_signal_handler(sig, frame):
+    """
+    Registered before READY=1, so ExecReload= (SIGUSR1) and
+    sdwdate-clock-jump (SIGUSR2) do not kill sdwdate while it is starting.
+    Only records the request, LOGGER and the status folder are not set up
+    yet. Replaced by resync_signal_handler in main().
+    """
+    global resync_requested
+    global clock_jump_pending
+    resync_requested = True
+    if sig == signal.SIGUSR2:
+        clock_jump_pending = True
+
+
+signal.signal(signal.SIGUSR1, early_resync_signal_handler)
+signal.signal(signal.SIGUSR2, early_resync_signal_handler)
+
 SDNOTIFY_OBJECT = sdnotify.SystemdNotifier()
 SDNOTIFY_OBJECT.notify("READY=1")
 SDNOTIFY_OBJECT.notify("STATUS=Starting...")
+BOOT_TIMELINE.mark("ready")
+
+# Served by the control socket.
+STATUS_SNAPSHOT = StatusSnapshot()
+
+# Written to METRICS_TEXTFILE.
+METRICS = MetricsRegistry()
+
+# See PROFILE_ROUNDS.
+ROUND_PROFILER = RoundProfiler()
+
+# Modules only needed once sdwdate is running (translations, json, secrets,
+# NTP SHM, time distribution) are imported on first use instead of at start,
+# which shortens the time until READY=1.
+
+TRANSLATIONS_PATH = "/usr/share/translations/sdwdate.yaml"
+
+# Loaded on first use by translate_object.
+translation = None
+
+# MEASURE_ONLY: a previous round would have set the time. first_success is
+# not created in measure only mode.
+measured_first_success = False
+
+
+def translate_object(message):
+    global translation
+    if translation is None:
+        from guimessages.translations import _translations
+        translation = _translations(TRANSLATIONS_PATH, "sdwdate")
+    return translation.gettext(message)
+
+
+def secure_choice(sequence):
+    import secrets
+    return secrets.choice(sequence)
 
 
 def write_status(icon, msg):
+    import json
     status = {"icon": "", "message": ""}
     status["icon"] = icon
     status["message"] = msg
 
+    STATUS_SNAPSHOT.update(icon=icon, message=msg)
+
     try:
         with open(status_file_path, "w") as file_object:
             json.dump(status, file_object)
@@ -62,6 +197,185 @@ def write_status(icon, msg):
         msgf.close()
 
 
+def write_metrics():
+    metrics_textfile = metrics_textfile_config()
+    if metrics_textfile is None:
+        return
+    try:
+        METRICS.write(metrics_textfile)
+    except BaseException:
+        error_message = str(sys.exc_info()[0]) + " " + str(sys.exc_info()[1])
+        message = "Could not write metrics file. error: " + error_message
+        LOGGER.error(message)
+
+
+def boot_timeline_mark(event):
+    """
+    See boot_timeline.py.
+    """
+    if not BOOT_TIMELINE.mark(event):
+        return
+    METRICS.set_gauge("boot_timeline_seconds", BOOT_TIMELINE.gauges())
+    if event == "first_time_set":
+        METRICS.set_gauge(
+            "time_to_first_sync_seconds", BOOT_TIMELINE.time_to_first_sync())
+        message = "Boot timeline, seconds since boot: " + \
+            BOOT_TIMELINE.summary()
+        LOGGER.info(message)
+
+
+def write_last_round_file(sdwdate_obj):
+    try:
+        write_last_round(
+            last_round_path,
+            sdwdate_obj.set_boottime,
+            sdwdate_obj.set_unixtime,
+            sdwdate_obj.new_diff_in_seconds,
+            sdwdate_obj.error_bound_seconds,
+            sdwdate_obj.median_diff_raw_in_seconds,
+            len(sdwdate_obj.pool_results)
+        )
+    except BaseException:
+        error_message = str(sys.exc_info()[0]) + " " + str(sys.exc_info()[1])
+        message = "Could not write last round file. error: " + error_message
+        LOGGER.error(message)
+
+
+def warm_restart():
+    """
+    Returns True if the last round of this boot can be reused instead of
+    running a round after a restart. See WARM_RESTART_MAX_AGE.
+    """
+    max_age = warm_restart_max_age_config()
+    if max_age <= 0 or measure_only_config():
+        return False
+    if os.path.exists(clock_jump_do_once_file):
+        record, reason = None, "clock jump requested"
+    elif not os.path.exists(status_first_success_path):
+        record, reason = None, "no first success"
+    else:
+        record, reason = read_last_round(last_round_path, max_age)
+    if record is None:
+        message = "Warm restart: no, " + reason + "."
+        LOGGER.info(message)
+        return False
+
+    message = (
+        "Warm restart: yes, "
+        + reason
+        + ", applied offset: "
+        + str(record["applied_offset"])
+        + " error bound: "
+        + str(record["error_bound"])
+        + ". Skipping preparation and fetching, sleeping."
+    )
+    LOGGER.info(message)
+    ntp_shm_unit = ntp_shm_config()
+    if ntp_shm_unit is not None:
+        # The NTP daemon considers the reference clock unreachable without
+        # new samples. Time measured by the last round, without randomized
+        # nanoseconds, as written by write_ntp_shm.
+        reference_unixtime = record["set_unixtime"] - \
+            record["applied_offset"] + record["median_offset"]
+        offset = reference_unixtime + record["age"] - time.time()
+        try:
+            precision = start_ntp_shm_refresher(
+                ntp_shm_unit, offset, record["error_bound"],
+                record.get("sources", 1), None)
+        except BaseException:
+            error_message = str(sys.exc_info()[0]) + " " + \
+                str(sys.exc_info()[1])
+            message = "Warm restart: no, NTP SHM: ERROR: " + error_message
+            LOGGER.error(message)
+            return False
+        message = (
+            "NTP SHM unit "
+            + str(ntp_shm_unit)
+            + ": wrote offset of the last round: %+.9f precision: %s" %
+            (offset, precision)
+        )
+        LOGGER.info(message)
+    round_unixtime = time.time() - record["age"]
+    STATUS_SNAPSHOT.update(
+        median_offset=record["median_offset"],
+        new_diff=record["applied_offset"],
+        error_bound=record["error_bound"]
+    )
+    METRICS.set_gauge("median_offset_seconds", record["median_offset"])
+    METRICS.set_gauge("applied_correction_seconds", record["applied_offset"])
+    METRICS.set_gauge("error_bound_seconds", record["error_bound"])
+    METRICS.set_gauge("last_success_timestamp_seconds", round(round_unixtime))
+    if time_distribution_server is not None:
+        time_distribution_server.publish(
+            record["set_unixtime"], record["set_boottime"],
+            record["error_bound"])
+    return True
+
+
+def release_round_memory(sdwdate_obj):
+    """
+    Called before wait_sleep. See memory.py.
+    """
+    sdwdate_obj.release_round_state()
+    TRANSCRIPT.reset(False)
+    rss_before, rss_after = release_memory()
+    if rss_after is None:
+        return
+    METRICS.set_gauge("resident_memory_bytes", rss_after * 1024)
+    message = (
+        "Memory released before sleeping. rss: "
+        + str(rss_before)
+        + " KiB -> "
+        + str(rss_after)
+        + " KiB"
+    )
+    LOGGER.info(message)
+
+
+def write_transcript(sdwdate_obj, status, round_number):
+    if sdwdate_obj.randomize_nanoseconds is None:
+        randomize = None
+    else:
+        randomize = {
+            "nanoseconds": sdwdate_obj.randomize_nanoseconds,
+            "sign": sdwdate_obj.randomize_sign,
+        }
+    round_record = {
+        "status": status,
+        "fetch_iterations": sdwdate_obj.iteration,
+        "number_of_pools": sdwdate_obj.number_of_pools,
+        "pool_quorum": sdwdate_obj.pool_quorum,
+        "allowed_failures": sdwdate_obj.allowed_failures,
+        "randomize": randomize,
+    }
+    # build_median ran.
+    if sdwdate_obj.error_bound_seconds != 0:
+        round_record["median_diff_raw"] = \
+            sdwdate_obj.median_diff_raw_in_seconds
+        round_record["new_diff"] = sdwdate_obj.new_diff_in_seconds
+        round_record["error_bound"] = sdwdate_obj.error_bound_seconds
+    try:
+        file_name = TRANSCRIPT.write(
+            transcript_folder_path,
+            round_number,
+            round_record,
+            transcript_keep_config()
+        )
+        message = "Transcript written: " + file_name
+        LOGGER.info(message)
+    except BaseException:
+        error_message = str(sys.exc_info()[0]) + " " + str(sys.exc_info()[1])
+        message = "Could not write transcript. error: " + error_message
+        LOGGER.error(message)
+
+
+def wait_sclockadj(process, start_monotonic):
+    process.wait()
+    duration = round(time.monotonic() - start_monotonic, 3)
+    METRICS.set_gauge("sclockadj_duration_seconds", duration)
+    write_metrics()
+
+
 def kill_sclockadj():
     try:
         sclockadj_process.kill()
@@ -82,6 +396,23 @@ def kill_sleep_process():
         LOGGER.info(message)
 
 
+def resync_signal_handler(sig, frame):
+    """
+    SIGUSR1: Wake up from wait_sleep and start a new round straight away.
+    SIGUSR2: Same as SIGUSR1 but instantly set the time using /bin/date
+             (clock jump) instead of gradually adjusting it using sclockadj.
+    """
+    global resync_requested
+    resync_requested = True
+    if sig == signal.SIGUSR2:
+        Path(clock_jump_do_once_file).touch()
+        message = "Signal SIGUSR2 received. Resync using clock jump requested."
+    else:
+        message = "Signal SIGUSR1 received. Resync requested."
+    LOGGER.info(message)
+    kill_sleep_process()
+
+
 def signal_handler(sig, frame):
     message = translate_object("sigterm")
     stripped_message = strip_html(message)
@@ -92,9 +423,11 @@ def signal_handler(sig, frame):
 
 
 def exit_handler(exit_code, reason):
+    HEARTBEAT.stop()
     SDNOTIFY_OBJECT.notify("STATUS=Shutting down...")
     SDNOTIFY_OBJECT.notify("WATCHDOG=1")
     SDNOTIFY_OBJECT.notify("STOPPING=1")
+    STATUS_SNAPSHOT.update(phase="stopping")
 
     message = (
         "Exiting with exit_code '"
@@ -112,21 +445,144 @@ def exit_handler(exit_code, reason):
 
     kill_sclockadj()
     kill_sleep_process()
+    stop_ntp_shm(True)
 
     Path(sleep_long_file_path).unlink(missing_ok=True)
 
+    if control_server is not None:
+        stop_control_socket(control_server, control_socket_path)
+
     message = "End."
     LOGGER.info(message)
 
     sys.exit(exit_code)
 
 
+def ntp_shm_disciplined():
+    """
+    Called by ShmRefresher once the NTP daemon corrected the clock. Until
+    then the firewall stays in timesync-fail-closed mode.
+    """
+    file_object = open(status_first_success_path, "w")
+    file_object.close()
+    message = "NTP SHM: clock corrected by NTP daemon. Created " + \
+        status_first_success_path
+    LOGGER.info(message)
+    boot_timeline_mark("first_time_set")
+
+
+def start_ntp_shm_refresher(ntp_shm_unit, offset_seconds, error_bound_seconds,
+                            nsamples, on_disciplined):
+    """
+    Writes the first sample and starts the ShmRefresher, replacing the one
+    of the previous round. Returns the precision written. See ntp_shm.py.
+    """
+    global ntp_shm_object
+    global ntp_shm_refresher
+    from sdwdate.ntp_shm import NtpShm
+    from sdwdate.ntp_shm import ShmRefresher
+    stop_ntp_shm()
+    if ntp_shm_object is None or ntp_shm_object.unit != ntp_shm_unit:
+        if ntp_shm_object is not None:
+            ntp_shm_object.detach()
+        ntp_shm_object = NtpShm(ntp_shm_unit)
+    refresher = ShmRefresher(
+        ntp_shm_object,
+        offset_seconds,
+        error_bound_seconds,
+        nsamples,
+        on_disciplined
+    )
+    precision = refresher.refresh()
+    refresher.start()
+    ntp_shm_refresher = refresher
+    return precision
+
+
+def stop_ntp_shm(detach=False):
+    global ntp_shm_refresher
+    if ntp_shm_refresher is not None:
+        ntp_shm_refresher.stop()
+        ntp_shm_refresher = None
+    if detach and ntp_shm_object is not None:
+        ntp_shm_object.detach()
+
+
+def fetch_deadline_seconds():
+    """
+    Heartbeat deadline while waiting for the next time source result.
+    run_command_scheduled tries every SOCKS endpoint at most once.
+    """
+    if proxy_scheduler is None:
+        endpoints = 1
+    else:
+        endpoints = len(proxy_scheduler.endpoints)
+    return URL_TO_UNIXTIME_TIMEOUT_SECONDS * endpoints + FETCH_MARGIN_SECONDS
+
+
+def probe_proxy():
+    """
+    SOCKS endpoint for BackgroundProber. See PROXY_LIST.
+    """
+    if proxy_scheduler is not None:
+        endpoint = proxy_scheduler.pick()
+        if endpoint is not None:
+            return endpoint.ip_address, endpoint.port_number
+    return proxy_ip, proxy_port
+
+
+def start_prober(sleep_seconds):
+    """
+    Returns a started BackgroundProber, or None if PROBE is disabled.
+    """
+    probe = probe_config()
+    if probe is None:
+        return None
+    probes_per_hour, concurrency, bytes_per_hour, max_age = probe
+
+    urls = []
+    for pool_number in range(number_of_pools_config()):
+        urls.extend(read_pools(pool_number, "production")[0])
+
+    prober = BackgroundProber(
+        urls, probe_proxy, sleep_seconds, probes_per_hour, concurrency,
+        bytes_per_hour)
+    message = (
+        "Background prober: probes scheduled: " + str(len(prober.schedule))
+        + " pool members: " + str(len(urls))
+        + " health: " + str(SOURCE_HEALTH.summary(max_age))
+    )
+    LOGGER.info(message)
+    prober.start()
+    return prober
+
+
+def stop_prober(prober):
+    prober.stop()
+    message = (
+        "Background prober: probes done: " + str(prober.probes)
+        + " skipped (bytes per hour budget): " + str(prober.skipped_budget)
+        + " bytes last hour: " + str(SOURCE_HEALTH.probe_bytes_last_hour())
+    )
+    LOGGER.info(message)
+
+
 class TimeSourcePool(object):
+    __slots__ = ("url", "comment", "url_random_pool", "already_picked_index",
+                 "done", "exhausted")
+
     def __init__(self, pool):
         self.url, self.comment = read_pools(pool, "production")
         self.url_random_pool = []
         self.already_picked_index = []
         self.done = False
+        # Every url was tried without a valid time.
+        self.exhausted = False
+
+
+# Fields of a RemoteResult shown by the control socket.
+SOURCE_RESULT_FIELDS = ("url", "pool", "iteration", "status", "took_time",
+                        "time_diff_raw", "time_diff_lag_cleaned")
 
 
 class SdwdateClass(object):
@@ -134,7 +590,14 @@ class SdwdateClass(object):
         self.failure_ratio_from_config = allowed_failures_config()
 
         self.iteration = 0
-        self.number_of_pools = 3
+        self.number_of_pools = number_of_pools_config()
+        # Pools which must return a valid time. See POOL_QUORUM.
+        self.pool_quorum = pool_quorum_config(self.number_of_pools)
+        # None or (probes per hour, concurrency, bytes per hour, max age).
+        # See PROBE.
+        self.probe = probe_config()
+        # Run rounds without setting the time. See MEASURE_ONLY.
+        self.measure_only = measure_only_config()
         pool_range = range(self.number_of_pools)
         self.pools = []
         for pool_i in pool_range:
@@ -150,26 +613,18 @@ class SdwdateClass(object):
             total_number_pool_member
         )
 
-        self.list_of_urls_returned = []
+        self.url_pool_number = {}
+        self.error_bound_seconds = 0
+        # Error bound of the time distribution server, if used.
+        self.upstream_error_bound = 0
+
+        # url -> RemoteResult of all iterations, in order of completion.
+        self.results = {}
+        # RemoteResult of the current iteration, in order of completion.
+        self.remote_results = []
+        # The valid RemoteResult of each done pool, used for the median.
+        self.pool_results = []
         self.list_of_url_random_requested = []
-        self.valid_urls = []
-        self.list_of_unixtimes = []
-        self.list_of_status = []
-
-        self.request_unixtimes = {}
-        self.request_took_times = {}
-        self.list_of_took_time = []
-        self.list_of_half_took_time = []
-        self.time_diff_raw_int = {}
-        self.time_diff_lag_cleaned_float = {}
-
-        self.list_off_time_diff_raw_int = []
-        self.list_off_time_diff_lag_cleaned_float = []
-
-        self.unixtimes = []
-        self.half_took_time_float = {}
-        self.list_of_pools_raw_diff = []
-        self.pools_lag_cleaned_diff = []
         self.failed_urls = []
 
         self.median_diff_raw_in_seconds = 0
@@ -179,6 +634,36 @@ class SdwdateClass(object):
         self.new_diff_in_nanoseconds = 0
         self.unixtime_before_sleep = 0
         self.sleep_time_seconds = 0
+        self.woken_up_by_resync_request = False
+        # Recorded in transcripts. None if not randomizing.
+        self.randomize_nanoseconds = None
+        self.randomize_sign = None
+        # Set by set_new_time, written to the last round file. See
+        # WARM_RESTART_MAX_AGE.
+        self.set_boottime = None
+        self.set_unixtime = None
+
+
+    def source_results_snapshot(self):
+        return [
+            {name: getattr(result, name) for name in SOURCE_RESULT_FIELDS}
+            for result in self.results.values()
+        ]
+
+
+    def release_round_state(self):
+        """
+        Called before wait_sleep. Drops what is only needed during the
+        round. Keeps the results (median, new_diff, error_bound) and what
+        wait_sleep and check_clock_skew use.
+        """
+        self.pools = []
+        self.url_pool_number = {}
+        self.results = {}
+        self.remote_results = []
+        self.pool_results = []
+        self.list_of_url_random_requested = []
+        self.failed_urls = []
 
 
     def preparation(self):
@@ -188,7 +673,7 @@ class SdwdateClass(object):
         loop_max = 10000
         preparation_sleep_seconds = 0
         while True:
-            SDNOTIFY_OBJECT.notify("WATCHDOG=1")
+            HEARTBEAT.enter("preparation", PREPARATION_DEADLINE_SECONDS)
             if loop_counter >= loop_max:
                 loop_counter = 0
             loop_counter += 1
@@ -212,6 +697,7 @@ class SdwdateClass(object):
                 preparation_sleep_seconds = 10
 
             preparation_path = "/usr/libexec/helper-scripts/onion-time-pre-script"
+            count_child_process()
             preparation_status = subprocess.Popen(
                 preparation_path, stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE)
@@ -268,29 +754,58 @@ class SdwdateClass(object):
 
 
     @staticmethod
-    def general_timeout_error(pools):
+    def general_timeout_error(statuses):
         """
         This error occurs (at least) when internet connection is down.
         """
         returned_error = "timeout"
-        if (
-                pools[0] == returned_error
-                and pools[1] == returned_error
-                and pools[2] == returned_error
-        ):
-            return True
-        return False
+        if not statuses:
+            return False
+        for status in statuses:
+            if status != returned_error:
+                return False
+        return True
+
+
+    def pools_done(self):
+        return len([pool for pool in self.pools if pool.done])
+
+
+    def pools_possible(self):
+        """
+        Pools which returned a valid time or might still return one.
+        """
+        return len([pool for pool in self.pools if not pool.exhausted])
+
+
+    def pools_agree(self):
+        """
+        Whether the time differences of the pools which returned a valid
+        time lie within their error bounds of each other. With a quorum
+        below all pools, the median is only used if they do. Otherwise a
+        single pool could move the median.
+        """
+        return offsets_agree(
+            [result.time_diff_raw for result in self.pool_results],
+            [result.half_took_time + 1 for result in self.pool_results])
 
 
     def build_median(self):
         """
         Get the median (not average) from the list of values.
         """
-        sorted_request_took_times = sorted(self.request_took_times.values())
+        sorted_request_took_times = sorted(
+            result.took_time for result in self.pool_results)
         sorted_request_half_took_times = sorted(
-            self.half_took_time_float.values())
-        diffs_raw = sorted(self.list_of_pools_raw_diff)
-        diffs_lag_cleaned = sorted(self.pools_lag_cleaned_diff)
+            result.half_took_time for result in self.pool_results)
+        diffs_raw = sorted(
+            result.time_diff_raw for result in self.pool_results)
+        # Rounding. Nanoseconds accuracy is impossible. It is unknown if the
+        # time (seconds) reported by remote servers was a "early second"
+        # (0.000000000) or "late second" (0.999999999).
+        diffs_lag_cleaned = sorted(
+            round(result.time_diff_lag_cleaned)
+            for result in self.pool_results)
         message = "     request_took_times, sorted: %s" % \
             sorted_request_took_times
         LOGGER.info(message)
@@ -303,16 +818,16 @@ class SdwdateClass(object):
         message = "      diffs_lag_cleaned, sorted: %s" % \
             diffs_lag_cleaned
         LOGGER.info(message)
-        median_took_times = sorted_request_took_times[
-            (len(sorted_request_took_times) // 2)
-        ]
-        median_half_took_times = sorted_request_half_took_times[
-            (len(sorted_request_half_took_times) // 2)
-        ]
-        self.median_diff_raw_in_seconds = diffs_raw[(len(diffs_raw) // 2)]
-        self.median_diff_lag_cleaned_in_seconds = diffs_lag_cleaned[
-            (len(diffs_lag_cleaned) // 2)
-        ]
+        median_took_times = median(sorted_request_took_times)
+        median_half_took_times = median(sorted_request_half_took_times)
+        self.median_diff_raw_in_seconds = round(median(diffs_raw), 3)
+        self.median_diff_lag_cleaned_in_seconds = median(diffs_lag_cleaned)
+        # The HTTP Date header has a resolution of one second. It is unknown
+        # when during the request the remote created it, which is at most
+        # half of the time the request took (round trip). In time
+        # distribution client mode the error bound of the server adds up.
+        self.error_bound_seconds = round(
+            median_half_took_times + 1 + self.upstream_error_bound, 2)
         message = "median          request_took_times: %+.2f" % \
             median_took_times
         LOGGER.info(message)
@@ -329,6 +844,17 @@ class SdwdateClass(object):
             % self.median_diff_lag_cleaned_in_seconds
         )
         LOGGER.info(message)
+        message = "error bound                       : %.2f" % \
+            self.error_bound_seconds
+        LOGGER.info(message)
+
+        STATUS_SNAPSHOT.update(
+            median_offset=self.median_diff_raw_in_seconds,
+            error_bound=self.error_bound_seconds
+        )
+        METRICS.set_gauge(
+            "median_offset_seconds", self.median_diff_raw_in_seconds)
+        METRICS.set_gauge("error_bound_seconds", self.error_bound_seconds)
 
 
     def time_replay_protection_file_write(self):
@@ -373,6 +899,7 @@ class SdwdateClass(object):
         status_first_success = os.path.exists(status_first_success_path)
         clock_jump_do = os.path.exists(clock_jump_do_once_file)
 
+        self.set_boottime = boottime_seconds()
         old_unixtime_float = time.time()
         old_unixtime_int = round(old_unixtime_float)
         old_unixtime_int = int(old_unixtime_int)
@@ -383,6 +910,7 @@ class SdwdateClass(object):
         new_unixtime_int = round(new_unixtime_float)
         new_unixtime_int = int(new_unixtime_int)
         new_unixtime_str = format(new_unixtime_float, ".9f")
+        self.set_unixtime = new_unixtime_float
 
         old_unixtime_human_readable = time_human_readable(
             old_unixtime_int
@@ -431,14 +959,25 @@ class SdwdateClass(object):
             write_status(icon, message)
             return False
 
-        if not status_first_success:
+        ntp_shm_unit = ntp_shm_config()
+
+        if self.measure_only:
+            return self.report_measured_offset(
+                ntp_shm_unit, status_first_success, clock_jump_do)
+
+        if ntp_shm_unit is not None:
+            if not self.write_ntp_shm(ntp_shm_unit, status_first_success):
+                return False
+        elif not status_first_success:
             self.set_time_using_date(new_unixtime_str)
         elif clock_jump_do:
             self.set_time_using_date(new_unixtime_str)
         else:
             self.run_sclockadj()
 
-        if not status_first_success:
+        # NTP SHM: created by ntp_shm_disciplined once the NTP daemon
+        # corrected the clock.
+        if not status_first_success and ntp_shm_unit is None:
             file_object = open(status_first_success_path, "w")
             file_object.close()
 
@@ -452,14 +991,47 @@ class SdwdateClass(object):
         return True
 
 
+    def report_measured_offset(self, ntp_shm_unit, status_first_success,
+                               clock_jump_do):
+        """
+        MEASURE_ONLY. Instead of set_time_using_date, run_sclockadj or
+        write_ntp_shm, log what would have been done. Does not create
+        first_success, which would end timesync-fail-closed mode, nor
+        success, which says the time was set.
+        """
+        global measured_first_success
+        if ntp_shm_unit is not None:
+            method = "NTP SHM unit " + str(ntp_shm_unit)
+        elif not (status_first_success or measured_first_success):
+            method = "/bin/date"
+        elif clock_jump_do:
+            method = "/bin/date"
+        else:
+            method = "sclockadj"
+        message = (
+            "Measure only: would have applied offset %+.9f seconds using %s."
+            % (self.new_diff_in_seconds, method)
+            + " error bound: " + str(self.error_bound_seconds)
+            + " seconds. Not setting time."
+        )
+        LOGGER.info(message)
+        measured_first_success = True
+
+        if clock_jump_do:
+            Path(clock_jump_do_once_file).unlink(missing_ok=True)
+        return True
+
+
     def add_or_subtract_nanoseconds(self):
         if randomize_time_config():
             LOGGER.info("Randomizing nanoseconds.")
             # nanoseconds = randint(0, self.range_nanoseconds)
-            nanoseconds = secrets.choice(self.range_nanoseconds)
+            nanoseconds = secure_choice(self.range_nanoseconds)
             # sign = randint(0, 1)
             sings = [0, 1]
-            sign = secrets.choice(sings)
+            sign = secure_choice(sings)
+            self.randomize_nanoseconds = nanoseconds
+            self.randomize_sign = sign
             seconds_to_add_or_subtract = (
                 float(nanoseconds) / 1000000000
             )
@@ -491,6 +1063,48 @@ class SdwdateClass(object):
             self.new_diff_in_seconds
         LOGGER.info(message)
 
+        STATUS_SNAPSHOT.update(new_diff=self.new_diff_in_seconds)
+        METRICS.set_gauge(
+            "applied_correction_seconds", self.new_diff_in_seconds)
+
+
+    def write_ntp_shm(self, ntp_shm_unit, status_first_success):
+        """
+        Leave setting the clock to chrony or ntpd using the
+        NTP shared memory reference clock driver. The median offset, without
+        randomized nanoseconds, is written now and then again every
+        REFRESH_INTERVAL_SECONDS until the next round. See ntp_shm.py.
+        """
+        if status_first_success:
+            on_disciplined = None
+        else:
+            on_disciplined = ntp_shm_disciplined
+        try:
+            precision = start_ntp_shm_refresher(
+                ntp_shm_unit,
+                self.median_diff_raw_in_seconds,
+                self.error_bound_seconds,
+                len(self.pool_results),
+                on_disciplined
+            )
+        except BaseException:
+            error_message = str(sys.exc_info()[0]) + " " + \
+                str(sys.exc_info()[1])
+            message = "NTP SHM: ERROR: " + error_message
+            LOGGER.error(message)
+            icon = "error"
+            write_status(icon, message)
+            return False
+        message = (
+            "NTP SHM unit "
+            + str(ntp_shm_unit)
+            + ": wrote offset: %+.9f precision: %s" %
+            (self.median_diff_raw_in_seconds, precision)
+            + ". Not setting time. Left to NTP daemon."
+        )
+        LOGGER.info(message)
+        return True
+
 
     def run_sclockadj(self):
         if self.new_diff_in_seconds == 0:
@@ -509,7 +1123,14 @@ class SdwdateClass(object):
 
         # Run sclockadj in a subshell.
         global sclockadj_process
+        count_child_process()
         sclockadj_process = Popen(sclockad_cmd)
+        threading.Thread(
+            target=wait_sclockadj,
+            args=(sclockadj_process, time.monotonic()),
+            name="wait_sclockadj",
+            daemon=True
+        ).start()
         message = (
             "Launched sclockadj into the background. PID: %s"
             % sclockadj_process.pid
@@ -534,6 +1155,7 @@ class SdwdateClass(object):
         # Avoid Popen shell=True.
         date_cmd = shlex.split(date_cmd)
 
+        count_child_process()
         bin_date_status = subprocess.Popen(
             date_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
@@ -555,6 +1177,103 @@ class SdwdateClass(object):
             exit_handler(exit_code, reason)
 
 
+    def time_distribution_fetch(self):
+        """
+        Client mode. Use the time of a trusted sdwdate instance running in
+        server mode (gateway) instead of fetching over Tor.
+        The same time sanity checks as for onion time sources apply.
+        returns:
+        True if a valid time was received, otherwise False. In that case the
+        caller falls back to fetching over Tor.
+        """
+        server_address = time_distribution_client_config()
+        if server_address is None:
+            return False
+
+        message = "Time distribution client: querying " + server_address
+        LOGGER.info(message)
+        boot_timeline_mark("first_fetch_sent")
+
+        url = "timedist://" + server_address
+        start_monotonic = time.monotonic()
+        from sdwdate.time_distribution import query_time_distribution_server
+        try:
+            payload, end_unixtime, took_time = query_time_distribution_server(
+                server_address,
+                time_distribution_key_file_config(),
+                time_distribution_max_age_config()
+            )
+        except BaseException:
+            error_message = str(sys.exc_info()[0]) + " " + \
+                str(sys.exc_info()[1])
+            message = "Time distribution client: ERROR: " + error_message + \
+                " Falling back to fetching over Tor."
+            LOGGER.warning(message)
+            METRICS.observe_request(
+                "time_distribution", url, "fallback",
+                round(time.monotonic() - start_monotonic, 2))
+            return False
+
+        server_unixtime = float(payload["server_unixtime"]) + \
+            float(payload["offset"])
+        remote_unixtime = int(server_unixtime)
+
+        timesanitycheck_status_static, timesanitycheck_error_static = \
+            static_time_sanity_check(remote_unixtime)
+        consensus_status, consensus_error, consensus_valid_after_str, \
+            consensus_valid_until_str = \
+            time_consensus_sanity_check(remote_unixtime)
+
+        if timesanitycheck_status_static != "sane" or \
+                consensus_status != "ok":
+            message = (
+                "Time distribution client: time sanity check failed. "
+                + "Time Replay Protection: "
+                + timesanitycheck_status_static
+                + " Tor Consensus Time Sanity Check: "
+                + consensus_status
+                + " " + consensus_error
+                + " Falling back to fetching over Tor."
+            )
+            LOGGER.warning(message)
+            METRICS.observe_request(
+                "time_distribution", url, "fallback", took_time)
+            return False
+
+        METRICS.observe_request("time_distribution", url, "ok", took_time)
+        half_took_time_float = round(float(took_time) / 2, 2)
+        time_diff_raw = round(server_unixtime - end_unixtime, 3)
+        time_diff_lag_cleaned_float = round(
+            time_diff_raw - half_took_time_float, 2)
+
+        self.upstream_error_bound = float(payload["error_bound"])
+        result = RemoteResult(
+            0, url, "ok", remote_unixtime, took_time, half_took_time_float,
+            time_diff_raw, time_diff_lag_cleaned_float)
+        self.results[url] = result
+        self.pool_results.append(result)
+        STATUS_SNAPSHOT.update(sources=self.source_results_snapshot())
+        boot_timeline_mark("first_valid_result")
+
+        message = (
+            "Time distribution client: "
+            + url
+            + " server_time: "
+            + time_human_readable(remote_unixtime)
+            + " took_time: "
+            + str(took_time)
+            + " seconds, time_diff_raw: "
+            + str(time_diff_raw)
+            + " seconds, server offset: "
+            + str(payload["offset"])
+            + " seconds, server error_bound: "
+            + str(payload["error_bound"])
+            + " seconds"
+        )
+        LOGGER.info(message)
+        return True
+
+
     def sdwdate_fetch_loop(self):
         """
         Check remotes.
@@ -584,23 +1303,40 @@ class SdwdateClass(object):
             message = strip_html(fetching_msg)
             LOGGER.info(message)
 
-        while True:
+        message = (
+            "pools: "
+            + str(self.number_of_pools)
+            + " pool_quorum: "
+            + str(self.pool_quorum)
+        )
+        LOGGER.info(message)
+
+        time_distribution_done = self.time_distribution_fetch()
+
+        while not time_distribution_done:
             self.iteration += 1
+            HEARTBEAT.enter("fetching", fetch_deadline_seconds())
             message = "Running sdwdate fetch loop. iteration: %s" % self.iteration
             LOGGER.info(message)
+            STATUS_SNAPSHOT.update(fetch_iteration=self.iteration)
 
             # Clear the lists.
-            self.list_of_urls_returned[:] = []
+            self.remote_results = []
             self.list_of_url_random_requested[:] = []
 
             for pool in self.pools:
-                if pool.done:
+                if pool.done or pool.exhausted:
                     continue
                 pool_size = len(pool.url)
                 while True:
                     # url_index = random.randrange(0, pool_size)
                     values = list(range(0, pool_size))
-                    url_index = secrets.choice(values)
+                    if self.probe is not None:
+                        # Pool members known to be reachable first.
+                        values = SOURCE_HEALTH.preferred_indices(
+                            pool.url, pool.already_picked_index,
+                            self.probe[3]) or values
+                    url_index = secure_choice(values)
                     # print("pool_size: " + str(pool_size))
                     if url_index not in pool.already_picked_index:
                         # print("AAA str(len(pool.already_picked_index)): " \
@@ -612,7 +1348,15 @@ class SdwdateClass(object):
                         # print("BBB str(len(pool.already_picked_index)): " \
                         # + \
                         # str(len(pool.already_picked_index)))
-                        pool_number = self.pools.index(pool)
+                        pool.exhausted = True
+                        break
+                    # if url_index in pool.already_picked_index:
+                        # print("CCC str(len(pool.already_picked_index)): " \
+                        # + \
+                        # str(len(pool.already_picked_index)))
+                if pool.exhausted:
+                    pool_number = self.pools.index(pool)
+                    if self.pools_possible() < self.pool_quorum:
                         message = (
                             "pool "
                             + str(pool_number)
@@ -626,10 +1370,17 @@ class SdwdateClass(object):
                         LOGGER.error(stripped_message)
                         write_status(icon, message)
                         return status
-                    # if url_index in pool.already_picked_index:
-                        # print("CCC str(len(pool.already_picked_index)): " \
-                        # + \
-                        # str(len(pool.already_picked_index)))
+                    message = (
+                        "pool "
+                        + str(pool_number)
+                        + ": no valid time from any url. Pools which can "
+                        + "still return a valid time: "
+                        + str(self.pools_possible())
+                        + " pool_quorum: "
+                        + str(self.pool_quorum)
+                    )
+                    LOGGER.warning(message)
+                    continue
                 already_picked_number = len(pool.already_picked_index)
 
                 message = (
@@ -646,6 +1397,8 @@ class SdwdateClass(object):
                 )
                 LOGGER.info(message)
 
+                self.url_pool_number[pool.url[url_index]] = \
+                    self.pools.index(pool)
                 pool.url_random_pool.append(pool.url[url_index])
                 self.list_of_url_random_requested.append(pool.url[url_index])
 
@@ -661,22 +1414,54 @@ class SdwdateClass(object):
 
             message = "requested urls %s" % self.list_of_url_random_requested
             LOGGER.info(message)
+            boot_timeline_mark("first_fetch_sent")
 
-            self.list_of_urls_returned, \
-                self.list_of_status, \
-                self.list_of_unixtimes, \
-                self.list_of_took_time, \
-                self.list_of_half_took_time, \
-                self.list_off_time_diff_raw_int, \
-                self.list_off_time_diff_lag_cleaned_float, \
-                = get_time_from_servers(
+            # Each result is handled as soon as it is checked, while the
+            # other time sources are still being fetched.
+            for result in iter_time_from_servers(
                     self.pools,
                     self.list_of_url_random_requested,
                     proxy_ip,
-                    proxy_port
+                    proxy_port,
+                    proxy_scheduler,
+                    self.url_pool_number,
+                    self.iteration):
+                HEARTBEAT.enter("fetching", fetch_deadline_seconds())
+                self.results[result.url] = result
+                self.remote_results.append(result)
+                # "done": answered, rejected by a time sanity check.
+                SOURCE_HEALTH.record(
+                    result.url, result.status in ("ok", "done"),
+                    result.took_time, "round")
+
+                METRICS.observe_request(
+                    result.pool,
+                    result.url,
+                    result.status,
+                    result.took_time
                 )
+                send_source_record(
+                    result.pool,
+                    result.url,
+                    result.status,
+                    result.took_time,
+                    result.time_diff_raw,
+                    result.time_diff_lag_cleaned
+                )
+
+                # Example result.url:
+                # http://sdolvtfhatvsysc6l34d65ymdwxcujausv7k5jk4cy5ttzhjoi6fzvyd.onion
+
+                if result.status == "ok":
+                    boot_timeline_mark("first_valid_result")
+                else:
+                    self.failed_urls.append(result.url)
+
+            if proxy_scheduler is not None:
+                message = "proxies: " + proxy_scheduler.summary()
+                LOGGER.info(message)
 
-            if self.list_of_urls_returned == []:
+            if self.remote_results == []:
                 message = translate_object(
                     "no_value_returned") + translate_object("restart")
                 stripped_message = strip_html(message)
@@ -686,33 +1471,17 @@ class SdwdateClass(object):
                 write_status(icon, message)
                 return status
 
-            message = 'returned urls "%s"' % self.list_of_urls_returned
+            message = 'returned urls "%s"' % [
+                result.url for result in self.remote_results]
             LOGGER.info(message)
             LOGGER.info("")
 
-            for i in range(len(self.list_of_urls_returned)):
-                returned_url_item_url = self.list_of_urls_returned[i]
-                returned_url_item_unixtime = self.list_of_unixtimes[i]
-                returned_url_item_took_time = self.list_of_took_time[i]
-                returned_url_item_took_status = self.list_of_status[i]
-
-                # Example returned_url_item_url:
-                # http://sdolvtfhatvsysc6l34d65ymdwxcujausv7k5jk4cy5ttzhjoi6fzvyd.onion
-
-                if returned_url_item_took_status == "ok":
-                    self.request_unixtimes[returned_url_item_url] = returned_url_item_unixtime
-                    self.request_took_times[returned_url_item_url] = returned_url_item_took_time
-                    self.valid_urls.append(returned_url_item_url)
-                    self.unixtimes.append(returned_url_item_unixtime)
-                    self.half_took_time_float[returned_url_item_url] = self.list_of_half_took_time[i]
-                    self.time_diff_raw_int[returned_url_item_url] = self.list_off_time_diff_raw_int[i]
-                    self.time_diff_lag_cleaned_float[returned_url_item_url] = self.list_off_time_diff_lag_cleaned_float[i]
-                else:
-                    self.failed_urls.append(returned_url_item_url)
+            STATUS_SNAPSHOT.update(sources=self.source_results_snapshot())
 
             if self.iteration >= 2:
-                if len(self.list_of_status) >= 3:
-                    if self.general_timeout_error(self.list_of_status):
+                statuses = [result.status for result in self.remote_results]
+                if len(statuses) >= self.number_of_pools:
+                    if self.general_timeout_error(statuses):
                         message = translate_object(
                             "general_timeout_error")
                         stripped_message = strip_html(message)
@@ -745,48 +1514,58 @@ class SdwdateClass(object):
                 if pool.done:
                     continue
                 for url in pool.url_random_pool:
-                    pool.done = url in self.valid_urls
+                    result = self.results.get(url)
+                    pool.done = result is not None and result.status == "ok"
                     if pool.done:
-                        pool_number = self.pools.index(pool)
-
-                        # Values are returned randomly. Get the index of the
-                        # url.
-                        web_unixtime = self.request_unixtimes[url]
-                        web_unixtime = int(web_unixtime)
-                        request_took_time_item = self.request_took_times[url]
-                        web_time = time_human_readable(web_unixtime)
-
-                        pool_diff = self.time_diff_raw_int[url]
-                        self.list_of_pools_raw_diff.append(pool_diff)
-
-                        # Rounding. Nanoseconds accuracy is impossible.
-                        # It is unknown if the time (seconds) reported by
-                        # remote servers was a
-                        # "early second" (0.000000000) or
-                        # "late second" (0.999999999).
-                        time_diff_lag_cleaned_int = round(
-                            self.time_diff_lag_cleaned_float[url]
-                        )
-                        self.pools_lag_cleaned_diff.append(
-                            time_diff_lag_cleaned_int)
+                        self.pool_results.append(result)
+                        web_time = time_human_readable(int(result.unixtime))
 
                         message = ""
-                        message += "pool " + str(pool_number)
+                        message += "pool " + str(result.pool)
                         message += ": " + url + ", "
                         message += "web_time: " + web_time + ","
                         message += " took_time: "
-                        message += str(request_took_time_item)
+                        message += str(result.took_time)
                         message += " seconds,"
-                        message += " time_diff_raw: " + str(pool_diff)
+                        message += " time_diff_raw: "
+                        message += str(result.time_diff_raw)
                         message += " seconds,"
                         message += " time_diff_lag_cleaned: "
-                        message += str(time_diff_lag_cleaned_int) + " seconds"
+                        message += str(round(result.time_diff_lag_cleaned))
+                        message += " seconds"
                         LOGGER.info(message)
 
-            # message = "len(self.valid_urls): " + str(len(self.valid_urls))
-            # LOGGER.info(message)
-            if len(self.valid_urls) >= self.number_of_pools:
-                break
+            if self.pools_done() >= self.pool_quorum:
+                # All pools: the median as always, even if some disagree.
+                if self.pools_agree() or \
+                        self.pools_done() >= self.number_of_pools:
+                    break
+                pool_diffs = [
+                    "%+.3f +/- %.2f" %
+                    (result.time_diff_raw, result.half_took_time + 1)
+                    for result in self.pool_results
+                ]
+                if self.pools_possible() <= self.pools_done():
+                    message = (
+                        "Time differences of pools "
+                        + str(pool_diffs)
+                        + " do not agree within their error bounds"
+                        + " and no other pool can return a valid time. "
+                        + translate_object("restart")
+                    )
+                    stripped_message = strip_html(message)
+                    icon = "error"
+                    status = "error"
+                    LOGGER.error(stripped_message)
+                    write_status(icon, message)
+                    return status
+                message = (
+                    "Time differences of pools "
+                    + str(pool_diffs)
+                    + " do not agree within their error bounds."
+                    + " Fetching from the remaining pools."
+                )
+                LOGGER.warning(message)
 
         message = "End fetching remote times."
         LOGGER.info(message)
@@ -802,9 +1581,14 @@ class SdwdateClass(object):
 
 
     def wait_sleep(self):
-        # If we make the sleep period configurable one day, we need to
-        # advice the user to also adjust WatchdogSec= in sdwdate's systemd
-        # unit file.
+        global resync_requested
+        if resync_requested:
+            resync_requested = False
+            self.woken_up_by_resync_request = True
+            message = "Resync requested. Not sleeping."
+            LOGGER.info(message)
+            return
+
         # minimum sleep time: 60 minutes
         sleep_time_minimum_seconds = 60 * 60
         # maximum sleep time: 180 minutes
@@ -814,7 +1598,7 @@ class SdwdateClass(object):
         # sleep_time_minimum_seconds, sleep_time_maximum_seconds
         # )
         values = list(range(sleep_time_minimum_seconds, sleep_time_maximum_seconds))
-        self.sleep_time_seconds = secrets.choice(values)
+        self.sleep_time_seconds = secure_choice(values)
 
         sleep_time_minutes = self.sleep_time_seconds / 60
         sleep_time_minutes_rounded = round(sleep_time_minutes)
@@ -827,10 +1611,11 @@ class SdwdateClass(object):
         stripped_message = strip_html(message)
         LOGGER.info(stripped_message)
 
-        SDNOTIFY_OBJECT.notify("WATCHDOG=1")
+        HEARTBEAT.enter(
+            "sleeping", self.sleep_time_seconds + SLEEP_MARGIN_SECONDS)
 
         #nanoseconds = randint(0, self.range_nanoseconds)
-        nanoseconds = secrets.choice(self.range_nanoseconds)
+        nanoseconds = secure_choice(self.range_nanoseconds)
 
         if self.sleep_time_seconds >= 10:
             file_object = open(sleep_long_file_path, "w")
@@ -838,6 +1623,14 @@ class SdwdateClass(object):
 
         self.unixtime_before_sleep = int(time.time())
 
+        STATUS_SNAPSHOT.update(
+            phase="sleeping",
+            next_wake_unixtime=self.unixtime_before_sleep +
+            self.sleep_time_seconds
+        )
+        METRICS.set_gauge("sleep_seconds", self.sleep_time_seconds)
+        write_metrics()
+
         # Using sh sleep in place of
         # python's time.sleep(self.sleep_time_seconds).
         # The latter uses the system clock for its inactive state time.
@@ -853,14 +1646,33 @@ class SdwdateClass(object):
         # Avoid Popen shell=True.
         sleep_cmd = shlex.split(sleep_cmd)
 
+        prober = start_prober(self.sleep_time_seconds)
+
         global sleep_process
+        count_child_process()
         sleep_process = Popen(sleep_cmd)
+        # Resync might have been requested after the check above but before
+        # sleep_process was available to the signal handler.
+        if resync_requested:
+            kill_sleep_process()
         sleep_process.wait()
 
+        if prober is not None:
+            stop_prober(prober)
+
+        if resync_requested:
+            resync_requested = False
+            self.woken_up_by_resync_request = True
+
 
     def check_clock_skew(self):
         unixtime_after_sleep = int(time.time())
         time_delta = unixtime_after_sleep - self.unixtime_before_sleep
+
+        if self.woken_up_by_resync_request:
+            message = "Woken up by resync request. Starting new round."
+            LOGGER.info(message)
+            return
         time_passed = self.sleep_time_seconds - time_delta
 
         if time_passed > 2:
@@ -933,6 +1745,21 @@ def global_files():
         sdwdate_status_files_folder + "/clock_jump_do_once"
     )
 
+    global profile_folder_path
+    profile_folder_path = sdwdate_status_files_folder + "/profile"
+
+    global control_socket_path
+    control_socket_path = sdwdate_status_files_folder + "/sdwdate.sock"
+
+    global transcript_folder_path
+    transcript_folder_path = sdwdate_status_files_folder + "/transcripts"
+
+    global boot_timeline_path
+    boot_timeline_path = sdwdate_status_files_folder + "/boot_timeline"
+
+    global last_round_path
+    last_round_path = sdwdate_status_files_folder + "/last_round"
+
     # Read by systemcheck.
     global msg_path
     msg_path = sdwdate_status_files_folder + "/msg"
@@ -948,11 +1775,6 @@ def global_files():
         + "/time-replay-protection-utc-humanreadable"
     )
 
-    translations_path = "/usr/share/translations/sdwdate.yaml"
-    translation = _translations(translations_path, "sdwdate")
-    global translate_object
-    translate_object = translation.gettext
-
     if not sdwdate_status_files_folder_split[-1] == "sdwdate":
         print("ERROR: home folder does not end with /sdwdate")
         print("ERROR: home_folder_split: " + str(home_folder_split))
@@ -988,6 +1810,10 @@ def main():
     sleep_process = []
     global sclockadj_process
     sclockadj_process = []
+    global control_server
+    control_server = None
+    global time_distribution_server
+    time_distribution_server = None
 
     global LOGGER
     LOGGER = logging.getLogger("sdwdate")
@@ -996,9 +1822,17 @@ def main():
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
     )
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    LOGGER.addHandler(console_handler)
+    if journal_structured_config():
+        # Native journald protocol. Timestamp, identifier and priority are
+        # journal fields already.
+        JOURNAL.enabled = True
+        journal_handler = JournalHandler()
+        journal_handler.setFormatter(logging.Formatter("%(message)s"))
+        LOGGER.addHandler(journal_handler)
+    else:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        LOGGER.addHandler(console_handler)
 
     my_pid = os.getpid()
     pid_message = "sdwdate (Secure Distributed Web Date) started. PID: %s" % my_pid
@@ -1017,8 +1851,68 @@ def main():
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
+    if HEARTBEAT.start(SDNOTIFY_OBJECT.notify, LOGGER.error):
+        message = "Watchdog heartbeat: WATCHDOG=1 every " + \
+            str(round(HEARTBEAT.interval_seconds)) + \
+            " seconds while within phase deadlines."
+    else:
+        message = "Watchdog heartbeat: disabled, WATCHDOG_USEC not set."
+    LOGGER.info(message)
+
     global_files()
 
+    if measure_only_config():
+        message = "Measure only: running rounds without setting the time."
+        LOGGER.info(message)
+        metrics_textfile = metrics_textfile_config()
+        if metrics_textfile is None:
+            message = (
+                "Measure only: metrics file disabled. METRICS_TEXTFILE "
+                + "belongs to the instance setting the time, use "
+                + "environment variable SDWDATE_METRICS_TEXTFILE."
+            )
+        else:
+            message = "Measure only: metrics file: " + metrics_textfile
+        LOGGER.info(message)
+        STATUS_SNAPSHOT.update(measure_only=True)
+        METRICS.set_gauge("measure_only", 1)
+
+    BOOT_TIMELINE.load(
+        boot_timeline_path, os.path.exists(status_first_success_path))
+    METRICS.set_gauge("boot_timeline_seconds", BOOT_TIMELINE.gauges())
+    if BOOT_TIMELINE.time_to_first_sync() is not None:
+        METRICS.set_gauge(
+            "time_to_first_sync_seconds", BOOT_TIMELINE.time_to_first_sync())
+    message = "Boot timeline: " + boot_timeline_path + " process_starts: " + \
+        str(BOOT_TIMELINE.process_starts) + " " + BOOT_TIMELINE.summary()
+    LOGGER.info(message)
+
+    # Registered after global_files() because resync_signal_handler uses
+    # clock_jump_do_once_file. Requests received by
+    # early_resync_signal_handler until now are kept.
+    signal.signal(signal.SIGUSR1, resync_signal_handler)
+    signal.signal(signal.SIGUSR2, resync_signal_handler)
+    if clock_jump_pending:
+        Path(clock_jump_do_once_file).touch()
+        message = "Signal SIGUSR2 received while starting. Resync using " + \
+            "clock jump requested."
+        LOGGER.info(message)
+    elif resync_requested:
+        message = "Signal SIGUSR1 received while starting. Resync requested."
+        LOGGER.info(message)
+
+    if control_socket_config():
+        try:
+            control_server = start_control_socket(
+                control_socket_path, STATUS_SNAPSHOT)
+            message = "Control socket: " + control_socket_path
+            LOGGER.info(message)
+        except BaseException:
+            error_message = str(sys.exc_info()[0])
+            message = "Could not create control socket. error: " + \
+                error_message
+            LOGGER.error(message)
+
     global proxy_ip, proxy_port
     proxy_ip, proxy_port = proxy_settings()
 
@@ -1028,6 +1922,47 @@ def main():
     )
     LOGGER.info(proxy_message)
 
+    # Multiple SOCKS endpoints. See PROXY_LIST.
+    global proxy_scheduler
+    proxy_scheduler = None
+    proxy_list = proxy_list_settings()
+    if len(proxy_list) > 1:
+        proxy_scheduler = ProxyScheduler(proxy_list)
+        proxy_ip, proxy_port = proxy_list[0]
+        message = "Tor socks endpoints: " + " ".join(
+            ip_address + ":" + port_number
+            for ip_address, port_number in proxy_list
+        )
+        LOGGER.info(message)
+
+    time_distribution_server_address = time_distribution_server_config()
+    if time_distribution_server_address is not None:
+        from sdwdate.time_distribution import start_time_distribution_server
+        try:
+            time_distribution_server = start_time_distribution_server(
+                time_distribution_server_address,
+                time_distribution_key_file_config()
+            )
+            message = "Time distribution server: listening on " + \
+                time_distribution_server_address
+            LOGGER.info(message)
+        except BaseException:
+            error_message = str(sys.exc_info()[0]) + " " + \
+                str(sys.exc_info()[1])
+            message = "Time distribution server: ERROR: " + error_message
+            LOGGER.error(message)
+
+    if warm_restart():
+        # Replaces "stopped by user or system" of the previous process.
+        write_status("success", translate_object("success"))
+        sdwdate_obj = SdwdateClass()
+        STATUS_SNAPSHOT.update(phase="sleeping", round=0)
+        with span("wait_sleep"):
+            sdwdate_obj.wait_sleep()
+        HEARTBEAT.enter("woken_up")
+        sdwdate_obj.check_clock_skew()
+        del sdwdate_obj
+
     loop_counter = 0
     loop_max = 10000
 
@@ -1039,13 +1974,34 @@ def main():
         msg = "Running sdwdate main loop. iteration: " + str(loop_counter)
         LOGGER.info(msg)
 
+        ROUND_SPANS.reset(span_timing_config())
+        JOURNAL.set_context(SDWDATE_ROUND=loop_counter)
+        set_compact_log(log_compact_config())
+        TRANSCRIPT.reset(transcript_record_config())
+
+        profile_rounds, profile_modes = profile_config()
+        ROUND_PROFILER.configure(profile_rounds, profile_modes)
+        profiling = ROUND_PROFILER.start()
+        if profiling:
+            message = "Profiling this round. modes: " + \
+                ",".join(ROUND_PROFILER.modes)
+            LOGGER.info(message)
+
         sdwdate_obj = SdwdateClass()
 
-        sdwdate_obj.preparation()
+        STATUS_SNAPSHOT.update(
+            phase="preparation",
+            round=loop_counter,
+            fetch_iteration=0,
+            next_wake_unixtime=None
+        )
+        with span("preparation"):
+            sdwdate_obj.preparation()
+        boot_timeline_mark("tor_ready")
 
         msg_for_sdnotify = "STATUS=" + msg
         SDNOTIFY_OBJECT.notify(msg_for_sdnotify)
-        SDNOTIFY_OBJECT.notify("WATCHDOG=1")
+        HEARTBEAT.enter("fetching", fetch_deadline_seconds())
 
         Path(sleep_long_file_path).unlink(missing_ok=True)
         Path(fail_file_path).unlink(missing_ok=True)
@@ -1056,24 +2012,94 @@ def main():
         # print("main allowed_failures: " + str(x))
         # sys.exit(0)
 
-        sdwdate_status_fl = sdwdate_obj.sdwdate_fetch_loop()
+        STATUS_SNAPSHOT.update(phase="fetching", sources=[])
+        with span("sdwdate_fetch_loop"):
+            sdwdate_status_fl = sdwdate_obj.sdwdate_fetch_loop()
 
-        SDNOTIFY_OBJECT.notify("WATCHDOG=1")
+        HEARTBEAT.enter("setting_time")
 
         if sdwdate_status_fl == "success":
-            sdwdate_obj.build_median()
-            sdwdate_obj.add_or_subtract_nanoseconds()
-            status_set_net_time = sdwdate_obj.set_new_time()
+            STATUS_SNAPSHOT.update(phase="setting_time")
+            with span("build_median"):
+                sdwdate_obj.build_median()
+            with span("add_or_subtract_nanoseconds"):
+                sdwdate_obj.add_or_subtract_nanoseconds()
+            with span("set_new_time"):
+                status_set_net_time = sdwdate_obj.set_new_time()
             if status_set_net_time:
-                sdwdate_obj.time_replay_protection_file_write()
+                # MEASURE_ONLY: the time was not set. Keep time replay
+                # protection, clients and the last round file as they are.
+                if not sdwdate_obj.measure_only:
+                    # NTP SHM: marked by ntp_shm_disciplined.
+                    if ntp_shm_config() is None:
+                        boot_timeline_mark("first_time_set")
+                    with span("time_replay_protection_file_write"):
+                        sdwdate_obj.time_replay_protection_file_write()
+                    if time_distribution_server is not None:
+                        # Clients get the time this round determined, not
+                        # the clock, which sclockadj or chrony may still be
+                        # correcting.
+                        time_distribution_server.publish(
+                            sdwdate_obj.set_unixtime,
+                            sdwdate_obj.set_boottime,
+                            sdwdate_obj.error_bound_seconds
+                        )
+                    write_last_round_file(sdwdate_obj)
             else:
                 sdwdate_status_fl = "error"
 
         if sdwdate_status_fl == "error":
             file_object = open(fail_file_path, "w")
             file_object.close()
+        elif sdwdate_obj.measure_only:
+            METRICS.set_gauge(
+                "last_measurement_timestamp_seconds", round(time.time()))
+        else:
+            METRICS.set_gauge(
+                "last_success_timestamp_seconds", round(time.time()))
+
+        METRICS.observe_round(sdwdate_status_fl, sdwdate_obj.iteration)
+        send_round_record(
+            sdwdate_status_fl,
+            sdwdate_obj.iteration,
+            sdwdate_obj.median_diff_raw_in_seconds,
+            sdwdate_obj.new_diff_in_seconds,
+            sdwdate_obj.error_bound_seconds
+        )
+
+        HEARTBEAT.enter("round_end")
+        if TRANSCRIPT.enabled:
+            write_transcript(sdwdate_obj, sdwdate_status_fl, loop_counter)
+
+        if profiling:
+            try:
+                profile_files = ROUND_PROFILER.stop(
+                    profile_folder_path, loop_counter)
+                message = "Profile written: " + " ".join(profile_files)
+                LOGGER.info(message)
+            except BaseException:
+                error_message = str(sys.exc_info()[0]) + " " + \
+                    str(sys.exc_info()[1])
+                message = "Could not write profile. error: " + error_message
+                LOGGER.error(message)
+
+        if ROUND_SPANS.enabled:
+            import json
+            round_summary = ROUND_SPANS.summary()
+            round_summary["round"] = loop_counter
+            round_summary["status"] = sdwdate_status_fl
+            round_summary["fetch_iterations"] = sdwdate_obj.iteration
+            message = "ROUND SUMMARY: " + json.dumps(
+                round_summary, sort_keys=True, separators=(",", ":"))
+            LOGGER.info(message)
+
+        if memory_release_config():
+            HEARTBEAT.enter("memory_release")
+            release_round_memory(sdwdate_obj)
 
-        sdwdate_obj.wait_sleep()
+        with span("wait_sleep"):
+            sdwdate_obj.wait_sleep()
+        HEARTBEAT.enter("woken_up")
         sdwdate_obj.check_clock_skew()
         kill_sclockadj()
 
@@ -0,0 +1,412 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Deterministic discrete-event simulation of sdwdate.
+#
+# Runs the real sdwdate_fetch_loop (source selection, allowed failures),
+# check_remote (validation), build_median, add_or_subtract_nanoseconds and
+# set_new_time (date versus sclockadj policy) against a virtual clock and
+# simulated time sources. Only the following is simulated:
+# - url_to_unixtime (run_command): latency, Date header, failures, timeouts.
+# - Tor consensus and minimum-unixtime-show sanity check inputs.
+# - /bin/date and sclockadj: step or slew of the virtual local clock.
+# - wait_sleep: advances the virtual clock.
+#
+# The virtual clock keeps the true time and the offset of the local clock,
+# which drifts at a configurable rate. Nothing waits in real time, so months
+# of operation take seconds.
+#
+# Randomness is derived from the seed only, so a run can be repeated
+# exactly, regardless of thread scheduling inside iter_time_from_servers.
+#
+# Used by /usr/share/sdwdate/simulate.
+
+import sys
+sys.dont_write_bytecode = True
+
+import io
+import math
+import time
+import random
+import tempfile
+import contextlib
+
+from sdwdate.harness import SourceProfile
+from sdwdate.harness import configure_sdwdate_module
+from sdwdate.harness import fake_onion_host_name
+
+
+# sclockadj: 5000000 nanoseconds per second.
+SCLOCKADJ_SECONDS_PER_SECOND = 0.005
+
+# run_command timeout.
+URL_TO_UNIXTIME_TIMEOUT_SECONDS = 120
+
+# wait_sleep: 60 to 180 minutes.
+SLEEP_TIME_MINIMUM_SECONDS = 60 * 60
+SLEEP_TIME_MAXIMUM_SECONDS = 180 * 60
+
+# Tor consensus: valid-after at the full hour, valid-until three hours later.
+CONSENSUS_VALID_SECONDS = 3 * 3600
+
+# Tue, 17 May 2033 10:00:00 GMT, as in static_time_sanity_check.
+EXPIRATION_UNIXTIME = 1999936800
+
+# Thu, 01 Jan 2026 00:00:00 GMT
+DEFAULT_START_UNIXTIME = 1767225600
+
+
+class VirtualClock(object):
+    """
+    offset: local clock minus true time, seconds.
+    drift: seconds per second, for example 50 ppm = 0.00005.
+    """
+    def __init__(self, start_unixtime, offset, drift_ppm):
+        self.true_time = float(start_unixtime)
+        self.start_unixtime = float(start_unixtime)
+        self.offset = float(offset)
+        self.drift = drift_ppm / 1000000.0
+        self.slew_remaining = 0.0
+
+    def offset_after(self, seconds):
+        """
+        Offset and remaining slew after 'seconds' without changing state.
+        """
+        offset = self.offset + self.drift * seconds
+        slew_remaining = self.slew_remaining
+        if slew_remaining != 0:
+            slewed = min(abs(slew_remaining),
+                         SCLOCKADJ_SECONDS_PER_SECOND * seconds)
+            slewed = math.copysign(slewed, slew_remaining)
+            offset += slewed
+            slew_remaining -= slewed
+        return offset, slew_remaining
+
+    def advance(self, seconds):
+        self.offset, self.slew_remaining = self.offset_after(seconds)
+        self.true_time += seconds
+
+    def local_time(self):
+        return self.true_time + self.offset
+
+    def local_time_after(self, seconds):
+        return self.true_time + seconds + self.offset_after(seconds)[0]
+
+    def step(self, seconds):
+        self.offset += seconds
+
+    def slew(self, seconds):
+        self.slew_remaining = seconds
+
+    def stop_slew(self):
+        # kill_sclockadj
+        self.slew_remaining = 0.0
+
+
+class VirtualTimeModule(object):
+    """
+    Replaces the 'time' module in sdwdate.sdwdate and sdwdate.remote_times.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+
+    def time(self):
+        return self.clock.local_time()
+
+    def monotonic(self):
+        return self.clock.true_time - self.clock.start_unixtime
+
+    def sleep(self, seconds):
+        self.clock.advance(seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class SimulatedProcess(object):
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+class SimulatedRun(object):
+    """
+    One round trip of iter_time_from_servers. Requests run concurrently, so
+    the virtual clock advances by the slowest one afterwards.
+    """
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.longest_seconds = 0.0
+
+    def run_command(self, i, url_to_unixtime_command, remote,
+                    timeout_seconds=URL_TO_UNIXTIME_TIMEOUT_SECONDS):
+        simulation = self.simulation
+        clock = simulation.clock
+        profile = simulation.profiles[remote]
+        # Independent of the order in which threads call this.
+        random_object = random.Random(
+            str(simulation.seed) + ":" + str(simulation.batch_number) + ":" +
+            remote)
+        latency = profile.sample_latency(random_object)
+        outcome = profile.sample_outcome(random_object)
+
+        if outcome == "timeout":
+            took_time = timeout_seconds
+            self.longest_seconds = max(self.longest_seconds, took_time)
+            end_unixtime = clock.local_time_after(took_time)
+            return (SimulatedProcess(-9), "timeout", end_unixtime,
+                    took_time, "", "")
+
+        self.longest_seconds = max(self.longest_seconds, latency)
+        end_unixtime = clock.local_time_after(latency)
+        took_time = round(latency, 2)
+
+        if outcome == "failure":
+            return (SimulatedProcess(5), "done", end_unixtime, took_time, "",
+                    "connect error: simulated")
+
+        # The remote creates the Date header halfway.
+        remote_unixtime = int(clock.true_time + latency / 2 + profile.skew)
+        return (SimulatedProcess(0), "done", end_unixtime, took_time,
+                str(remote_unixtime), "")
+
+
+class Simulation(object):
+    """
+    profiles: list (pools) of lists (sources) of SourceProfile.
+    pool_quorum: as POOL_QUORUM. None: all pools.
+    """
+    def __init__(self, profiles, seed=0, initial_offset=0.0, drift_ppm=0.0,
+                 start_unixtime=DEFAULT_START_UNIXTIME, pool_quorum=None):
+        self.seed = seed
+        self.pool_quorum = pool_quorum
+        self.random_object = random.Random(seed)
+        self.clock = VirtualClock(start_unixtime, initial_offset, drift_ppm)
+        self.batch_number = 0
+        self.pool_urls = []
+        self.profiles = {}
+        for pool_number, pool_profiles in enumerate(profiles):
+            urls = []
+            for index, profile in enumerate(pool_profiles):
+                url = "http://" + fake_onion_host_name(pool_number, index)
+                urls.append(url)
+                self.profiles[url] = profile
+            self.pool_urls.append(urls)
+        # Minimum accepted by static_time_sanity_check.
+        self.minimum_unixtime = int(start_unixtime) - 30 * 86400
+        self.replay_protection_unixtime = self.minimum_unixtime
+
+    def time_replay_protection_file_read(self):
+        unixtime = self.replay_protection_unixtime - 100
+        return unixtime, time.strftime(
+            "%a %b %d %H:%M:%S UTC %Y", time.gmtime(unixtime))
+
+    def static_time_sanity_check(self, unixtime_to_validate):
+        if unixtime_to_validate < self.minimum_unixtime:
+            return "slow", "none"
+        if unixtime_to_validate > EXPIRATION_UNIXTIME:
+            return "fast", "none"
+        return "sane", "none"
+
+    def time_consensus_sanity_check(self, unixtime):
+        valid_after = int(self.clock.true_time // 3600 * 3600)
+        valid_until = valid_after + CONSENSUS_VALID_SECONDS
+        status = "ok"
+        if not int(unixtime) > valid_after:
+            status = "slow"
+        if int(unixtime) > valid_until:
+            status = "fast"
+        return (
+            status,
+            "",
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(valid_after)),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(valid_until)),
+        )
+
+    def iter_time_from_servers(self, *args, **kwargs):
+        simulated_run = SimulatedRun(self)
+        self.remote_times.run_command = simulated_run.run_command
+        yield from self.real_iter_time_from_servers(*args, **kwargs)
+        self.clock.advance(simulated_run.longest_seconds)
+        self.batch_number += 1
+
+    def install(self, status_folder):
+        from sdwdate import remote_times
+
+        sdwdate_module = configure_sdwdate_module(
+            status_folder, self.pool_urls, "127.0.0.1", "9050",
+            self.pool_quorum)
+        sdwdate_module.LOGGER.disabled = True
+        virtual_time = VirtualTimeModule(self.clock)
+
+        self.remote_times = remote_times
+        remote_times.time = virtual_time
+        remote_times.time_replay_protection_file_read = \
+            self.time_replay_protection_file_read
+        remote_times.static_time_sanity_check = self.static_time_sanity_check
+        remote_times.time_consensus_sanity_check = \
+            self.time_consensus_sanity_check
+
+        self.real_iter_time_from_servers = remote_times.iter_time_from_servers
+        sdwdate_module.iter_time_from_servers = self.iter_time_from_servers
+        sdwdate_module.time = virtual_time
+        sdwdate_module.secure_choice = self.random_object.choice
+        sdwdate_module.time_replay_protection_file_read = \
+            self.time_replay_protection_file_read
+        sdwdate_module.ntp_shm_config = lambda: None
+        sdwdate_module.measure_only_config = lambda: False
+
+        clock = self.clock
+
+        class SimulatedSdwdate(sdwdate_module.SdwdateClass):
+            def set_time_using_date(self, new_unixtime_str):
+                clock.stop_slew()
+                clock.step(self.new_diff_in_seconds)
+
+            def run_sclockadj(self):
+                clock.slew(self.new_diff_in_seconds)
+
+            def time_distribution_fetch(self):
+                return False
+
+        self.sdwdate_class = SimulatedSdwdate
+
+    def run_round(self):
+        """
+        One iteration of the main loop of sdwdate without preparation.
+        Returns status, fetch iterations.
+        """
+        sdwdate_obj = self.sdwdate_class()
+        status = sdwdate_obj.sdwdate_fetch_loop()
+        if status == "success":
+            sdwdate_obj.build_median()
+            sdwdate_obj.add_or_subtract_nanoseconds()
+            if sdwdate_obj.set_new_time():
+                # time_replay_protection_file_write
+                self.replay_protection_unixtime = int(self.clock.local_time())
+            else:
+                status = "error"
+        return status, sdwdate_obj.iteration
+
+    def sleep(self):
+        # wait_sleep, then kill_sclockadj.
+        self.clock.advance(self.random_object.randrange(
+            SLEEP_TIME_MINIMUM_SECONDS, SLEEP_TIME_MAXIMUM_SECONDS))
+        self.clock.stop_slew()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    sorted_values = sorted(values)
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return round(sorted_values[index], 3)
+
+
+def run_trial(profiles, seed, days, initial_offset, drift_ppm, tolerance,
+              pool_quorum=None):
+    """
+    Returns a dict with the results of one simulated sdwdate run.
+    In sync means at least one successful round and an offset within
+    tolerance.
+    """
+    simulation = Simulation(
+        profiles, seed=seed, initial_offset=initial_offset,
+        drift_ppm=drift_ppm, pool_quorum=pool_quorum)
+    clock = simulation.clock
+    end_time = clock.true_time + days * 86400
+
+    rounds = 0
+    successes = 0
+    convergence_seconds = None
+    residual_offsets = []
+
+    with tempfile.TemporaryDirectory(prefix="sdwdate-simulate-") as status_folder:
+        simulation.install(status_folder)
+        # remote_times and sdwdate log every detail. Discard.
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            while clock.true_time < end_time:
+                if convergence_seconds is not None:
+                    residual_offsets.append(abs(clock.offset))
+                elif successes > 0 and abs(clock.offset) <= tolerance:
+                    convergence_seconds = \
+                        clock.true_time - clock.start_unixtime
+                status, fetch_iterations = simulation.run_round()
+                rounds += 1
+                if status == "success":
+                    successes += 1
+                # Stepped using /bin/date.
+                if convergence_seconds is None and successes > 0 and \
+                        abs(clock.offset) <= tolerance:
+                    convergence_seconds = \
+                        clock.true_time - clock.start_unixtime
+                simulation.sleep()
+                output.seek(0)
+                output.truncate()
+
+    return {
+        "seed": seed,
+        "rounds": rounds,
+        "successes": successes,
+        "converged": convergence_seconds is not None,
+        "convergence_seconds": convergence_seconds,
+        "residual_offsets": residual_offsets,
+        "final_offset": clock.offset,
+    }
+
+
+def summarize_trials(trials):
+    rounds = sum(trial["rounds"] for trial in trials)
+    successes = sum(trial["successes"] for trial in trials)
+    converged = [trial for trial in trials if trial["converged"]]
+    convergence_seconds = [
+        trial["convergence_seconds"] for trial in converged
+    ]
+    residual_offsets = []
+    for trial in trials:
+        residual_offsets.extend(trial["residual_offsets"])
+    return {
+        "trials": len(trials),
+        "rounds": rounds,
+        "successes": successes,
+        "rounds_per_success":
+            round(rounds / successes, 3) if successes else None,
+        "failure_to_sync_probability":
+            round(1 - len(converged) / len(trials), 4) if trials else None,
+        "convergence_seconds_p50": percentile(convergence_seconds, 0.5),
+        "convergence_seconds_p95": percentile(convergence_seconds, 0.95),
+        "residual_offset_seconds_p50": percentile(residual_offsets, 0.5),
+        "residual_offset_seconds_p95": percentile(residual_offsets, 0.95),
+        "residual_offset_seconds_max":
+            round(max(residual_offsets), 3) if residual_offsets else None,
+    }
+
+
+def build_profiles(number_of_pools, sources_per_pool, liar_ratio, liar_skew,
+                   dead_ratio, failure_rate, latency, latency_jitter):
+    """
+    Per pool: the first sources lie by liar_skew seconds, the next ones are
+    dead (always time out), the others are honest.
+    """
+    profiles = []
+    for pool_number in range(number_of_pools):
+        liars = int(round(sources_per_pool * liar_ratio))
+        dead = int(round(sources_per_pool * dead_ratio))
+        pool_profiles = []
+        for index in range(sources_per_pool):
+            if index < liars:
+                profile = SourceProfile(
+                    latency=latency, latency_jitter=latency_jitter,
+                    skew=liar_skew, failure_rate=failure_rate)
+            elif index < liars + dead:
+                profile = SourceProfile(
+                    latency=latency, latency_jitter=latency_jitter,
+                    timeout_rate=1.0)
+            else:
+                profile = SourceProfile(
+                    latency=latency, latency_jitter=latency_jitter,
+                    failure_rate=failure_rate)
+            pool_profiles.append(profile)
+        profiles.append(pool_profiles)
+    return profiles
@@ -0,0 +1,284 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Health of time sources (pool members), kept between rounds.
+#
+# Updated by the results of sdwdate_fetch_loop and, if PROBE=true, by
+# BackgroundProber during wait_sleep. The prober sends header-only requests
+# (url_to_unixtime --batch --head) to a few pool members at random times
+# spread over the sleep interval, stalest members first.
+#
+# Budgets of the prober:
+# - at most PROBE_CONCURRENCY requests at the same time,
+# - at most PROBE_BYTES_PER_HOUR bytes received within any hour. Before
+#   each probe the expected bytes are reserved, using the average of
+#   previous probes.
+#
+# With PROBE=true, sdwdate_fetch_loop picks pool members which answered
+# within PROBE_MAX_AGE seconds first, then members not known to be
+# unreachable, then any.
+
+import sys
+sys.dont_write_bytecode = True
+
+import time
+import threading
+import subprocess
+import collections
+
+
+# Seconds per header-only request. Lower than the url_to_unixtime timeout
+# of rounds, a probe should not hold a Tor circuit for long.
+PROBE_TIMEOUT_SECONDS = 60
+
+# Bytes reserved per probe until probes were measured. A HEAD reply of a
+# typical onion is a few hundred bytes.
+PROBE_BYTES_ESTIMATE = 1024
+
+BYTES_WINDOW_SECONDS = 3600
+
+
+class SourceHealthRecord(object):
+    __slots__ = ("alive", "monotonic", "took_time", "origin")
+
+    def __init__(self, alive, monotonic, took_time, origin):
+        self.alive = alive
+        self.monotonic = monotonic
+        self.took_time = took_time
+        # "round" or "probe".
+        self.origin = origin
+
+
+class SourceHealth(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        # [monotonic, bytes] of probes within BYTES_WINDOW_SECONDS.
+        self.probe_bytes = collections.deque()
+        self.probe_bytes_average = None
+
+    def record(self, url, alive, took_time, origin):
+        with self.lock:
+            self.records[url] = SourceHealthRecord(
+                alive, time.monotonic(), took_time, origin)
+
+    def state(self, url, max_age):
+        """
+        Returns True (answered), False (did not answer) or None (unknown or
+        older than max_age seconds).
+        """
+        with self.lock:
+            record = self.records.get(url)
+        if record is None or time.monotonic() - record.monotonic > max_age:
+            return None
+        return record.alive
+
+    def preferred_indices(self, urls, excluded_indices, max_age):
+        """
+        Indices of urls, not in excluded_indices, which answered within
+        max_age seconds. If none, those not known to be unreachable. Empty
+        list if all remaining are known to be unreachable.
+        """
+        alive = []
+        unknown = []
+        for index, url in enumerate(urls):
+            if index in excluded_indices:
+                continue
+            state = self.state(url, max_age)
+            if state is True:
+                alive.append(index)
+            elif state is None:
+                unknown.append(index)
+        return alive or unknown
+
+    def stalest(self, urls, count):
+        """
+        Up to count urls, never checked first, then least recently checked.
+        Random order among equally stale urls.
+        """
+        import secrets
+        shuffled = list(urls)
+        secrets.SystemRandom().shuffle(shuffled)
+        with self.lock:
+            ages = {
+                url: self.records[url].monotonic if url in self.records
+                else float("-inf")
+                for url in shuffled
+            }
+        shuffled.sort(key=lambda url: ages[url])
+        return shuffled[:count]
+
+    def summary(self, max_age):
+        with self.lock:
+            urls = list(self.records)
+        states = [self.state(url, max_age) for url in urls]
+        return {
+            "alive": states.count(True),
+            "unreachable": states.count(False),
+            "unknown": states.count(None),
+        }
+
+    def probe_bytes_last_hour(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.probe_bytes and \
+                    now - self.probe_bytes[0][0] > BYTES_WINDOW_SECONDS:
+                self.probe_bytes.popleft()
+            return sum(item[1] for item in self.probe_bytes)
+
+    def reserve_probe_bytes(self, number_of_bytes):
+        """
+        Returns the entry to pass to settle_probe_bytes.
+        """
+        entry = [time.monotonic(), number_of_bytes]
+        with self.lock:
+            self.probe_bytes.append(entry)
+        return entry
+
+    def settle_probe_bytes(self, entry, number_of_bytes):
+        with self.lock:
+            entry[1] = number_of_bytes
+
+    def record_probe_size(self, number_of_bytes):
+        with self.lock:
+            if self.probe_bytes_average is None:
+                self.probe_bytes_average = float(number_of_bytes)
+            else:
+                self.probe_bytes_average = \
+                    0.7 * self.probe_bytes_average + 0.3 * number_of_bytes
+
+    def probe_bytes_estimate(self):
+        with self.lock:
+            if self.probe_bytes_average is None:
+                return PROBE_BYTES_ESTIMATE
+            return max(int(self.probe_bytes_average), 1)
+
+
+SOURCE_HEALTH = SourceHealth()
+
+
+def probe_schedule(sleep_seconds, probes_per_hour):
+    """
+    Random offsets (seconds) within the sleep interval, sorted. None within
+    the last PROBE_TIMEOUT_SECONDS, the probe would be cut short by waking.
+    """
+    window = sleep_seconds - PROBE_TIMEOUT_SECONDS
+    if window <= 0 or probes_per_hour <= 0:
+        return []
+    import secrets
+    number_of_probes = round(probes_per_hour * sleep_seconds / 3600)
+    random_object = secrets.SystemRandom()
+    return sorted(
+        random_object.uniform(0, window) for i in range(number_of_probes))
+
+
+class BackgroundProber(object):
+    """
+    Probes urls (list of pool member urls) during one sleep interval.
+    proxy: function returning (ip address, port number) of a SOCKS port.
+    """
+    def __init__(self, urls, proxy, sleep_seconds, probes_per_hour,
+                 concurrency, bytes_per_hour, health=SOURCE_HEALTH):
+        self.urls = urls
+        self.proxy = proxy
+        self.schedule = probe_schedule(sleep_seconds, probes_per_hour)
+        self.concurrency = max(concurrency, 1)
+        self.bytes_per_hour = bytes_per_hour
+        self.health = health
+        self.stop_event = threading.Event()
+        self.process_lock = threading.Lock()
+        self.process = None
+        self.probes = 0
+        self.skipped_budget = 0
+        self.thread = threading.Thread(
+            target=self.run, name="sdwdate-prober", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        self.stop_event.set()
+        with self.process_lock:
+            if self.process is not None:
+                self.process.kill()
+        self.thread.join(timeout)
+
+    def run(self):
+        start = time.monotonic()
+        for offset in self.schedule:
+            if self.stop_event.wait(max(start + offset - time.monotonic(), 0)):
+                return
+            try:
+                self.probe_once()
+            except BaseException:
+                error_message = str(sys.exc_info()[0]) + " " + \
+                    str(sys.exc_info()[1])
+                print("source_health.py: probe error: " + error_message)
+
+    def budget_count(self):
+        """
+        Number of urls which can be probed now within the bytes budget.
+        """
+        estimate = self.health.probe_bytes_estimate()
+        available = self.bytes_per_hour - self.health.probe_bytes_last_hour()
+        return max(min(self.concurrency, available // estimate), 0)
+
+    def probe_once(self):
+        import json
+        count = self.budget_count()
+        if count <= 0:
+            self.skipped_budget += 1
+            print("source_health.py: probe skipped, bytes per hour budget "
+                  "of " + str(self.bytes_per_hour) + " reached")
+            return
+        urls = self.health.stalest(self.urls, count)
+        estimate = self.health.probe_bytes_estimate()
+        # Reserved first, replaced by the actual bytes once the results are
+        # in.
+        reservation = self.health.reserve_probe_bytes(estimate * len(urls))
+
+        proxy_ip, proxy_port = self.proxy()
+        command = [
+            "url_to_unixtime", "--batch", "--head",
+            "--concurrency", str(len(urls)),
+            "--timeout", str(PROBE_TIMEOUT_SECONDS),
+            proxy_ip, str(proxy_port),
+        ] + urls
+        with self.process_lock:
+            if self.stop_event.is_set():
+                self.health.settle_probe_bytes(reservation, 0)
+                return
+            self.process = subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True
+            )
+        received_bytes = 0
+        try:
+            for line in self.process.stdout:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                alive = result.get("status") == "ok"
+                self.health.record(
+                    result.get("url"), alive,
+                    result.get("phases", {}).get("total"), "probe")
+                if result.get("bytes") is not None:
+                    received_bytes += result["bytes"]
+                    self.health.record_probe_size(result["bytes"])
+                else:
+                    received_bytes += estimate
+                print("source_health.py: probe " + str(result.get("url")) +
+                      " alive: " + str(alive))
+            self.process.wait()
+        finally:
+            with self.process_lock:
+                self.process.stdout.close()
+                self.process = None
+        self.health.settle_probe_bytes(reservation, received_bytes)
+        self.probes += 1
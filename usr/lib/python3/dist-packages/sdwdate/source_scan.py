@@ -0,0 +1,269 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Scan of every member of every pool. Used by
+# /usr/share/sdwdate/onion-tester.
+#
+# Each source is fetched once, at most 'concurrency' at a time, each with
+# its own timeout. A full scan therefore takes about as long as the slowest
+# source, not the sum of all of them. Does not set the clock.
+#
+# scan_sources_batch: one 'url_to_unixtime --batch' process fetching all
+# sources using threads, results streamed as NDJSON.
+# scan_sources: one url_to_unixtime process per source using run_command
+# of remote_times.py, as sdwdate does.
+
+import sys
+sys.dont_write_bytecode = True
+
+import csv
+import json
+import math
+import time
+import threading
+import subprocess
+import concurrent.futures
+
+from sdwdate.config import read_pools
+from sdwdate.config import read_pool_definitions
+from sdwdate.remote_times import run_command
+from sdwdate.remote_times import build_url_to_unixtime_command
+
+
+SCAN_FIELDS = (
+    "pool", "pool_name", "url", "comment", "status", "took_time",
+    "date_skew", "bytes", "http_time", "error",
+)
+
+# One url_to_unixtime process per source.
+DEFAULT_CONCURRENCY = 20
+
+# Threads of one url_to_unixtime --batch process.
+DEFAULT_BATCH_CONCURRENCY = 64
+
+DEFAULT_TIMEOUT_SECONDS = 60
+
+
+class ScanResult(object):
+    __slots__ = SCAN_FIELDS
+
+    def __init__(self, pool, pool_name, url, comment):
+        self.pool = pool
+        self.pool_name = pool_name
+        self.url = url
+        self.comment = comment
+        self.status = None
+        self.took_time = None
+        # Seconds the remote Date header is ahead of the local clock,
+        # corrected by half of the request duration.
+        self.date_skew = None
+        self.bytes = None
+        self.http_time = None
+        self.error = ""
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in SCAN_FIELDS}
+
+
+def scan_targets():
+    """
+    Returns a ScanResult without results for every pool member, including
+    every member of multi-line pools.
+    """
+    targets = []
+    for pool_number, pool_definition in enumerate(read_pool_definitions()):
+        pool_name = pool_definition[0]
+        urls, comments = read_pools(pool_number, "test")
+        for url, comment in zip(urls, comments):
+            targets.append(ScanResult(pool_number, pool_name, url, comment))
+    return targets
+
+
+def parse_verbose_output(stderr):
+    """
+    Returns (http_time, bytes) from url_to_unixtime verbose output.
+    """
+    http_time = None
+    response_bytes = None
+    for line in stderr.splitlines():
+        if line.startswith("http_time: "):
+            http_time = line[len("http_time: "):]
+        elif line.startswith("bytes: "):
+            try:
+                response_bytes = int(line[len("bytes: "):])
+            except ValueError:
+                pass
+    return http_time, response_bytes
+
+
+def scan_source(i, result, proxy_ip, proxy_port, timeout_seconds):
+    url_to_unixtime_command = build_url_to_unixtime_command(
+        proxy_ip, proxy_port, result.url)
+    process, run_status, end_unixtime, took_time, stdout, stderr = \
+        run_command(i, url_to_unixtime_command, result.url, timeout_seconds)
+
+    result.took_time = took_time
+    result.http_time, result.bytes = parse_verbose_output(stderr)
+
+    if run_status == "timeout":
+        result.status = "timeout"
+        result.error = "no reply within " + str(timeout_seconds) + " seconds"
+        return result
+    if run_status != "done" or process.returncode != 0:
+        result.status = "error"
+        # First line, for example: connect error: ...
+        result.error = stderr.splitlines()[0] if stderr else \
+            "exit code " + str(process.returncode)
+        return result
+    try:
+        remote_unixtime = int(stdout)
+    except ValueError:
+        result.status = "error"
+        result.error = "unexpected output: " + stdout[:100]
+        return result
+
+    result.status = "ok"
+    result.date_skew = round(
+        remote_unixtime - (end_unixtime - took_time / 2), 2)
+    return result
+
+
+def scan_sources(targets, proxy_ip, proxy_port,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                 progress=None):
+    """
+    Fills in the results of targets (list of ScanResult). Calls
+    progress(result, done, total) as results arrive. Returns targets.
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(concurrency, 1)) as executor:
+        futures = [
+            executor.submit(
+                scan_source, i, result, proxy_ip, proxy_port,
+                timeout_seconds)
+            for i, result in enumerate(targets)
+        ]
+        done = 0
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            done += 1
+            if progress is not None:
+                progress(result, done, len(targets))
+    return targets
+
+
+def apply_batch_result(result, batch_result):
+    """
+    Fills in result (ScanResult) from one url_to_unixtime --batch line.
+    """
+    took_time = batch_result["phases"].get("total")
+    result.took_time = None if took_time is None else round(took_time, 2)
+    result.http_time = batch_result.get("http_time")
+    result.bytes = batch_result.get("bytes")
+    if batch_result["status"] == "ok":
+        result.status = "ok"
+        result.date_skew = round(
+            batch_result["unixtime"] -
+            (batch_result["end_unixtime"] - took_time / 2), 2)
+        return
+    if batch_result.get("error_class") == "timeout":
+        result.status = "timeout"
+    else:
+        result.status = "error"
+    # First line, for example: connect error: ...
+    result.error = str(batch_result.get("error"))
+
+
+def scan_sources_batch(targets, proxy_ip, proxy_port,
+                       concurrency=DEFAULT_BATCH_CONCURRENCY,
+                       timeout_seconds=DEFAULT_TIMEOUT_SECONDS,
+                       progress=None):
+    """
+    As scan_sources, using a single url_to_unixtime --batch process.
+    """
+    results_by_url = {}
+    for result in targets:
+        results_by_url.setdefault(result.url, []).append(result)
+    urls = list(results_by_url)
+
+    command = [
+        "url_to_unixtime", "--batch",
+        "--concurrency", str(concurrency),
+        "--timeout", str(timeout_seconds),
+        proxy_ip, str(proxy_port),
+    ]
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    )
+
+    # The requests timeout applies per connect and per read, not to the
+    # whole request. Kill the batch if it takes much longer than expected.
+    waves = math.ceil(len(urls) / max(concurrency, 1))
+    watchdog = threading.Timer(
+        waves * timeout_seconds * 2 + 30, process.kill)
+    watchdog.start()
+
+    done = 0
+    try:
+        process.stdin.write("\n".join(urls) + "\n")
+        process.stdin.close()
+        for line in process.stdout:
+            try:
+                batch_result = json.loads(line)
+            except ValueError:
+                continue
+            for result in results_by_url.get(batch_result.get("url"), []):
+                apply_batch_result(result, batch_result)
+                done += 1
+                if progress is not None:
+                    progress(result, done, len(targets))
+        process.wait()
+    finally:
+        watchdog.cancel()
+
+    for result in targets:
+        if result.status is None:
+            result.status = "error"
+            result.error = "no result from url_to_unixtime --batch, " + \
+                "exit code " + str(process.returncode)
+    return targets
+
+
+def summarize(targets, wall_seconds):
+    statuses = [result.status for result in targets]
+    took_times = [
+        result.took_time for result in targets if result.took_time is not None
+    ]
+    return {
+        "unixtime": int(time.time()),
+        "sources": len(targets),
+        "statuses": {
+            status: statuses.count(status) for status in sorted(set(statuses))
+        },
+        "wall_seconds": round(wall_seconds, 2),
+        "slowest_source_seconds": max(took_times) if took_times else None,
+        "sum_of_sources_seconds": round(sum(took_times), 2),
+    }
+
+
+def write_json(targets, summary, file_object):
+    report = dict(summary)
+    report["results"] = [result.as_dict() for result in targets]
+    json.dump(report, file_object, indent=2, sort_keys=True)
+    file_object.write("\n")
+
+
+def write_csv(targets, file_object):
+    writer = csv.writer(file_object)
+    writer.writerow(SCAN_FIELDS)
+    for result in targets:
+        writer.writerow([
+            "" if value is None else value
+            for value in (getattr(result, name) for name in SCAN_FIELDS)
+        ])
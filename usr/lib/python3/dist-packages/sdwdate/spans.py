@@ -0,0 +1,136 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Per round phase timing.
+#
+# with span("fetch_loop"):
+#     ...
+#
+# Durations are measured using the monotonic clock, which unlike time.time()
+# is not affected by sdwdate setting the clock. When disabled, span() returns
+# a shared no-op context manager.
+#
+# The summary is emitted before sleeping. Therefore phase "wait_sleep" of a
+# summary is the sleep that preceded the round.
+
+import sys
+sys.dont_write_bytecode = True
+
+import time
+import resource
+import threading
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    __slots__ = ("round_spans", "name", "start")
+
+    def __init__(self, round_spans, name):
+        self.round_spans = round_spans
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.round_spans.add(self.name, time.monotonic() - self.start)
+        return False
+
+
+class RoundSpans(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.reset(False)
+
+    def reset(self, enabled):
+        self.enabled = enabled
+        previous_sleep = getattr(self, "durations", {}).get("wait_sleep")
+        self.durations = {}
+        self.counts = {}
+        if enabled and previous_sleep is not None:
+            self.durations["wait_sleep"] = previous_sleep
+            self.counts["wait_sleep"] = 1
+        self.child_processes = 0
+        self.start_monotonic = time.monotonic()
+        if enabled:
+            self.rusage_self_start = resource.getrusage(resource.RUSAGE_SELF)
+            self.rusage_children_start = resource.getrusage(
+                resource.RUSAGE_CHILDREN)
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def add(self, name, duration):
+        # Spans of concurrent threads (url_to_unixtime) add up.
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0) + duration
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def count_child_process(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.child_processes += 1
+
+    def summary(self):
+        rusage_self = resource.getrusage(resource.RUSAGE_SELF)
+        rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self.lock:
+            phases_ms = {
+                name: round(duration * 1000, 1)
+                for name, duration in self.durations.items()
+            }
+            return {
+                "round_ms": round(
+                    (time.monotonic() - self.start_monotonic) * 1000, 1),
+                "phases_ms": phases_ms,
+                "phase_counts": dict(self.counts),
+                "child_processes": self.child_processes,
+                "cpu_self_ms": round(
+                    (rusage_self.ru_utime - self.rusage_self_start.ru_utime
+                     + rusage_self.ru_stime - self.rusage_self_start.ru_stime)
+                    * 1000, 1),
+                "cpu_children_ms": round(
+                    (rusage_children.ru_utime
+                     - self.rusage_children_start.ru_utime
+                     + rusage_children.ru_stime
+                     - self.rusage_children_start.ru_stime)
+                    * 1000, 1),
+                "maxrss_self_kib": rusage_self.ru_maxrss,
+                "maxrss_children_kib": rusage_children.ru_maxrss,
+            }
+
+
+ROUND_SPANS = RoundSpans()
+
+
+def span(name):
+    return ROUND_SPANS.span(name)
+
+
+def add_span(name, duration):
+    if ROUND_SPANS.enabled:
+        ROUND_SPANS.add(name, duration)
+
+
+def count_child_process():
+    ROUND_SPANS.count_child_process()
@@ -0,0 +1,213 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Time distribution from a trusted sdwdate instance (gateway, server mode) to
+# other sdwdate instances (workstations, client mode) so these do not each
+# need to fetch time over Tor.
+#
+# Protocol (TCP, one JSON object per line):
+# client: {"nonce": "<random hex>"}
+# server: {"payload": {...}, "mac": "<hex HMAC-SHA256 of payload>"}
+#
+# payload:
+# nonce          : echoed nonce of the client. Prevents replay of old replies.
+# server_unixtime: clock of the server when sending the reply.
+# offset         : correction the clock of the server still needs when
+#                  sending the reply. Not zero while sclockadj is still
+#                  slewing, before chrony applied an NTP SHM sample or if
+#                  sclockadj was stopped. server_unixtime + offset is the
+#                  time of the server.
+# round_unixtime : time, as determined by that round, when the last
+#                  validated round of the server ended.
+# error_bound    : error bound of that round in seconds. The client adds it
+#                  to its own.
+#
+# The time is not taken from the clock of the server, which lags behind
+# while a correction is applied, but from the last round: the time it
+# determined plus CLOCK_BOOTTIME elapsed since then.
+#
+# Trust model: the key authenticates replies as coming from a holder of the
+# key, not from the server. Every client holding the same key can
+# impersonate the server to all other clients holding it, for example a
+# compromised workstation answering on the internal network. Give every
+# client its own key and run one server instance, listening on an address
+# only that client can reach, per key. A single key shared by all clients
+# is only safe if all of them are trusted as much as the server.
+#
+# Example:
+# sudo -u sdwdate python3 /usr/lib/python3/dist-packages/sdwdate/time_distribution.py 10.152.152.10:9199 /etc/sdwdate.d/time-distribution.key
+
+import sys
+sys.dont_write_bytecode = True
+
+import json
+import hmac
+import time
+import socket
+import hashlib
+import secrets
+import threading
+import socketserver
+
+from sdwdate.boot_timeline import boottime_seconds
+
+
+REQUEST_MAX_LENGTH = 256
+REPLY_MAX_LENGTH = 4096
+CONNECTION_TIMEOUT_SECONDS = 10
+
+
+class TimeDistributionError(Exception):
+    pass
+
+
+def read_key(key_file_path):
+    with open(key_file_path, "rb") as key_file:
+        key = key_file.read().strip()
+    if len(key) < 32:
+        raise TimeDistributionError(
+            "key too short, need at least 32 bytes: " + key_file_path)
+    return key
+
+
+def split_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def payload_mac(key, payload):
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hmac.new(key, canonical.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+class TimeDistributionRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.request.settimeout(CONNECTION_TIMEOUT_SECONDS)
+        try:
+            request = json.loads(self.rfile.readline(REQUEST_MAX_LENGTH))
+            nonce = str(request["nonce"])
+        except BaseException:
+            return
+
+        with self.server.lock:
+            state = self.server.state
+
+        if state is None:
+            reply = {"error": "no validated round yet"}
+        else:
+            server_unixtime = time.time()
+            elapsed = boottime_seconds() - state["reference_boottime"]
+            payload = {
+                "nonce": nonce,
+                "server_unixtime": server_unixtime,
+                "offset": round(
+                    state["reference_unixtime"] + elapsed - server_unixtime,
+                    6),
+                "round_unixtime": state["reference_unixtime"],
+                "error_bound": state["error_bound"],
+            }
+            reply = {
+                "payload": payload,
+                "mac": payload_mac(self.server.key, payload),
+            }
+
+        self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+
+class TimeDistributionServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.state = None
+        socketserver.TCPServer.__init__(
+            self, split_address(address), TimeDistributionRequestHandler)
+
+    def publish(self, reference_unixtime, reference_boottime, error_bound):
+        """
+        reference_unixtime: time determined by a validated round at
+        CLOCK_BOOTTIME reference_boottime, whether or not the clock has
+        been corrected yet.
+        """
+        with self.lock:
+            self.state = {
+                "reference_unixtime": reference_unixtime,
+                "reference_boottime": reference_boottime,
+                "error_bound": error_bound,
+            }
+
+
+def start_time_distribution_server(address, key_file_path):
+    server = TimeDistributionServer(address, read_key(key_file_path))
+    thread = threading.Thread(
+        target=server.serve_forever, name="time_distribution", daemon=True)
+    thread.start()
+    return server
+
+
+def query_time_distribution_server(address, key_file_path, max_age_seconds):
+    """
+    Returns the authenticated payload of the server plus
+    end_unixtime and took_time of the request. The time of the server is
+    server_unixtime + offset.
+    Raises TimeDistributionError if the reply cannot be trusted.
+    """
+    key = read_key(key_file_path)
+    nonce = secrets.token_hex(16)
+
+    start_unixtime = time.time()
+    with socket.create_connection(
+            split_address(address), CONNECTION_TIMEOUT_SECONDS) as connection:
+        connection.sendall(
+            json.dumps({"nonce": nonce}).encode("utf-8") + b"\n")
+        with connection.makefile("rb") as reader:
+            line = reader.readline(REPLY_MAX_LENGTH)
+    end_unixtime = time.time()
+    took_time = round(end_unixtime - start_unixtime, 2)
+
+    try:
+        reply = json.loads(line)
+    except ValueError:
+        raise TimeDistributionError("malformed reply")
+
+    if "error" in reply:
+        raise TimeDistributionError("server error: " + str(reply["error"]))
+
+    payload = reply.get("payload")
+    mac = reply.get("mac")
+    if not isinstance(payload, dict) or not isinstance(mac, str):
+        raise TimeDistributionError("malformed reply")
+    if not hmac.compare_digest(payload_mac(key, payload), mac):
+        raise TimeDistributionError("MAC mismatch")
+    if payload.get("nonce") != nonce:
+        raise TimeDistributionError("nonce mismatch")
+
+    try:
+        server_unixtime = float(payload["server_unixtime"])
+        offset = float(payload["offset"])
+        round_unixtime = float(payload["round_unixtime"])
+        error_bound = float(payload["error_bound"])
+    except (KeyError, TypeError, ValueError):
+        raise TimeDistributionError("malformed payload")
+    if error_bound < 0:
+        raise TimeDistributionError("malformed payload")
+
+    round_age = server_unixtime + offset - round_unixtime
+    if round_age < 0 or round_age > max_age_seconds:
+        raise TimeDistributionError(
+            "last validated round of server too old: " +
+            str(round(round_age)) + " seconds")
+
+    return payload, end_unixtime, took_time
+
+
+if __name__ == "__main__":
+    payload, end_unixtime, took_time = query_time_distribution_server(
+        sys.argv[1], sys.argv[2], 4 * 60 * 60)
+    print("payload: " + str(payload))
+    print("end_unixtime: " + str(end_unixtime))
+    print("took_time: " + str(took_time))
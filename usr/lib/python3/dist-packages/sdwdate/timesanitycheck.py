@@ -12,8 +12,6 @@ sys.dont_write_bytecode = True
 import os
 import time
 # from datetime import datetime
-from dateutil.parser import parse
-from stem.connection import connect
 import subprocess
 
 os.environ["LC_TIME"] = "C"
@@ -21,6 +19,11 @@ os.environ["TZ"] = "UTC"
 time.tzset()
 
 def time_consensus_sanity_check(unixtime):
+    # Imported on first use. Takes long to import and is not needed until
+    # the first time source replied.
+    from stem.connection import connect
+    from sdwdate.http_date import parse_consensus_time
+
     error = ""
     status = "ok"
     consensus_valid_after_str = ""
@@ -51,17 +54,17 @@ def time_consensus_sanity_check(unixtime):
         pass
 
     try:
-        consensus_valid_after_unixtime = parse(
-            consensus_valid_after_str).strftime('%s')
-        consensus_valid_until_unixtime = parse(
-            consensus_valid_until_str).strftime('%s')
+        consensus_valid_after_unixtime = parse_consensus_time(
+            consensus_valid_after_str)
+        consensus_valid_until_unixtime = parse_consensus_time(
+            consensus_valid_until_str)
 
-        if int(unixtime) > int(consensus_valid_after_unixtime):
+        if int(unixtime) > consensus_valid_after_unixtime:
             pass
         else:
             status = "slow"
 
-        if int(unixtime) > int(consensus_valid_until_unixtime):
+        if int(unixtime) > consensus_valid_until_unixtime:
             status = "fast"
         else:
             pass
@@ -88,6 +91,8 @@ def static_time_sanity_check(unixtime_to_validate):
         # datetime.fromtimestamp(unixtime_to_validate), '%a %b %d %H:%M:%S UTC
         # %Y')
 
+        from sdwdate.spans import count_child_process
+        count_child_process()
         p = subprocess.Popen(
             "/usr/bin/minimum-unixtime-show",
             stdout=subprocess.PIPE,
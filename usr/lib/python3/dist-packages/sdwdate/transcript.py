@@ -0,0 +1,258 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Round transcripts. Opt-in using TRANSCRIPT_RECORD=true.
+#
+# A transcript holds the inputs that decided a round: per time source the
+# raw url_to_unixtime result (stdout, stderr including the HTTP Date header,
+# exit code, timing), the replay protection minimum, the static and Tor
+# consensus sanity check results, and per round the nanoseconds
+# randomization. Written as compact JSON to
+# /run/sdwdate/transcripts/round-<unixtime>-<round>.json
+#
+# Replay feeds a transcript back through check_remote, build_median and
+# add_or_subtract_nanoseconds with the recorded randomization and compares
+# the results:
+# /usr/share/sdwdate/transcript-replay /run/sdwdate/transcripts/*.json
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import json
+import glob
+import time
+import threading
+from pathlib import Path
+
+
+TRANSCRIPT_VERSION = 1
+
+# check_remote rejects stderr longer than 500 characters. Keep one more so
+# a replay rejects it too.
+STDERR_MAXIMUM_LENGTH = 501
+
+
+def http_time_from_stderr(stderr):
+    # url_to_unixtime verbose output: "http_time: Tue, 17 May 2033 ..."
+    for line in stderr.splitlines():
+        if line.startswith("http_time: "):
+            return line[len("http_time: "):]
+    return None
+
+
+def pool_number_of(pools, remote):
+    for pool_number, pool in enumerate(pools):
+        if remote in pool.url:
+            return pool_number
+    return None
+
+
+class TranscriptRecorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.batches = []
+        self.sanity_inputs = {}
+
+    def reset(self, enabled):
+        with self.lock:
+            self.enabled = enabled
+            self.batches = []
+            self.sanity_inputs = {}
+
+    def record_sanity_inputs(self, remote, replay_protection, static_check,
+                             consensus_check):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.sanity_inputs[remote] = {
+                "replay_protection": list(replay_protection),
+                "static_check": list(static_check),
+                "consensus_check": list(consensus_check),
+            }
+
+    def record_batch(self, pools, remotes, runs, results):
+        """
+        runs: run_command results. results: check_remote results
+        (RemoteResult). Both in the order of remotes.
+        """
+        if not self.enabled:
+            return
+        sources = []
+        with self.lock:
+            for remote, run, result in zip(remotes, runs, results):
+                process, run_status, end_unixtime, took_time, stdout, \
+                    stderr = run
+                source = {
+                    "url": remote,
+                    "pool": pool_number_of(pools, remote),
+                    "returncode": process.returncode,
+                    "run_status": run_status,
+                    "end_unixtime": end_unixtime,
+                    "took_time": took_time,
+                    "stdout": stdout,
+                    "stderr": stderr[:STDERR_MAXIMUM_LENGTH],
+                    "http_time": http_time_from_stderr(stderr),
+                    "status": result.status,
+                }
+                source.update(self.sanity_inputs.pop(remote, {}))
+                sources.append(source)
+            self.batches.append(sources)
+
+    def write(self, folder, round_number, round_record, keep):
+        """
+        Returns the file name.
+        """
+        with self.lock:
+            transcript = {
+                "version": TRANSCRIPT_VERSION,
+                "round": round_number,
+                "unixtime": time.time(),
+                "batches": self.batches,
+            }
+            transcript.update(round_record)
+
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        # systemd-tmpfiles 'Z /run/sdwdate/*' might have removed 'chmod +x'.
+        os.chmod(folder, 0o755)
+        file_name = (
+            folder + "/round-" + str(int(time.time())) + "-" +
+            str(round_number) + ".json"
+        )
+        temp_file_name = file_name + ".tmp"
+        with open(temp_file_name, "w") as file_object:
+            json.dump(transcript, file_object, separators=(",", ":"))
+        os.replace(temp_file_name, file_name)
+
+        # Oldest first. Names sort by unixtime.
+        file_names = sorted(glob.glob(folder + "/round-*.json"))
+        for old_file_name in file_names[:max(len(file_names) - keep, 0)]:
+            Path(old_file_name).unlink(missing_ok=True)
+        return file_name
+
+
+TRANSCRIPT = TranscriptRecorder()
+
+
+class RecordedProcess(object):
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+class RecordedChoices(object):
+    """
+    Replaces secure_choice of sdwdate.sdwdate during replay. Returns the
+    recorded nanoseconds and sign of add_or_subtract_nanoseconds.
+    """
+    def __init__(self, nanoseconds, sign):
+        self.values = [nanoseconds, sign]
+
+    def choice(self, sequence):
+        return self.values.pop(0)
+
+
+def replay(transcript, status_folder):
+    """
+    Returns a dict with recorded and replayed results and the list of
+    mismatches. Requires sdwdate.sdwdate.
+    """
+    from sdwdate import remote_times
+    from sdwdate.harness import FakePool
+    from sdwdate.harness import configure_sdwdate_module
+
+    pool_urls = [[] for pool_number in range(transcript["number_of_pools"])]
+    for batch in transcript["batches"]:
+        for source in batch:
+            if source["pool"] is not None and \
+                    source["url"] not in pool_urls[source["pool"]]:
+                pool_urls[source["pool"]].append(source["url"])
+    pools = [FakePool(urls) for urls in pool_urls]
+
+    # Transcripts written before POOL_QUORUM used all pools.
+    pool_quorum = transcript.get("pool_quorum", transcript["number_of_pools"])
+    sdwdate_module = configure_sdwdate_module(
+        status_folder, pool_urls, "127.0.0.1", "9050", pool_quorum)
+    sdwdate_module.LOGGER.disabled = True
+
+    current = {}
+    remote_times.time_replay_protection_file_read = \
+        lambda: tuple(current["replay_protection"])
+    remote_times.static_time_sanity_check = \
+        lambda unixtime: tuple(current["static_check"])
+    remote_times.time_consensus_sanity_check = \
+        lambda unixtime: tuple(current["consensus_check"])
+
+    mismatches = []
+    sdwdate_obj = sdwdate_module.SdwdateClass()
+    pools_done = set()
+
+    for batch_number, batch in enumerate(transcript["batches"]):
+        for i, source in enumerate(batch):
+            current.clear()
+            current.update(source)
+            url = source["url"]
+            result = remote_times.check_remote(
+                    i,
+                    pools,
+                    url,
+                    RecordedProcess(source["returncode"]),
+                    source["run_status"],
+                    source["end_unixtime"],
+                    source["took_time"],
+                    source["stdout"],
+                    source["stderr"],
+                    source["pool"]
+                )
+            if result.status != source["status"]:
+                mismatches.append(
+                    "batch " + str(batch_number) + " " + url + ": status " +
+                    str(source["status"]) + " replayed " + str(result.status))
+            # As sdwdate_fetch_loop: the first valid time of each pool.
+            if result.status != "ok" or source["pool"] in pools_done:
+                continue
+            pools_done.add(source["pool"])
+            sdwdate_obj.results[url] = result
+            sdwdate_obj.pool_results.append(result)
+
+    result = {
+        "round": transcript["round"],
+        "recorded_status": transcript["status"],
+        "mismatches": mismatches,
+    }
+
+    # As sdwdate_fetch_loop: below all pools, only if they agree.
+    if len(pools_done) < sdwdate_obj.pool_quorum or \
+            (len(pools_done) < transcript["number_of_pools"] and
+             not sdwdate_obj.pools_agree()):
+        result["replayed_status"] = "error"
+    else:
+        result["replayed_status"] = "success"
+        sdwdate_obj.build_median()
+        randomize = transcript["randomize"]
+        sdwdate_module.randomize_time_config = \
+            lambda: randomize is not None
+        if randomize is not None:
+            sdwdate_module.secure_choice = RecordedChoices(
+                randomize["nanoseconds"], randomize["sign"]).choice
+        sdwdate_obj.add_or_subtract_nanoseconds()
+        result["median_diff_raw"] = sdwdate_obj.median_diff_raw_in_seconds
+        result["new_diff"] = sdwdate_obj.new_diff_in_seconds
+        result["error_bound"] = sdwdate_obj.error_bound_seconds
+        for name, replayed in (
+                ("median_diff_raw", result["median_diff_raw"]),
+                ("new_diff", result["new_diff"]),
+                ("error_bound", result["error_bound"])):
+            recorded = transcript.get(name)
+            if recorded is not None and recorded != replayed:
+                mismatches.append(
+                    name + " " + str(recorded) + " replayed " + str(replayed))
+
+    if result["replayed_status"] != transcript["status"] and \
+            transcript["status"] == "success":
+        mismatches.append(
+            "status " + transcript["status"] + " replayed " +
+            result["replayed_status"])
+    return result
@@ -0,0 +1,103 @@
+#!/usr/bin/python3 -u
+
+# Copyright (C) 2017 - 2023 ENCRYPTED SUPPORT LP <adrelanos@whonix.org>
+# See the file COPYING for copying conditions.
+
+# Warm restart. After every round which set the time, sdwdate writes a
+# summary to /run/sdwdate/last_round: boot ID, CLOCK_BOOTTIME and unix
+# time the clock was set to, applied offset, error bound and the number of
+# time sources of the median.
+#
+# If sdwdate is restarted (Restart=always, package upgrade) within
+# WARM_RESTART_MAX_AGE seconds of that round, in the same boot, it sleeps
+# straight away instead of running preparation and a round, provided the
+# clock is still where the last round put it. A clock jump request
+# (sdwdate-clock-jump, suspend) removes first_success and always causes a
+# round.
+
+import sys
+sys.dont_write_bytecode = True
+
+import os
+import time
+
+from sdwdate.boot_timeline import boottime_seconds
+from sdwdate.boot_timeline import read_boot_id
+
+
+# Seconds. Largest difference between the clock and the time expected from
+# the last round. Otherwise something else changed the clock, or sclockadj
+# was stopped before it adjusted the clock in full.
+CLOCK_TOLERANCE_SECONDS = 2
+
+RECORD_KEYS = (
+    "set_boottime",
+    "set_unixtime",
+    "applied_offset",
+    "error_bound",
+    "median_offset",
+)
+
+
+def write_last_round(path, set_boottime, set_unixtime, applied_offset,
+                     error_bound, median_offset, sources):
+    """
+    set_boottime: CLOCK_BOOTTIME when the time was set.
+    set_unixtime: time the clock was set to at set_boottime.
+    sources: number of time sources of the median, for NTP_SHM.
+    """
+    import json
+    record = {
+        "boot_id": read_boot_id(),
+        "set_boottime": set_boottime,
+        "set_unixtime": set_unixtime,
+        "applied_offset": applied_offset,
+        "error_bound": error_bound,
+        "median_offset": median_offset,
+        "sources": sources,
+    }
+    temp_path = path + ".tmp." + str(os.getpid())
+    with open(temp_path, "w") as file_object:
+        json.dump(record, file_object, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def read_last_round(path, max_age):
+    """
+    Returns (record, reason). record is None if the last round cannot be
+    reused, reason says why.
+    """
+    import json
+    try:
+        with open(path) as file_object:
+            record = json.load(file_object)
+    except FileNotFoundError:
+        return None, "no last round"
+    except (OSError, ValueError):
+        error_message = str(sys.exc_info()[0]) + " " + str(sys.exc_info()[1])
+        return None, "last round unreadable: " + error_message
+
+    if not isinstance(record, dict):
+        return None, "last round malformed"
+    for key in RECORD_KEYS:
+        if not isinstance(record.get(key), (int, float)):
+            return None, "last round malformed: " + key
+
+    boot_id = read_boot_id()
+    if boot_id is not None and record.get("boot_id") is not None and \
+            boot_id != record["boot_id"]:
+        return None, "last round from another boot"
+
+    age = boottime_seconds() - record["set_boottime"]
+    if age < 0:
+        return None, "last round from another boot"
+    if age > max_age:
+        return None, "last round " + str(round(age)) + \
+            " seconds ago, older than " + str(max_age) + " seconds"
+    record["age"] = round(age, 3)
+
+    clock_error = time.time() - (record["set_unixtime"] + age)
+    if abs(clock_error) > CLOCK_TOLERANCE_SECONDS:
+        return None, "clock differs by " + str(round(clock_error, 3)) + \
+            " seconds from the time set by the last round"
+    return record, "last round " + str(round(age)) + " seconds ago"